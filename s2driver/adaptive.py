@@ -0,0 +1,152 @@
+import numpy as np
+
+### Adaptive coarse-to-fine sampling
+# Points live on a fine grid at the target resolution. Sampling starts on a coarse subgrid, split into square cells whose corners are measured. Cells whose corner values vary the most are split into four, measuring their edge midpoints and centers, until the cells reach the fine grid spacing or the point budget runs out.
+
+
+class AdaptiveGrid:
+    """Quadtree refinement of a 2d map. Grid indices are (iy, ix) on the fine grid."""
+
+    def __init__(self, numx: int, numy: int, coarse_spacing: int):
+        """
+        Args:
+            numx (int): fine grid points along x. (numx - 1) must be a multiple of coarse_spacing.
+            numy (int): fine grid points along y. (numy - 1) must be a multiple of coarse_spacing.
+            coarse_spacing (int): spacing of the initial coarse grid, in fine grid steps. Must be a power of two.
+
+        Raises:
+            ValueError: coarse_spacing is not a power of two, or does not divide the grid
+        """
+        if coarse_spacing < 1 or coarse_spacing & (coarse_spacing - 1):
+            raise ValueError("coarse_spacing must be a power of two!")
+        if (numx - 1) % coarse_spacing or (numy - 1) % coarse_spacing:
+            raise ValueError("Grid size minus one must be a multiple of coarse_spacing!")
+        self.numx = numx
+        self.numy = numy
+        self.coarse_spacing = coarse_spacing
+        self.values = np.full((numy, numx), np.nan)
+        self.sampled = np.zeros((numy, numx), dtype=bool)
+        iy, ix = np.meshgrid(
+            np.arange(0, numy - 1, coarse_spacing),
+            np.arange(0, numx - 1, coarse_spacing),
+            indexing="ij",
+        )
+        self.cells = np.column_stack(
+            [iy.ravel(), ix.ravel(), np.full(iy.size, coarse_spacing)]
+        )  # leaf cells, (iy, ix, size) of their lower corner
+
+    @staticmethod
+    def fit_to_spacing(num: int, coarse_spacing: int) -> int:
+        """Smallest valid grid size (number of points) that is at least num"""
+        cells = max(int(np.ceil((num - 1) / coarse_spacing)), 1)
+        return cells * coarse_spacing + 1
+
+    def initial_points(self) -> np.ndarray:
+        """(iy, ix) of the coarse grid points"""
+        iy, ix = np.meshgrid(
+            np.arange(0, self.numy, self.coarse_spacing),
+            np.arange(0, self.numx, self.coarse_spacing),
+            indexing="ij",
+        )
+        return np.column_stack([iy.ravel(), ix.ravel()])
+
+    def record(self, points: np.ndarray, values: np.ndarray):
+        """Stores measured values
+
+        Args:
+            points (np.ndarray): (iy, ix) of the measured points, shape (n, 2)
+            values (np.ndarray): measured values, shape (n,)
+        """
+        points = np.asarray(points, dtype=int)
+        self.values[points[:, 0], points[:, 1]] = values
+        self.sampled[points[:, 0], points[:, 1]] = True
+
+    def _corners(self, cells: np.ndarray) -> np.ndarray:
+        iy, ix, size = cells.T
+        return np.stack(
+            [
+                self.values[iy, ix],
+                self.values[iy, ix + size],
+                self.values[iy + size, ix],
+                self.values[iy + size, ix + size],
+            ],
+            axis=1,
+        )
+
+    def cell_scores(self) -> np.ndarray:
+        """Variation (max - min of the corner values) of every leaf cell, a cheap estimate of the local gradient times the cell size"""
+        corners = self._corners(self.cells)
+        return np.nanmax(corners, axis=1) - np.nanmin(corners, axis=1)
+
+    def refine(self, threshold: float = 0.1, max_new_points: int = None) -> np.ndarray:
+        """Splits the leaf cells whose variation is at least threshold times the range of all measured values, highest variation first
+
+        Args:
+            threshold (float, optional): relative variation above which a cell is split. Defaults to 0.1.
+            max_new_points (int, optional): stop splitting cells once this many new points would be needed. Defaults to None (no limit).
+
+        Returns:
+            np.ndarray: (iy, ix) of the new points to measure. Empty once no cell needs (or can be) split.
+        """
+        scores = self.cell_scores()
+        value_range = np.nanmax(self.values) - np.nanmin(self.values)
+        splittable = (self.cells[:, 2] > 1) & (scores >= threshold * value_range) & (scores > 0)
+        candidates = np.flatnonzero(splittable)
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        new_points = {}
+        split = []
+        for c in candidates:
+            iy, ix, size = self.cells[c]
+            half = size // 2
+            midpoints = [
+                (iy, ix + half),
+                (iy + half, ix),
+                (iy + half, ix + half),
+                (iy + half, ix + size),
+                (iy + size, ix + half),
+            ]
+            needed = [p for p in midpoints if not self.sampled[p] and p not in new_points]
+            if max_new_points is not None and len(new_points) + len(needed) > max_new_points:
+                break
+            for p in needed:
+                new_points[p] = True
+            split.append(c)
+
+        if len(split) > 0:
+            parents = self.cells[split]
+            half = parents[:, 2] // 2
+            children = [
+                np.column_stack([parents[:, 0] + dy * half, parents[:, 1] + dx * half, half])
+                for dy in (0, 1)
+                for dx in (0, 1)
+            ]
+            keep = np.ones(len(self.cells), dtype=bool)
+            keep[split] = False
+            self.cells = np.vstack([self.cells[keep], *children])
+        return np.array(list(new_points.keys()), dtype=int).reshape(-1, 2)
+
+    def reconstruct(self) -> np.ndarray:
+        """Full resolution map. Each leaf cell is filled by bilinear interpolation of its corners, measured points keep their values.
+
+        Returns:
+            np.ndarray: map of shape (numy, numx)
+        """
+        result = np.full((self.numy, self.numx), np.nan)
+        for size in np.unique(self.cells[:, 2])[::-1]:  # finer cells overwrite shared edges of coarser ones
+            cells = self.cells[self.cells[:, 2] == size]
+            v00, v01, v10, v11 = self._corners(cells).T
+            t = np.arange(size + 1) / size
+            ty = t[None, :, None]
+            tx = t[None, None, :]
+            block = (
+                (1 - ty) * (1 - tx) * v00[:, None, None]
+                + (1 - ty) * tx * v01[:, None, None]
+                + ty * (1 - tx) * v10[:, None, None]
+                + ty * tx * v11[:, None, None]
+            )
+            rows = cells[:, 0, None, None] + np.arange(size + 1)[None, :, None]
+            cols = cells[:, 1, None, None] + np.arange(size + 1)[None, None, :]
+            result[rows, cols] = block
+        result[self.sampled] = self.values[self.sampled]
+        return result
@@ -0,0 +1,106 @@
+import os
+import h5py
+import numpy as np
+from s2driver.analysis.loading import get_h5_filepath, iter_mca_rows
+
+### Cumulative sum index
+# The raw MCA spectra of a scan are summed cumulatively along the energy axis once, and cached next to the MAPS file. The counts in any energy window are then the difference of two planes of the index, so a map of an arbitrary ROI costs one subtraction per pixel instead of a pass over every spectrum.
+
+CUMSUM_ROWS = 16  # map rows summed at once while building the index, which is also the chunk height on disk
+
+
+def get_cumsum_filepath(scan_number: int) -> str:
+    """Path to the cumulative sum index of a scan, next to its MAPS .h5 file"""
+    return get_h5_filepath(scan_number).replace(".h5", "_cumsum.h5")
+
+
+def _source_signature(fpath: str) -> tuple:
+    """(size, modification time) of a file, to tell whether an index is stale"""
+    stat = os.stat(fpath)
+    return stat.st_size, stat.st_mtime
+
+
+def build_cumsum_index(scan_number: int, overwrite: bool = False) -> str:
+    """Builds the cumulative sum index of a scan's raw spectra, a few rows at a time, so the spectra never have to fit in memory. Lines of serpentine scans are flipped back like load_h5 does. An existing index is reused unless the MAPS file changed since it was built.
+
+    The index holds "cumsum" (energy bins + 1 by y by x, starting with a plane of zeros) and the "energy" axis of the bins.
+
+    Args:
+        scan_number (int): scan to index
+        overwrite (bool, optional): whether to rebuild an up-to-date index. Defaults to False.
+
+    Returns:
+        str: path to the index
+    """
+    source = get_h5_filepath(scan_number)
+    fpath = get_cumsum_filepath(scan_number)
+    signature = _source_signature(source)
+    if not overwrite and os.path.exists(fpath):
+        with h5py.File(fpath, "r") as dat:
+            if tuple(dat.attrs.get("source_signature", ())) == signature:
+                return fpath
+
+    tmp_fpath = fpath + ".tmp"  # renamed once complete, so a half-built index is never used
+    with h5py.File(source, "r") as src:
+        mca = src["MAPS"]["mca_arr"]
+        nbins, ny, nx = mca.shape
+        dtype = np.int64 if np.issubdtype(mca.dtype, np.integer) else np.float64  # exact sums of integer counts
+        energy = src["MAPS"]["energy"][:nbins]
+    with h5py.File(tmp_fpath, "w") as dat:
+        dat["energy"] = energy
+        cumsum = dat.create_dataset(
+            "cumsum",
+            shape=(nbins + 1, ny, nx),
+            dtype=dtype,
+            chunks=(1, min(CUMSUM_ROWS, ny), nx),  # one plane (a window edge) reads as whole chunks
+        )
+        cumsum[0] = np.zeros((ny, nx), dtype=dtype)
+        for y0, block in iter_mca_rows(scan_number, CUMSUM_ROWS):
+            cumsum[1:, y0 : y0 + CUMSUM_ROWS] = np.cumsum(block, axis=0, dtype=dtype)
+        dat.attrs["source_signature"] = signature
+    os.replace(tmp_fpath, fpath)
+    return fpath
+
+
+def roi_maps(scan_number: int, windows: dict, clip_flyscan: bool = True) -> dict:
+    """Raw counts in arbitrary energy windows, from the cumulative sum index of a scan. Builds the index on first use.
+
+    Args:
+        scan_number (int): scan to map
+        windows (dict): name: (emin, emax) energy windows, in the units of the MAPS energy axis (keV). Bins with energies inside the window are summed.
+        clip_flyscan (bool, optional): removes the last two columns of the maps, like load_h5. Defaults to True.
+
+    Raises:
+        ValueError: a window with emin > emax
+
+    Returns:
+        dict: name: map (y by x) of counts in each window
+    """
+    xmask = slice(0, -2) if clip_flyscan else slice(0, None)
+    fpath = build_cumsum_index(scan_number)
+    maps = {}
+    with h5py.File(fpath, "r") as dat:
+        energy = dat["energy"][()]
+        cumsum = dat["cumsum"]
+        for name, (emin, emax) in windows.items():
+            if emin > emax:
+                raise ValueError(f"Window {name} must have emin <= emax, got ({emin}, {emax})!")
+            lower = np.searchsorted(energy, emin, side="left")
+            upper = np.searchsorted(energy, emax, side="right")
+            maps[name] = (cumsum[upper] - cumsum[lower])[:, xmask]
+    return maps
+
+
+def roi_map(scan_number: int, emin: float, emax: float, clip_flyscan: bool = True) -> np.ndarray:
+    """Raw counts in one energy window, see roi_maps
+
+    Args:
+        scan_number (int): scan to map
+        emin (float): lower edge of the window (keV)
+        emax (float): upper edge of the window (keV)
+        clip_flyscan (bool, optional): removes the last two columns of the map, like load_h5. Defaults to True.
+
+    Returns:
+        np.ndarray: map (y by x) of counts in the window
+    """
+    return roi_maps(scan_number, {"roi": (emin, emax)}, clip_flyscan=clip_flyscan)["roi"]
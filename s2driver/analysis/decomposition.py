@@ -0,0 +1,270 @@
+import os
+import h5py
+import numpy as np
+from s2driver.analysis.helpers import save_dict_to_hdf5, load_dict_from_hdf5
+from s2driver.analysis.loading import (
+    get_h5_filepath,
+    get_xeol_filepath,
+    iter_mca_rows,
+    iter_xeol_rows,
+)
+
+### Decomposition
+# PCA and NMF of XRF or XEOL cubes that may not fit in memory. Spectra are streamed from the scan's .h5 file in blocks of map rows sized to a memory budget, as float32. PCA accumulates the covariance matrix in one pass and projects onto its eigenvectors in a second, which is exact. NMF learns its components online from mini-batches (Mairal et al., 2010) and then fits abundances with the components fixed.
+
+DECOMPOSITION_MEMORY = 256e6  # bytes of spectra held in memory at once
+BLOCK_COPIES = 4  # working copies of a block of spectra, used to size blocks to the memory budget
+DECOMPOSITION_METHODS = ["pca", "nmf"]
+NMF_COMPONENT_ITERATIONS = 20  # multiplicative updates of the NMF components after every block
+
+
+def get_decomposition_filepath(scan_number: int, method: str, xeol: bool = False) -> str:
+    """Path to the saved decomposition of a scan, next to its MAPS (or XEOL) .h5 file"""
+    source = get_xeol_filepath(scan_number) if xeol else get_h5_filepath(scan_number)
+    return source.replace(".h5", f"_{method}.h5")
+
+
+def _cube_shape(scan_number: int, xeol: bool, clip_flyscan: bool) -> tuple:
+    """(ny, nx, spectral axis) of a scan's spectra, nx after clipping flyscan columns"""
+    if xeol:
+        with h5py.File(get_xeol_filepath(scan_number), "r") as dat:
+            shape = dat["spectra"].shape
+            axis = dat["wavelength"][()]
+        ny, nx = (1, shape[0]) if len(shape) == 2 else shape[:2]
+    else:
+        with h5py.File(get_h5_filepath(scan_number), "r") as dat:
+            nbins, ny, nx = dat["MAPS"]["mca_arr"].shape
+            axis = dat["MAPS"]["energy"][:nbins]
+        if clip_flyscan:
+            nx -= 2
+    return ny, nx, axis
+
+
+def _iter_blocks(scan_number: int, xeol: bool, channels: slice, clip_flyscan: bool, memory: float):
+    """Yields (first row, rows by x by channels float32 spectra) blocks of a scan, sized to the memory budget"""
+    ny, nx, axis = _cube_shape(scan_number, xeol, clip_flyscan)
+    nchannels = len(axis[channels])
+    rows = max(1, int(memory // (BLOCK_COPIES * 4 * nx * nchannels)))
+    if xeol:
+        for y0, block in iter_xeol_rows(scan_number, rows):
+            yield y0, np.asarray(block[..., channels], dtype=np.float32)
+    else:
+        xmask = slice(0, nx)  # drops the flyscan columns if clipped
+        for y0, block in iter_mca_rows(scan_number, rows):
+            yield y0, np.asarray(np.moveaxis(block[channels], 0, 2)[:, xmask], dtype=np.float32)
+
+
+def _iter_measured(scan_number: int, xeol: bool, channels: slice, clip_flyscan: bool, memory: float, nx: int):
+    """Yields (first row, flat pixel indices, non-negative spectra as pixels by channels) of the measured points of each block, for NMF"""
+    for y0, block in _iter_blocks(scan_number, xeol, channels, clip_flyscan, memory):
+        x = block.reshape(-1, block.shape[-1])
+        measured = np.flatnonzero(np.isfinite(x).all(axis=1))
+        if len(measured) > 0:
+            yield y0, y0 * nx + measured, np.maximum(x[measured], 0)
+
+
+def _measured(x: np.ndarray) -> np.ndarray:
+    """Spectra (pixels by channels) of the points that were measured, ie without the NaN points of aborted XEOL scans"""
+    return x[np.isfinite(x).all(axis=1)]
+
+
+def _output(method: str, scan_number: int, xeol: bool, components: np.ndarray, maps: np.ndarray, axis: np.ndarray, save: bool, **extra) -> dict:
+    output = {
+        "method": method,
+        "components": components,  # components by channels
+        "maps": maps,  # components by y by x
+        "wavelength" if xeol else "energy": axis,
+        **extra,
+    }
+    if save:
+        fpath = get_decomposition_filepath(scan_number, method, xeol)
+        save_dict_to_hdf5(output, fpath)
+        output["filepath"] = fpath
+    return output
+
+
+def incremental_pca(
+    scan_number: int,
+    n_components: int = 5,
+    xeol: bool = False,
+    channels: slice = slice(None),
+    clip_flyscan: bool = True,
+    memory: float = DECOMPOSITION_MEMORY,
+    save: bool = True,
+) -> dict:
+    """Principal component analysis of the spectra of a scan, streamed from disk in two passes
+
+    Args:
+        scan_number (int): scan to decompose
+        n_components (int, optional): number of components to keep. Defaults to 5.
+        xeol (bool, optional): whether to decompose the XEOL spectra (counts per second) instead of the raw XRF spectra. Defaults to False.
+        channels (slice, optional): energy/wavelength channels to use. Defaults to slice(None) (all).
+        clip_flyscan (bool, optional): removes the last two columns of XRF maps, like load_h5. Defaults to True.
+        memory (float, optional): bytes of spectra to hold in memory at once. Defaults to DECOMPOSITION_MEMORY.
+        save (bool, optional): whether to save the result to get_decomposition_filepath. Defaults to True.
+
+    Returns:
+        dict: "components" (orthonormal, components by channels), "maps" of scores (components by y by x, NaN at points an aborted XEOL scan never reached), "mean" spectrum, "explained_variance" and "explained_variance_ratio", the "energy" or "wavelength" axis, and the "filepath" if saved
+    """
+    ny, nx, axis = _cube_shape(scan_number, xeol, clip_flyscan)
+    axis = axis[channels]
+    nchannels = len(axis)
+    shift = None  # spectra are summed relative to the first block's mean, which avoids cancellation in the covariance
+    total = np.zeros(nchannels)
+    products = np.zeros((nchannels, nchannels))
+    npixels = 0
+    for _, block in _iter_blocks(scan_number, xeol, channels, clip_flyscan, memory):
+        x = _measured(block.reshape(-1, nchannels))
+        if len(x) == 0:
+            continue
+        if shift is None:
+            shift = x.mean(axis=0)
+        x = x - shift
+        total += x.sum(axis=0, dtype=float)
+        products += (x.T @ x).astype(float)
+        npixels += len(x)
+    mean = shift + total / npixels
+    covariance = (products - np.outer(total, total) / npixels) / max(npixels - 1, 1)
+    variance, vectors = np.linalg.eigh(covariance)
+    order = np.argsort(variance)[::-1][:n_components]
+    components = vectors[:, order].T
+    components *= np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])[:, None]  # largest loading positive
+
+    maps = np.zeros((len(components), ny, nx), dtype=np.float32)
+    components32 = components.astype(np.float32)
+    mean32 = mean.astype(np.float32)
+    for y0, block in _iter_blocks(scan_number, xeol, channels, clip_flyscan, memory):
+        maps[:, y0 : y0 + block.shape[0]] = np.moveaxis((block - mean32) @ components32.T, 2, 0)  # NaN where nothing was measured
+    return _output(
+        "pca",
+        scan_number,
+        xeol,
+        components,
+        maps,
+        axis,
+        save,
+        mean=mean,
+        explained_variance=variance[order],
+        explained_variance_ratio=variance[order] / max(variance.sum(), 1e-12),
+    )
+
+
+def _nmf_abundances(x: np.ndarray, components: np.ndarray, iterations: int, h: np.ndarray = None) -> np.ndarray:
+    """Non-negative abundances (pixels by components) of spectra x (pixels by channels) with the components fixed, by multiplicative updates"""
+    wwt = components @ components.T
+    xwt = x @ components.T
+    if h is None:
+        h = np.maximum(xwt, 0) / np.maximum(np.diag(wwt), 1e-12) / len(components)
+        h = np.maximum(h, 1e-6 * h.max())  # multiplicative updates can not move an abundance away from 0
+    for _ in range(iterations):
+        h *= xwt / np.maximum(h @ wwt, 1e-12)
+    return h
+
+
+def minibatch_nmf(
+    scan_number: int,
+    n_components: int = 5,
+    xeol: bool = False,
+    channels: slice = slice(None),
+    epochs: int = 100,
+    tolerance: float = 1e-4,
+    iterations: int = 20,
+    component_iterations: int = NMF_COMPONENT_ITERATIONS,
+    clip_flyscan: bool = True,
+    memory: float = DECOMPOSITION_MEMORY,
+    seed: int = 0,
+    save: bool = True,
+) -> dict:
+    """Non-negative matrix factorization of the spectra of a scan, learnt online from blocks streamed from disk. Negative values (eg background-subtracted XEOL noise) are clipped to 0.
+
+    Every block updates its abundances (warm started from the previous pass), adds them to the sufficient statistics of the pass, and then updates the components several times against those statistics, like the block coordinate step of Mairal et al. Passes repeat until the components stop changing.
+
+    Args:
+        scan_number (int): scan to decompose
+        n_components (int, optional): number of components. Defaults to 5.
+        xeol (bool, optional): whether to decompose the XEOL spectra (counts per second) instead of the raw XRF spectra. Defaults to False.
+        channels (slice, optional): energy/wavelength channels to use. Defaults to slice(None) (all).
+        epochs (int, optional): maximum passes over the scan to learn the components. Defaults to 100.
+        tolerance (float, optional): learning stops once a pass changes the components by less than this fraction. Defaults to 1e-4.
+        iterations (int, optional): multiplicative updates of the abundances of each block. Defaults to 20.
+        component_iterations (int, optional): multiplicative updates of the components after each block. Defaults to NMF_COMPONENT_ITERATIONS.
+        clip_flyscan (bool, optional): removes the last two columns of XRF maps, like load_h5. Defaults to True.
+        memory (float, optional): bytes of spectra to hold in memory at once. Defaults to DECOMPOSITION_MEMORY.
+        seed (int, optional): seed of the random initial components. Defaults to 0.
+        save (bool, optional): whether to save the result to get_decomposition_filepath. Defaults to True.
+
+    Returns:
+        dict: "components" (non-negative, each summing to 1, components by channels), "maps" of abundances (components by y by x, in counts, NaN at points an aborted XEOL scan never reached), "reconstruction_error" (relative, over the whole scan), the "epochs" run and whether the components "converged" within tolerance, the "energy" or "wavelength" axis, and the "filepath" if saved
+    """
+    ny, nx, axis = _cube_shape(scan_number, xeol, clip_flyscan)
+    axis = axis[channels]
+    nchannels = len(axis)
+    rng = np.random.default_rng(seed)
+    components = None
+    abundances = np.full((ny * nx, n_components), np.nan, dtype=np.float32)  # warm start of the next pass
+    converged = False
+    for epoch in range(1, epochs + 1):
+        previous = None if components is None else components.copy()
+        hth = np.zeros((n_components, n_components), dtype=np.float32)  # sufficient statistics of the pass so far
+        htx = np.zeros((n_components, nchannels), dtype=np.float32)
+        for y0, pixels, x in _iter_measured(scan_number, xeol, channels, clip_flyscan, memory, nx):
+            if components is None:  # random mixtures of the mean spectrum
+                components = x.mean(axis=0) * rng.uniform(0.5, 1.5, (n_components, nchannels)).astype(np.float32) + 1e-6
+            h = _nmf_abundances(x, components, iterations, h=None if previous is None else abundances[pixels])
+            abundances[pixels] = h
+            hth += h.T @ h
+            htx += h.T @ x
+            for _ in range(component_iterations):
+                components *= htx / np.maximum(hth @ components, 1e-12)
+        if previous is not None and np.linalg.norm(components - previous) < tolerance * np.linalg.norm(previous):
+            converged = True
+            break
+
+    scale = np.maximum(components.sum(axis=1), 1e-12)
+    components /= scale[:, None]  # abundances carry the counts
+    abundances *= scale
+    squared_error = squared_norm = 0.0
+    for y0, pixels, x in _iter_measured(scan_number, xeol, channels, clip_flyscan, memory, nx):
+        h = _nmf_abundances(x, components, iterations, h=abundances[pixels])
+        abundances[pixels] = h
+        squared_error += float(((x - h @ components) ** 2).sum())
+        squared_norm += float((x**2).sum())
+    maps = np.moveaxis(abundances.reshape(ny, nx, n_components), 2, 0)  # NaN where nothing was measured
+    return _output(
+        "nmf",
+        scan_number,
+        xeol,
+        components,
+        maps,
+        axis,
+        save,
+        reconstruction_error=np.float64(np.sqrt(squared_error / max(squared_norm, 1e-12))),
+        epochs=np.int64(epoch),
+        converged=np.int64(converged),
+    )
+
+
+def load_decomposition(scan_number: int, method: str, xeol: bool = False) -> dict:
+    """Loads a decomposition saved by incremental_pca or minibatch_nmf
+
+    Args:
+        scan_number (int): decomposed scan
+        method (str): one of DECOMPOSITION_METHODS
+        xeol (bool, optional): whether to load the decomposition of the XEOL spectra. Defaults to False.
+
+    Raises:
+        ValueError: invalid method
+        FileNotFoundError: the scan has not been decomposed with this method
+
+    Returns:
+        dict: the saved decomposition, see incremental_pca and minibatch_nmf
+    """
+    if method not in DECOMPOSITION_METHODS:
+        raise ValueError(f"Method must be one of {DECOMPOSITION_METHODS}, not {method}!")
+    fpath = get_decomposition_filepath(scan_number, method, xeol)
+    if not os.path.exists(fpath):
+        raise FileNotFoundError(f"No {method} decomposition of scan {scan_number} at {fpath}!")
+    output = load_dict_from_hdf5(fpath)
+    output["method"] = output["method"].decode() if isinstance(output["method"], bytes) else output["method"]
+    output["filepath"] = fpath
+    return output
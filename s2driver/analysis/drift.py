@@ -0,0 +1,174 @@
+import time
+import numpy as np
+
+### Drift tracking
+# Successive maps of the same area are registered against a reference map by phase correlation, which finds the translation between two images from the peak of their normalized cross-power spectrum. Noisy XRF maps register more reliably with partial normalization and a gaussian low-pass on the cross-power spectrum. Measured drifts are fit against time so the next scan can be re-centered on the features it is meant to hit.
+
+DRIFT_MODELS = ["last", "linear"]  # how DriftTracker predicts drift, see DriftTracker.predict
+
+
+def _prepare(image: np.ndarray, window: bool) -> np.ndarray:
+    image = np.asarray(image, dtype=float)
+    finite = np.isfinite(image)
+    image = np.where(finite, image, np.nanmean(image) if finite.any() else 0.0)
+    image = image - image.mean()
+    if window:  # taper edges, so the map borders do not dominate the correlation
+        image = image * np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    return image
+
+
+def _subpixel_offset(left: np.ndarray, center: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Vertex of the parabola through three samples around a peak, relative to the center sample"""
+    denominator = left - 2 * center + right
+    return np.divide(left - right, 2 * denominator, out=np.zeros_like(center), where=denominator != 0)
+
+
+def phase_correlation(
+    reference: np.ndarray,
+    image: np.ndarray,
+    whitening: float = 0.5,
+    lowpass: float = 0.1,
+    window: bool = False,
+) -> tuple:
+    """Translation of image relative to reference, to subpixel precision. Both maps must have the same shape. NaNs are filled with the map mean.
+
+    Args:
+        reference (np.ndarray): reference map, y by x
+        image (np.ndarray): map to register, y by x
+        whitening (float, optional): the cross-power spectrum is divided by its magnitude to this power. 1 is pure phase correlation, lower values keep some weight on strong (low frequency) features, which is more robust to noise. Defaults to 0.5.
+        lowpass (float, optional): width (sigma) of a gaussian low-pass on the cross-power spectrum, in cycles per pixel. None disables it. Defaults to 0.1.
+        window (bool, optional): whether to apply a Hann window first, for maps with strong features on their borders. Defaults to False.
+
+    Returns:
+        tuple: (dy, dx) in pixels, where features of reference appear in image, and the correlation peak height relative to the mean (higher is a more confident match)
+    """
+    if np.shape(reference) != np.shape(image):
+        raise ValueError(f"Maps must have the same shape, got {np.shape(reference)} and {np.shape(image)}!")
+    reference_spectrum = np.conj(np.fft.rfft2(_prepare(reference, window)))
+    return _register_to_spectrum(reference_spectrum, image, whitening, lowpass, window)
+
+
+def _register_to_spectrum(reference_spectrum: np.ndarray, image: np.ndarray, whitening: float, lowpass: float, window: bool) -> tuple:
+    """phase_correlation against a precomputed conjugate spectrum of the reference, which saves one FFT per registration"""
+    ny, nx = np.shape(image)
+    cross_power = np.fft.rfft2(_prepare(image, window)) * reference_spectrum
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12) ** whitening
+    if lowpass is not None:
+        fy = np.fft.fftfreq(ny)[:, None]
+        fx = np.fft.rfftfreq(nx)[None, :]
+        cross_power *= np.exp(-(fy**2 + fx**2) / (2 * lowpass**2))
+    correlation = np.fft.irfft2(cross_power, s=(ny, nx))
+    py, px = np.unravel_index(np.argmax(correlation), correlation.shape)
+    peak = correlation[py, px]
+    confidence = peak / max(np.abs(correlation).mean(), 1e-12)
+    dy = py + _subpixel_offset(correlation[py - 1, px], peak, correlation[(py + 1) % ny, px])
+    dx = px + _subpixel_offset(correlation[py, px - 1], peak, correlation[py, (px + 1) % nx])
+    dy = dy - ny if dy > ny / 2 else dy  # shifts wrap around
+    dx = dx - nx if dx > nx / 2 else dx
+    return (float(dy), float(dx)), float(confidence)
+
+
+class DriftTracker:
+    """Tracks sample drift over a campaign by registering each new map of an area against a reference map. Maps must share the reference's shape and pixel size, but may be centered differently (eg after a drift correction)."""
+
+    def __init__(
+        self,
+        reference: dict,
+        channel: str,
+        model: str = "linear",
+        history: int = 10,
+        timestamp: float = None,
+    ):
+        """
+        Args:
+            reference (dict): reference map, loaded with s2driver.analysis.loading.load_h5
+            channel (str): element channel to register on, eg a channel with sharp, static features
+            model (str, optional): how to predict drift, one of DRIFT_MODELS. "last" uses the latest measurement, "linear" extrapolates a linear fit of the recent measurements. Defaults to "linear".
+            history (int, optional): number of recent measurements the linear model is fit to. Defaults to 10.
+            timestamp (float, optional): time the reference was measured, in s since the epoch. Defaults to None (now).
+
+        Raises:
+            ValueError: invalid model
+        """
+        if model not in DRIFT_MODELS:
+            raise ValueError(f"Drift model must be one of {DRIFT_MODELS}, not {model}!")
+        self.channel = channel
+        self.model = model
+        self.history = history
+        self.reference = np.asarray(reference["maps"][channel], dtype=float)
+        self._reference_spectrum = np.conj(np.fft.rfft2(_prepare(self.reference, window=False)))
+        self.x0 = float(reference["x"][0])
+        self.y0 = float(reference["y"][0])
+        self.pixel_x = float(np.median(np.diff(reference["x"])))
+        self.pixel_y = float(np.median(np.diff(reference["y"])))
+        t = time.time() if timestamp is None else timestamp
+        self.times = [t]
+        self.drifts = [(0.0, 0.0)]  # (dx, dy) in um, relative to the reference
+        self.peaks = [np.nan]  # nothing to correlate the reference with
+
+    def register(self, overview: dict, timestamp: float = None) -> tuple:
+        """Measures the drift of a new map of the reference area and adds it to the drift history
+
+        Args:
+            overview (dict): new map, loaded with s2driver.analysis.loading.load_h5
+            timestamp (float, optional): time the map was measured, in s since the epoch. Defaults to None (now).
+
+        Returns:
+            tuple: (dx, dy) drift in um since the reference map: features moved by this much in motor coordinates
+        """
+        image = np.asarray(overview["maps"][self.channel], dtype=float)
+        if image.shape != self.reference.shape:
+            raise ValueError(f"Map shape {image.shape} does not match the reference {self.reference.shape}!")
+        (dy, dx), peak = _register_to_spectrum(self._reference_spectrum, image, whitening=0.5, lowpass=0.1, window=False)
+        drift = (
+            dx * self.pixel_x + float(overview["x"][0]) - self.x0,  # pixel shift plus change in scan origin
+            dy * self.pixel_y + float(overview["y"][0]) - self.y0,
+        )
+        self.times.append(time.time() if timestamp is None else timestamp)
+        self.drifts.append(drift)
+        self.peaks.append(peak)
+        return drift
+
+    def predict(self, timestamp: float = None) -> tuple:
+        """Expected drift at a time, from the drift model
+
+        Args:
+            timestamp (float, optional): time to predict at, in s since the epoch. Defaults to None (now).
+
+        Returns:
+            tuple: (dx, dy) expected drift in um since the reference map
+        """
+        if self.model == "last" or len(self.times) < 3:
+            return self.drifts[-1]
+        t = np.array(self.times[-self.history :])
+        drifts = np.array(self.drifts[-self.history :])
+        t_now = time.time() if timestamp is None else timestamp
+        design = np.column_stack([t - t[-1], np.ones_like(t)])
+        coefficients, *_ = np.linalg.lstsq(design, drifts, rcond=None)  # (slope, offset) for x and y at once
+        return tuple(float(v) for v in coefficients[0] * (t_now - t[-1]) + coefficients[1])
+
+    def correct(self, startpos1: float, endpos1: float, startpos2: float, endpos2: float, timestamp: float = None) -> tuple:
+        """Shifts scan bounds defined on the reference map by the expected drift, so they cover the same features
+
+        Args:
+            startpos1 (float): starting x position, in um
+            endpos1 (float): ending x position, in um
+            startpos2 (float): starting y position, in um
+            endpos2 (float): ending y position, in um
+            timestamp (float, optional): time the scan will run, in s since the epoch. Defaults to None (now).
+
+        Returns:
+            tuple: corrected (startpos1, endpos1, startpos2, endpos2)
+        """
+        dx, dy = self.predict(timestamp)
+        return startpos1 + dx, endpos1 + dx, startpos2 + dy, endpos2 + dy
+
+    def report(self) -> dict:
+        """Drift history: "time" (s since the reference), "dx" and "dy" (um), and correlation "peak" confidence of every registration"""
+        drifts = np.array(self.drifts)
+        return {
+            "time": np.array(self.times) - self.times[0],
+            "dx": drifts[:, 0],
+            "dy": drifts[:, 1],
+            "peak": np.array(self.peaks),
+        }
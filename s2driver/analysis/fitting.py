@@ -0,0 +1,339 @@
+import h5py
+import numpy as np
+from s2driver.analysis.loading import get_h5_filepath, iter_mca_rows
+
+### Quick-look spectral fitting
+# Every spectrum is modelled as a non-negative sum of element line families (gaussians at the emission lines, with the detector's energy resolution), an optional elastic peak, and the smooth background of the whole map, stripped once from the summed spectrum (SNIP) where counting statistics are good. The design matrix is the same for every pixel, so the normal equations are formed for a whole block of pixels with one matrix product, and non-negative least squares is solved for all of them at once with an active set method that groups pixels with the same free components.
+
+FIT_ROWS = 16  # map rows fitted at once by fit_scan
+NNLS_ITERATIONS = 100  # maximum active set changes in nnls
+NNLS_TOLERANCE = 1e-9  # relative gradient below which a fixed component is not freed, see nnls
+NNLS_MIN_WEIGHT = 1e-6  # components whose squared norm is below this fraction of the largest are not fitted, eg lines outside the energy range
+SHARED_PASSIVE_SET = 8  # pixels sharing a set of free components are solved together once there are this many
+NNLS_WARM_START = 3  # rounds of dropping negative components before the exact active set method, see nnls
+NNLS_STACK = 4096  # pixels solved at once as a stack of masked systems
+BACKGROUND_WIDTH = 0.5  # keV, widest clipping window of the SNIP background, a few times the peak FWHM
+SIGMA_TO_FWHM = 2 * np.sqrt(2 * np.log(2))  # ~2.355
+
+ELEMENT_LINES = {
+    # (energy keV, relative intensity) of the strongest emission lines. K lines up to Br, L lines above
+    "Si": [(1.740, 1.0), (1.836, 0.03)],
+    "P": [(2.013, 1.0), (2.139, 0.04)],
+    "S": [(2.307, 1.0), (2.464, 0.06)],
+    "Cl": [(2.622, 1.0), (2.816, 0.08)],
+    "Ar": [(2.957, 1.0), (3.190, 0.10)],
+    "K": [(3.314, 1.0), (3.590, 0.11)],
+    "Ca": [(3.692, 1.0), (4.013, 0.12)],
+    "Ti": [(4.511, 1.0), (4.932, 0.13)],
+    "V": [(4.952, 1.0), (5.427, 0.13)],
+    "Cr": [(5.415, 1.0), (5.947, 0.13)],
+    "Mn": [(5.899, 1.0), (6.490, 0.13)],
+    "Fe": [(6.404, 1.0), (7.058, 0.13)],
+    "Co": [(6.930, 1.0), (7.649, 0.13)],
+    "Ni": [(7.478, 1.0), (8.265, 0.13)],
+    "Cu": [(8.048, 1.0), (8.905, 0.13)],
+    "Zn": [(8.639, 1.0), (9.572, 0.14)],
+    "Ga": [(9.252, 1.0), (10.264, 0.15)],
+    "Ge": [(9.886, 1.0), (10.982, 0.15)],
+    "As": [(10.544, 1.0), (11.726, 0.16)],
+    "Se": [(11.222, 1.0), (12.496, 0.17)],
+    "Br": [(11.924, 1.0), (13.291, 0.17)],
+    "Cd": [(3.134, 1.0), (3.317, 0.55)],
+    "In": [(3.287, 1.0), (3.487, 0.55)],
+    "Sn": [(3.444, 1.0), (3.663, 0.55)],
+    "Sb": [(3.605, 1.0), (3.844, 0.55)],
+    "Te": [(3.769, 1.0), (4.029, 0.55)],
+    "I": [(3.938, 1.0), (4.221, 0.55)],
+    "Cs": [(4.287, 1.0), (4.620, 0.55)],
+    "Ba": [(4.466, 1.0), (4.828, 0.55)],
+    "W": [(8.398, 1.0), (9.672, 0.70)],
+    "Pt": [(9.442, 1.0), (11.071, 0.75)],
+    "Au": [(9.713, 1.0), (11.443, 0.75)],
+    "Hg": [(9.989, 1.0), (11.823, 0.75)],
+    "Pb": [(10.551, 1.0), (12.614, 0.80)],
+    "Bi": [(10.839, 1.0), (13.024, 0.80)],
+}
+
+
+def detector_sigma(energy, noise: float = 0.12, fano: float = 0.114) -> np.ndarray:
+    """Standard deviation of a silicon drift detector peak at an energy: electronic noise plus Fano-limited charge statistics
+
+    Args:
+        energy (array-like): peak energies, in keV
+        noise (float, optional): FWHM of the electronic noise, in keV. Defaults to 0.12.
+        fano (float, optional): Fano factor of silicon. Defaults to 0.114.
+
+    Returns:
+        np.ndarray: peak sigma, in keV
+    """
+    return np.sqrt((noise / SIGMA_TO_FWHM) ** 2 + 3.85e-3 * fano * np.asarray(energy, dtype=float))
+
+
+def _gaussian(energy: np.ndarray, center: float, sigma: float) -> np.ndarray:
+    """Gaussian of unit area, sampled at the bin energies"""
+    return np.exp(-0.5 * ((energy - center) / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+
+
+def design_matrix(
+    energy: np.ndarray,
+    elements: list,
+    incident_energy: float = None,
+    background: np.ndarray = None,
+    noise: float = 0.12,
+    fano: float = 0.114,
+) -> tuple:
+    """Model spectra of every fit component, one column each, normalized so a component's amplitude is its total counts
+
+    Args:
+        energy (np.ndarray): bin energies, in keV
+        elements (list): element symbols, keys of ELEMENT_LINES
+        incident_energy (float, optional): beam energy in keV, adds an "elastic" peak component. Defaults to None (no elastic peak).
+        background (np.ndarray, optional): background counts on the energy axis, eg from snip_background, adds a "background" component of this shape. Defaults to None (no background).
+        noise (float, optional): detector noise FWHM in keV, see detector_sigma. Defaults to 0.12.
+        fano (float, optional): Fano factor, see detector_sigma. Defaults to 0.114.
+
+    Raises:
+        ValueError: unknown element
+
+    Returns:
+        tuple: (design matrix of shape bins by components, component names)
+    """
+    unknown = [el for el in elements if el not in ELEMENT_LINES]
+    if unknown:
+        raise ValueError(f"No emission lines known for {unknown}, must be in {list(ELEMENT_LINES.keys())}!")
+    energy = np.asarray(energy, dtype=float)
+    bin_width = np.gradient(energy)
+    columns, names = [], []
+    for el in elements:
+        lines = ELEMENT_LINES[el]
+        total = sum(intensity for _, intensity in lines)
+        columns.append(sum(intensity / total * _gaussian(energy, e, detector_sigma(e, noise, fano)) for e, intensity in lines))
+        names.append(el)
+    if incident_energy is not None:
+        columns.append(_gaussian(energy, incident_energy, detector_sigma(incident_energy, noise, fano)))
+        names.append("elastic")
+    columns = [c * bin_width for c in columns]
+    if background is not None:
+        columns.append(np.asarray(background, dtype=float) / max(np.sum(background), 1e-12))
+        names.append("background")
+    return np.column_stack(columns), names
+
+
+def _solve_passive(gram: np.ndarray, projections: np.ndarray, passive: np.ndarray) -> np.ndarray:
+    """Unconstrained least squares restricted to the passive (free) components of each pixel. Pixels sharing a passive set are solved together with one factorization, pixels with rare passive sets are solved as one stack of masked systems."""
+    z = np.zeros(passive.shape)
+    codes = np.ascontiguousarray(np.packbits(passive, axis=0).T)
+    codes = codes.view(np.dtype((np.void, codes.shape[1]))).ravel()  # one hashable key per pixel
+    _, first, group, counts = np.unique(codes, return_index=True, return_inverse=True, return_counts=True)
+    group = group.ravel()
+    order = np.argsort(group, kind="stable")  # pixels of each passive set are contiguous in order
+    starts = np.cumsum(counts) - counts
+    for g in np.flatnonzero((counts >= SHARED_PASSIVE_SET) & passive[:, first].any(axis=0)):
+        cols = order[starts[g] : starts[g] + counts[g]]
+        free = np.flatnonzero(passive[:, first[g]])
+        z[free[:, None], cols] = np.linalg.solve(gram[free[:, None], free], projections[free[:, None], cols])
+
+    rare = np.flatnonzero(counts[group] < SHARED_PASSIVE_SET)
+    identity = np.eye(len(gram))
+    for start in range(0, len(rare), NNLS_STACK):
+        cols = rare[start : start + NNLS_STACK]
+        free = passive[:, cols].T
+        systems = np.where(free[:, :, None] & free[:, None, :], gram, identity)  # fixed components solve to 0
+        rhs = np.where(free, projections[:, cols].T, 0.0)
+        z[:, cols] = np.linalg.solve(systems, rhs[:, :, None])[:, :, 0].T
+    return z
+
+
+def nnls(gram: np.ndarray, projections: np.ndarray, iterations: int = NNLS_ITERATIONS, tolerance: float = NNLS_TOLERANCE) -> np.ndarray:
+    """Solves min |A x - y|^2 subject to x >= 0 for many y at once, from the normal equations. This is the Lawson-Hanson active set method run on all pixels together (fast combinatorial NNLS): pixels that share a set of free components are solved with one factorization, and only pixels that are not yet optimal are updated.
+
+    Args:
+        gram (np.ndarray): A^T A, components by components
+        projections (np.ndarray): A^T y, components by pixels
+        iterations (int, optional): maximum number of active set changes. Defaults to NNLS_ITERATIONS.
+        tolerance (float, optional): a pixel is optimal once no fixed (zero) component could reduce the residual by more than this fraction of its largest projection. Defaults to NNLS_TOLERANCE.
+
+    Returns:
+        np.ndarray: non-negative amplitudes, components by pixels
+    """
+    projections = np.asarray(projections, dtype=float)
+    usable = np.diag(gram) > NNLS_MIN_WEIGHT * np.diag(gram).max()
+    if not usable.all():  # components with (almost) no counts in the fitted energy range stay 0
+        x = np.zeros(projections.shape)
+        x[usable] = nnls(gram[np.ix_(usable, usable)], projections[usable], iterations, tolerance)
+        return x
+    threshold = tolerance * np.maximum(np.abs(projections).max(axis=0), 1e-12)
+
+    def feasible(cols, x, passive):
+        """Solves on the passive sets of cols, backtracking from x while the solution has negative amplitudes"""
+        z = _solve_passive(gram, projections[:, cols], passive)
+        pending = np.flatnonzero((passive & (z <= 0)).any(axis=0))
+        for _ in range(iterations):
+            if len(pending) == 0:
+                break
+            xi, zi = x[:, pending], z[:, pending]
+            negative = passive[:, pending] & (zi <= 0)
+            step = np.where(negative, xi / np.where(negative, xi - zi, 1.0), np.inf).min(axis=0)  # longest step that keeps x >= 0
+            xi = xi + step * (zi - xi)
+            passive[:, pending] &= xi > 0
+            x[:, pending] = np.where(passive[:, pending], xi, 0.0)
+            z[:, pending] = _solve_passive(gram, projections[:, cols[pending]], passive[:, pending])
+            pending = pending[(passive[:, pending] & (z[:, pending] <= 0)).any(axis=0)]
+        return z, passive
+
+    x = np.linalg.solve(gram, projections)
+    passive = x > 0
+    for _ in range(NNLS_WARM_START):  # dropping every negative component at once quickly gets close to the final passive sets
+        x = _solve_passive(gram, projections, passive)
+        if not (passive & (x <= 0)).any():
+            break
+        passive &= x > 0
+    x = np.where(passive, np.clip(x, 0, None), 0.0)  # feasible starting point
+    passive = x > 0
+    everything = np.arange(x.shape[1])
+    x, passive = feasible(everything, x, passive)
+    gradient = projections - gram @ x
+    for _ in range(iterations):
+        candidates = ~passive & (gradient > threshold)
+        cols = np.flatnonzero(candidates.any(axis=0))  # pixels that are not optimal yet
+        if len(cols) == 0:
+            break
+        best = np.argmax(np.where(candidates[:, cols], gradient[:, cols], -np.inf), axis=0)
+        sub_passive = passive[:, cols]
+        sub_passive[best, np.arange(len(cols))] = True  # free the component that reduces the residual fastest
+        x[:, cols], passive[:, cols] = feasible(cols, x[:, cols], sub_passive)
+        gradient[:, cols] = projections[:, cols] - gram @ x[:, cols]
+    return x
+
+
+def snip_background(spectra: np.ndarray, width: int) -> np.ndarray:
+    """Smooth background under the peaks of spectra, by statistics-sensitive non-linear iterative peak clipping (SNIP) on log-log-sqrt scaled counts. Needs good counting statistics, eg a summed spectrum.
+
+    Args:
+        spectra (np.ndarray): counts, energy first
+        width (int): widest clipping window, in bins. Should be a few times the peak FWHM.
+
+    Returns:
+        np.ndarray: background counts, same shape as spectra
+    """
+    v = np.log(np.log(np.sqrt(np.clip(spectra, 0, None) + 1) + 1) + 1)
+    for p in range(1, width + 1):
+        v[p:-p] = np.minimum(v[p:-p], (v[: -2 * p] + v[2 * p :]) / 2)
+    return (np.exp(np.exp(v) - 1) - 1) ** 2 - 1
+
+
+def _bin_energy(spectra: np.ndarray, factor: int) -> np.ndarray:
+    """Sums groups of factor neighbouring bins along the first axis, dropping leftover bins"""
+    n = spectra.shape[0] // factor * factor
+    return spectra[:n].reshape((n // factor, factor) + spectra.shape[1:]).sum(axis=1)
+
+
+def fit_spectra(
+    spectra: np.ndarray,
+    energy: np.ndarray,
+    elements: list,
+    emin: float = 1.0,
+    emax: float = None,
+    bin_factor: int = 1,
+    incident_energy: float = None,
+    background: bool = True,
+) -> dict:
+    """Fits element amplitudes to every spectrum of a map, see fit_scan
+
+    Args:
+        spectra (np.ndarray): spectra, (y by) x by energy, eg "spectra" from load_h5
+        energy (np.ndarray): bin energies, in keV
+        elements (list): element symbols, keys of ELEMENT_LINES
+        emin (float, optional): lowest energy fitted, in keV. Defaults to 1.0.
+        emax (float, optional): highest energy fitted, in keV. Defaults to None (just below the elastic peak if incident_energy is given, otherwise the end of the spectrum).
+        bin_factor (int, optional): sums this many neighbouring energy bins before fitting, which speeds up the fit at the cost of energy resolution. Defaults to 1.
+        incident_energy (float, optional): beam energy in keV, fits an elastic peak. Defaults to None.
+        background (bool, optional): whether to fit a smooth background, with the shape of the background of the summed spectrum. Defaults to True.
+
+    Returns:
+        dict: "maps" of counts per element ("elastic" and "background" if fitted), each shaped like the spectra without the energy axis, "rss" (residual sum of squares per pixel), and the binned "energy"
+    """
+    spectra = np.asarray(spectra)
+    flat = np.moveaxis(spectra, -1, 0).reshape(spectra.shape[-1], -1)
+    summed = flat.sum(axis=1, dtype=float) if background else None
+    fitter = _Fitter(energy, elements, emin, emax, bin_factor, incident_energy, summed)
+    amplitudes, rss = fitter.fit(flat)
+    shape = spectra.shape[:-1]
+    return fitter.output(amplitudes.reshape((-1,) + shape), rss.reshape(shape))
+
+
+class _Fitter:
+    """Design matrix and normal equations for one energy axis, shared by every block of pixels"""
+
+    def __init__(self, energy, elements, emin, emax, bin_factor, incident_energy, summed_spectrum=None):
+        energy = np.asarray(energy, dtype=float)
+        if emax is None:
+            emax = energy[-1] if incident_energy is None else incident_energy + 1.0  # keep the whole elastic peak
+        self.bin_factor = bin_factor
+        self.window = slice(np.searchsorted(energy, emin), np.searchsorted(energy, emax, side="right"))
+        self.energy = _bin_energy(energy[self.window], bin_factor) / bin_factor  # mean energy of each bin group
+        background = None
+        if summed_spectrum is not None:
+            summed = _bin_energy(np.asarray(summed_spectrum[self.window], dtype=float), bin_factor)
+            background = snip_background(summed, int(round(BACKGROUND_WIDTH / np.median(np.diff(self.energy)))))
+        self.matrix, self.names = design_matrix(self.energy, elements, incident_energy, background)
+        self.gram = self.matrix.T @ self.matrix
+
+    def fit(self, spectra: np.ndarray) -> tuple:
+        """(amplitudes, residual sum of squares) of spectra shaped energy by pixels"""
+        y = _bin_energy(np.asarray(spectra[self.window], dtype=float), self.bin_factor)
+        projections = self.matrix.T @ y
+        x = nnls(self.gram, projections)
+        rss = (y**2).sum(axis=0) - 2 * (x * projections).sum(axis=0) + (x * (self.gram @ x)).sum(axis=0)
+        return x, np.maximum(rss, 0)
+
+    def output(self, amplitudes: np.ndarray, rss: np.ndarray) -> dict:
+        return {"maps": dict(zip(self.names, amplitudes)), "rss": rss, "energy": self.energy}
+
+
+def fit_scan(
+    scan_number: int,
+    elements: list,
+    emin: float = 1.0,
+    emax: float = None,
+    bin_factor: int = 4,
+    incident_energy: float = None,
+    background: bool = True,
+    clip_flyscan: bool = True,
+) -> dict:
+    """Quick-look element maps from the raw spectra of a scan, without waiting for MAPS. Spectra are read and fitted a few rows at a time. Amplitudes are raw counts in each element's lines, not normalized to the incident flux or quantified.
+
+    Args:
+        scan_number (int): scan to fit
+        elements (list): element symbols, keys of ELEMENT_LINES
+        emin (float, optional): lowest energy fitted, in keV. Defaults to 1.0.
+        emax (float, optional): highest energy fitted, in keV. Defaults to None, see fit_spectra.
+        bin_factor (int, optional): sums this many neighbouring energy bins before fitting. Defaults to 4, which keeps several bins per peak FWHM.
+        incident_energy (float, optional): beam energy in keV, fits an elastic peak. Defaults to None.
+        background (bool, optional): whether to fit a smooth background, with the shape of the background of the scan's integrated spectrum. Defaults to True.
+        clip_flyscan (bool, optional): removes the last two columns of the maps, like load_h5. Defaults to True.
+
+    Returns:
+        dict: "maps" (y by x) of counts per element, "elastic" and "background" if fitted, "rss" (residual sum of squares per pixel), binned "energy", and "x", "y" axes like load_h5
+    """
+    xmask = slice(0, -2) if clip_flyscan else slice(0, None)
+    with h5py.File(get_h5_filepath(scan_number), "r") as dat:
+        x_axis = dat["MAPS"]["x_axis"][()]
+        y_axis = dat["MAPS"]["y_axis"][()]
+        nbins, ny, nx = dat["MAPS"]["mca_arr"].shape
+        energy = dat["MAPS"]["energy"][:nbins]
+        summed = dat["MAPS"]["int_spec"][:nbins] if background else None
+    fitter = _Fitter(energy, elements, emin, emax, bin_factor, incident_energy, summed)
+
+    amplitudes = np.zeros((len(fitter.names), ny, nx))
+    rss = np.zeros((ny, nx))
+    for y0, block in iter_mca_rows(scan_number, FIT_ROWS):
+        rows = block.shape[1]
+        x, r = fitter.fit(block.reshape(nbins, -1))
+        amplitudes[:, y0 : y0 + rows] = x.reshape(-1, rows, nx)
+        rss[y0 : y0 + rows] = r.reshape(rows, nx)
+
+    output = fitter.output(amplitudes[:, :, xmask], rss[:, xmask])
+    output["x"] = x_axis
+    output["y"] = y_axis
+    return output
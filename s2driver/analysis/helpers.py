@@ -26,7 +26,7 @@ def recursively_load_dict_contents_from_group(h5file, path) -> dict:
     ans = {}
     for key, item in h5file[path].items():
         if isinstance(item, h5py._hl.dataset.Dataset):
-            ans[key] = item.value
+            ans[key] = item[()]
         elif isinstance(item, h5py._hl.group.Group):
             ans[key] = recursively_load_dict_contents_from_group(
                 h5file, path + key + "/"
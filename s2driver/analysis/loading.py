@@ -2,9 +2,85 @@ import h5py
 import numpy as np
 from s2driver.logging import get_experiment_dir
 from s2driver.driving import PVS
+from s2driver.scanindex import load_scan_metadata
 import os
 
 
+def get_h5_filepath(scan_number: int) -> str:
+    """Path to the MAPS-generated .h5 file of a scan"""
+    return os.path.join(
+        get_experiment_dir(),
+        "img.dat",
+        f"2idd_{scan_number:04d}.h5",
+    )
+
+
+def get_xeol_filepath(scan_number: int) -> str:
+    """Path to the XEOL .h5 file of a scan"""
+    return os.path.join(
+        get_experiment_dir(),
+        "XEOL",
+        f"2idd_{scan_number:04d}_XEOL.h5",
+    )
+
+
+def _unserpentine(arr) -> np.ndarray:
+    """Flips the odd lines (second to last axis) of a serpentine scan, whose points (last axis) were acquired in reverse"""
+    arr = np.array(arr)
+    arr[..., 1::2, :] = arr[..., 1::2, ::-1]
+    return arr
+
+
+def iter_mca_rows(scan_number: int, rows: int):
+    """Reads the raw spectra of a MAPS file a few map rows at a time, so they never have to fit in memory. Lines of serpentine scans are flipped back like load_h5 does.
+
+    Args:
+        scan_number (int): scan to read
+        rows (int): map rows per block
+
+    Yields:
+        tuple: (first row of the block, spectra as energy by rows by x)
+    """
+    serpentine = load_scan_metadata(scan_number).get("serpentine", False)
+    with h5py.File(get_h5_filepath(scan_number), "r") as dat:
+        mca = dat["MAPS"]["mca_arr"]  # energy by y by x
+        for y0 in range(0, mca.shape[1], rows):
+            block = mca[:, y0 : y0 + rows]
+            if serpentine:
+                odd = (y0 + np.arange(block.shape[1])) % 2 == 1
+                block[:, odd] = block[:, odd, ::-1]
+            yield y0, block
+
+
+def _xeol_cps(counts_raw: np.ndarray, bg: np.ndarray, dwelltime: np.ndarray) -> np.ndarray:
+    """Background-subtracted counts per second, NaN at points an aborted 2d scan never reached (saved with zero dwelltime)"""
+    measured = dwelltime > 0
+    cps = np.full(counts_raw.shape, np.nan)
+    cps[measured] = (counts_raw[measured] - bg) / dwelltime[measured][:, np.newaxis]
+    return cps
+
+
+def iter_xeol_rows(scan_number: int, rows: int):
+    """Reads the background-subtracted XEOL spectra of a scan a few map rows at a time, in counts per second like load_xeol (NaN where nothing was measured). 1d scans are read as a single row.
+
+    Args:
+        scan_number (int): scan to read
+        rows (int): map rows per block
+
+    Yields:
+        tuple: (first row of the block, spectra as rows by x by wavelength)
+    """
+    with h5py.File(get_xeol_filepath(scan_number), "r") as dat:
+        spectra = dat["spectra"]
+        bg = dat["background"][()]
+        dwelltime = dat["dwelltime"][()]
+        if spectra.ndim == 2:  # 1d scan
+            yield 0, _xeol_cps(spectra[()], bg, dwelltime)[np.newaxis]
+            return
+        for y0 in range(0, spectra.shape[0], rows):
+            yield y0, _xeol_cps(spectra[y0 : y0 + rows], bg, dwelltime[y0 : y0 + rows])
+
+
 def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us_ic"):
     """
     Loads a MAPS-generated .h5 file (raw + fitted data from 2IDD, fitted from 26IDC)
@@ -14,13 +90,13 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
     xbic_on_dsic: boolean. if True, considers the downstream ion chamber to be connected in an XBIC setup, adds to output['maps']['XBIC']
     quant_scaler: one of ['sr_current', 'us_ic', 'ds_ic']. quantification is normalized to some metric of beam power deposited in sample. typically we use upstream ion chamber
 
-    returns a dictionary with scan info and maps.
+    returns a dictionary with scan info and maps. lines of serpentine scans are flipped back so every line is oriented like the first one.
     """
-    fpath = os.path.join(
-        get_experiment_dir(),
-        "img.dat",
-        f"2idd_{scan_number:04d}.h5",
-    )
+    fpath = get_h5_filepath(scan_number)
+    if load_scan_metadata(scan_number).get("serpentine", False):
+        orient = _unserpentine
+    else:
+        orient = np.asarray
     quant_scaler_key = {
         "sr_current": 0,  # storage ring current
         "us_ic": 1,  # upstream ion chamber (incident flux)
@@ -40,7 +116,7 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
     with h5py.File(fpath, "r") as dat:
         output["x"] = dat["MAPS"]["x_axis"][()]
         output["y"] = dat["MAPS"]["y_axis"][()]
-        output["spectra"] = np.moveaxis(dat["MAPS"]["mca_arr"][()], 0, 2)[
+        output["spectra"] = np.moveaxis(orient(dat["MAPS"]["mca_arr"][()]), 0, 2)[
             :, xmask
         ]  # y by x by energy, full XRF spectra
         output["energy"] = dat["MAPS"]["energy"][
@@ -58,7 +134,7 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
 
         scaler_names = dat["MAPS"]["scaler_names"][()].astype("U13").tolist()
         quant_scaler_values = np.array(
-            dat["MAPS"]["scalers"][scaler_names.index(quant_scaler)]
+            orient(dat["MAPS"]["scalers"][scaler_names.index(quant_scaler)][()])
         )[:, xmask]
         fillval = np.nanmean(quant_scaler_values[quant_scaler_values > 0])
         quant_scaler_values = np.where(
@@ -68,7 +144,7 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
         )  # change all values that are 0.0 to mean, avoid divide by 0
         if "/MAPS/XRF_fits" in dat:
             xrf = []
-            raw = dat["MAPS"]["XRF_fits"][
+            raw = orient(dat["MAPS"]["XRF_fits"][()])[
                 :, :, xmask
             ]  # xrf elemental maps, elements by y by x
             quant = np.moveaxis(
@@ -85,7 +161,7 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
                 # update 20221228: this factor changes from run to run, but is always a round number (have seen 1, 4, and 10). I expect it could be related to usic amplifier settings or similar, but cant find a related value in the h5 file REK
             output["fitted"] = True
         else:
-            xrf = dat["MAPS"]["XRF_roi"][:, :, xmask]
+            xrf = orient(dat["MAPS"]["XRF_roi"][()])[:, :, xmask]
             output["fitted"] = False
 
         allchan = dat["MAPS"]["channel_names"][()].astype("U13").tolist()
@@ -94,23 +170,20 @@ def load_h5(scan_number, clip_flyscan=True, xbic_on_dsic=False, quant_scaler="us
         for channel, xrf_ in zip(allchan, xrf):
             output["maps"][channel] = np.array(xrf_)
         if xbic_on_dsic:
-            output["maps"]["xbic"] = dat["MAPS"]["scalers"][scaler_names.index("ds_ic")][:, xmask]
+            output["maps"]["xbic"] = orient(dat["MAPS"]["scalers"][scaler_names.index("ds_ic")][()])[:, xmask]
     return output
 
 
 def load_xeol(scan_number, wlmin=None, wlmax=None):
-    fpath = os.path.join(
-        get_experiment_dir(),
-        "XEOL",
-        f"2idd_{scan_number:04d}_XEOL.h5",
-    )
+    fpath = get_xeol_filepath(scan_number)
     output = {}
     with h5py.File(fpath, "r") as dat:
         wl = dat["wavelength"][()]
         bg = dat["background"][()]
         counts_raw = dat["spectra"][()]
         dwelltime = dat["dwelltime"][()]
-        
+        stopped_early = bool(dat["stopped_early"][()]) if "stopped_early" in dat else False
+        serpentine = bool(dat["serpentine"][()]) if "serpentine" in dat else False
 
         if wlmin is None:
             wlmin = wl[0]
@@ -122,17 +195,14 @@ def load_xeol(scan_number, wlmin=None, wlmax=None):
             np.argmin(np.abs(wl-wlmax))
         )
 
+        measured = dwelltime > 0  # points an aborted 2d scan never reached are saved with zero dwelltime
+        cps = _xeol_cps(counts_raw, bg, dwelltime)  # counts per second, NaN where nothing was measured
+        peak_cps_per_pixel = cps[..., roi].max(axis=-1)
+        peak_wl_per_pixel = np.where(measured, wl[roi][np.nan_to_num(cps[..., roi], nan=-np.inf).argmax(axis=-1)], np.nan)
+        avg = cps[measured].mean(axis=0)
         if len(counts_raw.shape) == 2: #1d scan
-            cps = (counts_raw - bg) / dwelltime[:,np.newaxis]  # counts per second
-            peak_cps_per_pixel = cps[:,roi].max(axis=1)
-            peak_wl_per_pixel = wl[roi][cps[:,roi].argmax(axis=1)]
-            avg = cps.mean(axis=0)
             pos = {'p1': dat["x"][()]}
         else:
-            cps = (counts_raw - bg) / dwelltime[:,:,np.newaxis]  # counts per second
-            peak_cps_per_pixel = cps[:,:,roi].max(axis=2)
-            peak_wl_per_pixel = wl[roi][cps[:,:,roi].argmax(axis=2)]
-            avg = cps.mean(axis=(0,1))
             pos = {'p1': dat["x"][()], 'p2': dat["y"][()]}
     
     output = {
@@ -148,7 +218,78 @@ def load_xeol(scan_number, wlmin=None, wlmax=None):
             "wlmin": wlmin,
             "wlmax": wlmax
         },
-        "positions": pos
+        "positions": pos,
+        "stopped_early": stopped_early,  # scan was aborted before all points were measured, eg by a stopping rule
+        "serpentine": serpentine,  # odd lines were acquired in reverse. already stored in the same orientation as the first line
     }
 
     return output
+
+
+def _fill_grid(values, iy, ix, shape) -> np.ndarray:
+    """Places per-point values (points along the first axis) on a grid of shape, NaN where nothing was measured"""
+    values = np.asarray(values, dtype=float)
+    grid = np.full(tuple(shape) + values.shape[1:], np.nan)
+    grid[iy[: len(values)], ix[: len(values)]] = values
+    return grid
+
+
+def load_masked_scan(scan_number, xeol=False, wlmin=None, wlmax=None):
+    """
+    Loads a masked_scan2d back onto its full grid. Pixels outside the mask (or not reached, if the scan was aborted) are NaN.
+
+    scan_number: first scan of the masked scan, as returned in its "scan_numbers"
+    xeol: boolean. if True, also loads the XEOL data of every segment into output['xeol']
+    wlmin, wlmax: XEOL wavelength range to find peaks in, see load_xeol
+
+    returns a dictionary with the grid axes, mask, and XRF maps/spectra (y by x [by energy]) like load_h5.
+    """
+    metadata = load_scan_metadata(scan_number).get("masked_scan2d")
+    if metadata is None:
+        raise ValueError(f"Scan {scan_number} is not the first scan of a masked_scan2d!")
+    iy = np.asarray(metadata["iy"])
+    ix = np.asarray(metadata["ix"])
+    shape = (len(metadata["y_axis"]), len(metadata["x_axis"]))
+
+    maps = {}
+    spectra = []
+    for n in np.atleast_1d(metadata["scan_numbers"]):
+        npts = load_scan_metadata(int(n))["npts_completed"]
+        segment = load_h5(int(n), clip_flyscan=False)
+        for channel, m in segment["maps"].items():
+            maps.setdefault(channel, []).append(np.ravel(m)[:npts])
+        spectra.append(segment["spectra"].reshape(-1, segment["spectra"].shape[-1])[:npts])
+
+    output = {
+        "x": metadata["x_axis"],
+        "y": metadata["y_axis"],
+        "mask": np.asarray(metadata["mask"]).astype(bool),
+        "extent": [
+            metadata["x_axis"][0],
+            metadata["x_axis"][-1],
+            metadata["y_axis"][0],
+            metadata["y_axis"][-1],
+        ],
+        "energy": segment["energy"],
+        "fitted": segment["fitted"],
+        "spectra": _fill_grid(np.concatenate(spectra), iy, ix, shape),
+        "maps": {
+            channel: _fill_grid(np.concatenate(m), iy, ix, shape)
+            for channel, m in maps.items()
+        },
+        "scan_numbers": np.atleast_1d(metadata["scan_numbers"]),
+    }
+
+    if xeol:
+        segments = [
+            load_xeol(int(n), wlmin=wlmin, wlmax=wlmax)
+            for n in output["scan_numbers"]
+        ]
+        output["xeol"] = {
+            "wavelength": segments[0]["wavelength"],
+            **{
+                key: _fill_grid(np.concatenate([s[key] for s in segments]), iy, ix, shape)
+                for key in ["cps", "peak_cps_per_pixel", "peak_wl_per_pixel"]
+            },
+        }
+    return output
@@ -0,0 +1,134 @@
+import os
+import time
+import h5py
+import numpy as np
+from s2driver.logging import get_experiment_dir
+from s2driver.scanindex import load_scan_metadata
+from s2driver.analysis.loading import load_h5, load_xeol, get_h5_filepath, get_xeol_filepath
+
+### Mosaic stitching
+# Tiles are accumulated one at a time into chunked datasets on disk, so a mosaic never has to fit in memory. Overlapping pixels are blended with weights that fall off linearly towards each tile's edges, which hides seams from drifts in flux or focus between tiles.
+
+NORMALIZE_ROWS = 64  # rows of the mosaic normalized at once in the final pass
+TILE_FILE_TIMEOUT = 600  # seconds to wait for a tile's MAPS/XEOL file, which may still be processing when stitching starts
+
+
+def get_mosaic_filepath(scan_number: int) -> str:
+    """Path to the stitched mosaic .h5 file of a mosaic_scan, named after its first tile"""
+    return os.path.join(
+        get_experiment_dir(),
+        "mosaic",
+        f"2idd_{scan_number:04d}_mosaic.h5",
+    )
+
+
+def _wait_for_file(fpath: str, timeout: float):
+    t0 = time.time()
+    while not os.path.exists(fpath):
+        if time.time() - t0 > timeout:
+            raise TimeoutError(f"Gave up waiting for {fpath} after {timeout} s!")
+        time.sleep(1)
+    time.sleep(3)  # wait for file to be completely written to disk
+
+
+def _feather(numy: int, numx: int) -> np.ndarray:
+    """Blending weights of a tile: 1 at the edges, rising linearly to the center"""
+    wy = np.minimum(np.arange(numy) + 1, numy - np.arange(numy))
+    wx = np.minimum(np.arange(numx) + 1, numx - np.arange(numx))
+    return np.minimum.outer(wy, wx).astype(float)
+
+
+def _accumulate(dat: h5py.File, name: str, region: tuple, values: np.ndarray, weights: np.ndarray, shape: tuple):
+    """Adds weighted tile values to a dataset of the mosaic, and the weights to its "weights/<name>", creating both on first use. Pixels with any non-finite value get zero weight, so they do not dilute other tiles in overlaps."""
+    values = np.asarray(values, dtype=float)
+    measured = np.isfinite(values).reshape(values.shape[:2] + (-1,)).all(axis=2)
+    weights = weights * measured
+    if name not in dat:
+        full_shape = tuple(shape) + values.shape[2:]
+        chunks = (min(shape[0], values.shape[0]), min(shape[1], values.shape[1])) + values.shape[2:]
+        dat.create_dataset(name, shape=full_shape, dtype=float, chunks=chunks, fillvalue=0.0)
+        dat.create_dataset(f"weights/{name}", shape=shape, dtype=float, chunks=chunks[:2], fillvalue=0.0)
+    w = weights.reshape(weights.shape + (1,) * (values.ndim - 2))
+    dat[name][region] += w * np.nan_to_num(values)
+    dat[f"weights/{name}"][region] += weights
+
+
+def stitch_mosaic(
+    scan_number: int,
+    output_filepath: str = None,
+    xeol: bool = False,
+    spectra: bool = False,
+    wlmin: float = None,
+    wlmax: float = None,
+    timeout: float = TILE_FILE_TIMEOUT,
+) -> str:
+    """Stitches the tiles of a mosaic_scan into one .h5 file. Tiles are loaded one at a time, so the mosaic can be much larger than memory.
+
+    The output holds "x" and "y" axes, "maps/<channel>" (y by x) for every XRF channel, "spectra" (y by x by energy) and "energy" if spectra is True, "xeol/peak_cps" and "xeol/peak_wl" if xeol is True, "weight" (total blending weight, 0 where no tile measured), "weights/<dataset>" (blending weight of each dataset, 0 where its tile values were NaN), and the tile "scan_numbers".
+
+    Args:
+        scan_number (int): first scan of the mosaic, as returned in its "scan_numbers"
+        output_filepath (str, optional): where to write the mosaic. Defaults to None (get_mosaic_filepath).
+        xeol (bool, optional): whether to stitch XEOL peak maps, for mosaics of scan2d_xeol tiles. Defaults to False.
+        spectra (bool, optional): whether to stitch the full XRF spectra too. Defaults to False.
+        wlmin (float, optional): XEOL wavelength range to find peaks in, see load_xeol. Defaults to None.
+        wlmax (float, optional): XEOL wavelength range to find peaks in, see load_xeol. Defaults to None.
+        timeout (float, optional): seconds to wait for each tile's output file to appear. Defaults to TILE_FILE_TIMEOUT.
+
+    Raises:
+        ValueError: scan_number is not the first scan of a mosaic_scan
+
+    Returns:
+        str: path to the stitched mosaic
+    """
+    plan = load_scan_metadata(scan_number).get("mosaic")
+    if plan is None:
+        raise ValueError(f"Scan {scan_number} is not the first scan of a mosaic_scan!")
+    output_filepath = output_filepath or get_mosaic_filepath(scan_number)
+    os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+    tiles = plan["tiles"]
+    scan_numbers = np.atleast_1d(plan["scan_numbers"])
+    shape = (len(plan["y"]), len(plan["x"]))
+
+    with h5py.File(output_filepath, "w") as dat:
+        dat["x"] = plan["x"]
+        dat["y"] = plan["y"]
+        dat["scan_numbers"] = scan_numbers
+        dat.create_dataset("weight", shape=shape, dtype=float, fillvalue=0.0)
+
+        for k, n in enumerate(scan_numbers):
+            n = int(n)
+            _wait_for_file(get_h5_filepath(n), timeout)
+            tile = load_h5(n, clip_flyscan=plan["scantype"] == "flyscan2d")
+            numy = min(int(tiles["numy"][k]), tile["spectra"].shape[0])
+            numx = min(int(tiles["numx"][k]), tile["spectra"].shape[1])
+            iy0, ix0 = int(tiles["iy0"][k]), int(tiles["ix0"][k])
+            region = np.s_[iy0 : iy0 + numy, ix0 : ix0 + numx]
+            weights = _feather(numy, numx)
+
+            for channel, m in tile["maps"].items():
+                _accumulate(dat, f"maps/{channel}", region, m[:numy, :numx], weights, shape)
+            if spectra:
+                if "energy" not in dat:
+                    dat["energy"] = tile["energy"]
+                _accumulate(dat, "spectra", region, tile["spectra"][:numy, :numx], weights, shape)
+            del tile
+            if xeol:
+                _wait_for_file(get_xeol_filepath(n), timeout)
+                tile = load_xeol(n, wlmin=wlmin, wlmax=wlmax)
+                _accumulate(dat, "xeol/peak_cps", region, tile["peak_cps_per_pixel"][:numy, :numx], weights, shape)
+                _accumulate(dat, "xeol/peak_wl", region, tile["peak_wl_per_pixel"][:numy, :numx], weights, shape)
+                del tile
+            dat["weight"][region] += weights
+
+        names = [f"{group}/{name}" for group in ["maps", "xeol"] if group in dat for name in dat[group]]
+        if spectra:
+            names.append("spectra")
+        for y0 in range(0, shape[0], NORMALIZE_ROWS):
+            rows = np.s_[y0 : y0 + NORMALIZE_ROWS]
+            for name in names:
+                w = dat[f"weights/{name}"][rows]
+                w = np.where(w > 0, w, np.nan)  # unmeasured pixels become NaN
+                block = dat[name][rows]
+                dat[name][rows] = block / w.reshape(w.shape + (1,) * (block.ndim - 2))
+    return output_filepath
@@ -0,0 +1,212 @@
+import numpy as np
+from s2driver.analysis.loading import load_xeol
+
+### Peak fitting
+# Fits one peak to every pixel's spectrum at once. Levenberg-Marquardt runs on all pixels together: residuals, jacobians and the damped normal equations are arrays with a leading pixel axis, and each pixel keeps its own damping. Pixels drop out once they converge, so a few slow pixels do not hold up the rest.
+
+PEAK_PROFILES = ["gaussian", "pseudovoigt"]
+PEAK_FIT_MEMORY = 256e6  # bytes of jacobians held in memory at once, pixels are fitted in blocks that fit
+LM_DAMPING = 1e-3  # initial Levenberg-Marquardt damping
+LM_DAMPING_FACTOR = 10.0  # damping is divided by this after a successful step, multiplied after a failed one
+MOMENT_SMOOTHING = 100  # spectra are smoothed over 1/this of their channels before taking moments for the initial guess
+FOUR_LN2 = 4 * np.log(2)
+
+
+def _profile(x: np.ndarray, params: np.ndarray, profile: str, jacobian: bool = True) -> tuple:
+    """Model and jacobian of a peak, for parameters (pixels by parameters) on channels x
+
+    Parameters are amplitude (peak height), center, fwhm and offset, and the lorentzian fraction eta for pseudo-voigt peaks. Returns the model (pixels by channels) and its jacobian (pixels by parameters by channels), or None if jacobian is False.
+    """
+    amplitude, center, fwhm, offset = (params[:, i, None] for i in range(4))
+    u = (x - center) / fwhm
+    u2 = u * u
+    gauss = np.exp(-FOUR_LN2 * u2)
+    if profile == "gaussian":
+        shape = gauss
+    else:
+        eta = params[:, 4, None]
+        lorentz = 1 / (1 + 4 * u2)
+        shape = (1 - eta) * gauss + eta * lorentz
+    model = amplitude * shape + offset
+    if not jacobian:
+        return model, None
+
+    if profile == "gaussian":
+        dshape_du = gauss * u
+        dshape_du *= -2 * FOUR_LN2
+    else:
+        dshape_du = u * ((-2 * FOUR_LN2) * (1 - eta) * gauss - 8 * eta * lorentz**2)
+    j = np.empty((len(params), params.shape[1], len(x)))
+    j[:, 0] = shape
+    np.multiply(dshape_du, -amplitude / fwhm, out=j[:, 1])  # du/dcenter = -1/fwhm
+    np.multiply(j[:, 1], u, out=j[:, 2])  # du/dfwhm = -u/fwhm
+    j[:, 3] = 1.0
+    if profile == "pseudovoigt":
+        j[:, 4] = amplitude * (lorentz - gauss)
+    return model, j
+
+
+def _constrain(params: np.ndarray, profile: str, x: np.ndarray) -> np.ndarray:
+    """Keeps peaks inside the fitted window, with widths between half a channel and twice the window"""
+    params[:, 1] = np.clip(params[:, 1], x[0], x[-1])
+    params[:, 2] = np.clip(np.abs(params[:, 2]), np.abs(x[1] - x[0]) / 2, 2 * np.ptp(x))
+    if profile == "pseudovoigt":
+        params[:, 4] = np.clip(params[:, 4], 0, 1)
+    return params
+
+
+def _moments(x: np.ndarray, y: np.ndarray, profile: str) -> np.ndarray:
+    """Initial parameters from the moments of each (smoothed) spectrum above half its maximum, which ignores the noise in the tails"""
+    width = max(1, len(x) // MOMENT_SMOOTHING)
+    padded = np.cumsum(np.pad(y, ((0, 0), (width // 2 + 1, width - width // 2 - 1)), mode="edge"), axis=1)
+    smoothed = (padded[:, width:] - padded[:, :-width]) / width  # moving average, same length as y
+    offset = np.percentile(smoothed, 10, axis=1)
+    signal = np.maximum(smoothed - offset[:, None], 0)
+    amplitude = signal.max(axis=1)
+    above = signal >= amplitude[:, None] / 2
+    weight = np.maximum((signal * above).sum(axis=1), 1e-12)
+    center = (signal * above * x).sum(axis=1) / weight
+    fwhm = above.sum(axis=1) * np.abs(np.median(np.diff(x)))
+    params = [amplitude, center, fwhm, offset]
+    if profile == "pseudovoigt":
+        params.append(np.full(len(y), 0.5))
+    return np.column_stack(params)
+
+
+def _levenberg_marquardt(x: np.ndarray, y: np.ndarray, params: np.ndarray, profile: str, max_iterations: int, tolerance: float) -> tuple:
+    """Fits params (pixels by parameters) to spectra y (pixels by channels). Returns the params, residual sum of squares and a converged flag per pixel. Pixels that stop because no step improves the fit any more are not flagged as converged."""
+    npix, nparams = params.shape
+    rss = ((y - _profile(x, params, profile, jacobian=False)[0]) ** 2).sum(axis=1)
+    damping = np.full(npix, LM_DAMPING)
+    converged = np.zeros(npix, dtype=bool)
+    active = np.arange(npix)
+    for _ in range(max_iterations):
+        if len(active) == 0:
+            break
+        model, j = _profile(x, params[active], profile)
+        r = y[active] - model
+        jtj = j @ j.transpose(0, 2, 1)
+        jtr = (j @ r[:, :, None])[:, :, 0]
+        diagonal = np.einsum("pkk->pk", jtj)
+        damped = jtj + (damping[active, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(nparams)
+        try:
+            step = np.linalg.solve(damped, jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:  # eg a pixel with no peak, whose center and width do not change the model
+            step = (np.linalg.pinv(damped) @ jtr[:, :, None])[:, :, 0]
+        trial = _constrain(params[active] + step, profile, x)
+        trial_rss = ((y[active] - _profile(x, trial, profile, jacobian=False)[0]) ** 2).sum(axis=1)
+
+        better = trial_rss < rss[active]
+        improved = active[better]
+        relative_change = (rss[improved] - trial_rss[better]) / np.maximum(rss[improved], 1e-12)
+        params[improved] = trial[better]
+        rss[improved] = trial_rss[better]
+        damping[improved] /= LM_DAMPING_FACTOR
+        damping[active[~better]] *= LM_DAMPING_FACTOR
+
+        done = np.zeros(len(active), dtype=bool)
+        done[better] = relative_change < tolerance
+        converged[active[done]] = True
+        done |= damping[active] > 1e10  # stuck, no step improves the fit any more
+        active = active[~done]
+    return params, rss, converged
+
+
+def fit_peaks(
+    x: np.ndarray,
+    spectra: np.ndarray,
+    profile: str = "gaussian",
+    xmin: float = None,
+    xmax: float = None,
+    max_iterations: int = 50,
+    tolerance: float = 1e-6,
+) -> dict:
+    """Fits a single peak (plus a constant offset) to every spectrum at once, by batched Levenberg-Marquardt initialized from moments
+
+    Args:
+        x (np.ndarray): channel positions, eg wavelengths
+        spectra (np.ndarray): spectra, any leading shape by channels, eg "cps" from load_xeol
+        profile (str, optional): one of PEAK_PROFILES. Pseudo-voigt peaks add a lorentzian fraction "eta". Defaults to "gaussian".
+        xmin (float, optional): lowest channel position fitted. Defaults to None (the first channel).
+        xmax (float, optional): highest channel position fitted. Defaults to None (the last channel).
+        max_iterations (int, optional): maximum Levenberg-Marquardt steps per pixel. Defaults to 50.
+        tolerance (float, optional): a pixel has converged once a step reduces its residual by less than this fraction. Defaults to 1e-6.
+
+    Raises:
+        ValueError: invalid profile, or fewer channels in the window than parameters
+
+    Returns:
+        dict: maps shaped like the leading axes of spectra: "amplitude" (peak height), "center", "fwhm", "offset", "eta" for pseudo-voigt peaks, and their standard errors "<name>_err", plus the peak "area", the "rss" and whether each pixel "converged". Pixels whose spectrum is not finite (eg unmeasured XEOL points) are not fitted, their maps are NaN and they are not converged.
+    """
+    if profile not in PEAK_PROFILES:
+        raise ValueError(f"Peak profile must be one of {PEAK_PROFILES}, not {profile}!")
+    x = np.asarray(x, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    window = slice(
+        np.searchsorted(x, x[0] if xmin is None else xmin),
+        np.searchsorted(x, x[-1] if xmax is None else xmax, side="right"),
+    )
+    x = x[window]
+    names = ["amplitude", "center", "fwhm", "offset"] + (["eta"] if profile == "pseudovoigt" else [])
+    if len(x) <= len(names):
+        raise ValueError(f"Need more than {len(names)} channels to fit a {profile} peak, got {len(x)}!")
+    shape = spectra.shape[:-1]
+    y = spectra[..., window].reshape(-1, len(x))
+    measured = np.flatnonzero(np.isfinite(y).all(axis=1))
+
+    params = np.full((len(y), len(names)), np.nan)
+    errors = np.full((len(y), len(names)), np.nan)
+    rss = np.full(len(y), np.nan)
+    converged = np.zeros(len(y), dtype=bool)
+    block = max(1, int(PEAK_FIT_MEMORY // (8 * len(x) * (len(names) + 4))))  # a jacobian and a few spectra-sized temporaries per pixel
+    for start in range(0, len(measured), block):
+        pixels = measured[start : start + block]
+        p0 = _constrain(_moments(x, y[pixels], profile), profile, x)
+        p, r, c = _levenberg_marquardt(x, y[pixels], p0, profile, max_iterations, tolerance)
+        j = _profile(x, p, profile)[1]
+        jtj = j @ j.transpose(0, 2, 1)
+        covariance = np.linalg.pinv(jtj) * (r / (len(x) - len(names)))[:, None, None]  # scaled by the residual variance
+        params[pixels], rss[pixels], converged[pixels] = p, r, c
+        errors[pixels] = np.sqrt(np.maximum(np.einsum("pkk->pk", covariance), 0))
+
+    output = {}
+    for i, name in enumerate(names):
+        output[name] = params[:, i].reshape(shape)
+        output[f"{name}_err"] = errors[:, i].reshape(shape)
+    eta = output.get("eta", 0.0)
+    output["area"] = output["amplitude"] * output["fwhm"] * ((1 - eta) * np.sqrt(np.pi / FOUR_LN2) + eta * np.pi / 2)
+    output["rss"] = rss.reshape(shape)
+    output["converged"] = converged.reshape(shape)
+    return output
+
+
+def fit_xeol_peaks(
+    scan_number: int,
+    profile: str = "gaussian",
+    wlmin: float = None,
+    wlmax: float = None,
+    max_iterations: int = 50,
+) -> dict:
+    """Fits a peak to the XEOL spectrum of every point of a scan, see fit_peaks. A smooth alternative to the argmax "peak_cps_per_pixel" and "peak_wl_per_pixel" of load_xeol, not quantized to spectrometer pixels.
+
+    Args:
+        scan_number (int): scan to fit
+        profile (str, optional): one of PEAK_PROFILES. Defaults to "gaussian".
+        wlmin (float, optional): lowest wavelength fitted, in nm. Defaults to None (the whole spectrum).
+        wlmax (float, optional): highest wavelength fitted, in nm. Defaults to None (the whole spectrum).
+        max_iterations (int, optional): maximum Levenberg-Marquardt steps per point. Defaults to 50.
+
+    Returns:
+        dict: peak parameter maps (counts per second, nm) and their errors from fit_peaks, shaped like the scan, plus its "positions"
+    """
+    data = load_xeol(scan_number)
+    output = fit_peaks(
+        data["wavelength"],
+        data["cps"],
+        profile=profile,
+        xmin=wlmin,
+        xmax=wlmax,
+        max_iterations=max_iterations,
+    )
+    output["positions"] = data["positions"]
+    return output
@@ -0,0 +1,185 @@
+import numpy as np
+
+### Region of interest detection
+# Finds features on an overview map and turns them into scan specs for detail scans. Thresholding, labelling and per-region statistics are all vectorized over the whole map.
+
+ROI_METRICS = ["sum", "mean", "max", "area"]  # built-in ways to rank regions, see find_rois
+
+
+def otsu_threshold(image: np.ndarray, bins: int = 256) -> float:
+    """Threshold that best separates an image into two classes (Otsu's method), ignoring NaNs
+
+    Args:
+        image (np.ndarray): map to threshold
+        bins (int, optional): number of histogram bins. Defaults to 256.
+
+    Returns:
+        float: threshold value, pixels above it are foreground
+    """
+    values = image[np.isfinite(image)]
+    counts, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_below = np.cumsum(counts)
+    weight_above = weight_below[-1] - weight_below
+    sum_below = np.cumsum(counts * centers)
+    mean_below = np.divide(sum_below, weight_below, out=np.zeros_like(sum_below), where=weight_below > 0)
+    mean_above = np.divide(
+        sum_below[-1] - sum_below, weight_above, out=np.zeros_like(sum_below), where=weight_above > 0
+    )
+    between_variance = weight_below * weight_above * (mean_below - mean_above) ** 2
+    return centers[np.argmax(between_variance)]
+
+
+def label_components(mask: np.ndarray, connectivity: int = 8) -> np.ndarray:
+    """Labels connected regions of a boolean mask. Every pixel repeatedly takes the smallest label among its neighbours, with pointer jumping so labels spread across a region in a few passes.
+
+    Args:
+        mask (np.ndarray): 2d boolean mask
+        connectivity (int, optional): 4 (edges) or 8 (edges and corners). Defaults to 8.
+
+    Raises:
+        ValueError: invalid connectivity
+
+    Returns:
+        np.ndarray: int labels, same shape as mask. 0 is background, regions are numbered 1..n in raster order of their first pixel.
+    """
+    if connectivity not in (4, 8):
+        raise ValueError("Connectivity must be 4 or 8!")
+    mask = np.asarray(mask, dtype=bool)
+    ny, nx = mask.shape
+    background = mask.size  # larger than any pixel index
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), background)
+    offsets = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+    if connectivity == 8:
+        offsets += [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+    while True:
+        padded = np.pad(labels, 1, constant_values=background)
+        smallest = labels
+        for dy, dx in offsets:
+            smallest = np.minimum(smallest, padded[1 + dy : 1 + dy + ny, 1 + dx : 1 + dx + nx])
+        smallest = np.where(mask, smallest, background)
+        flat = np.append(smallest.ravel(), background)
+        while True:  # pointer jumping: follow labels to the smallest label they point to
+            jumped = flat[flat]
+            if np.array_equal(jumped, flat):
+                break
+            flat = jumped
+        smallest = flat[:-1].reshape(mask.shape)
+        if np.array_equal(smallest, labels):
+            break
+        labels = smallest
+
+    _, relabelled = np.unique(labels, return_inverse=True)  # background sorts last
+    relabelled = relabelled.reshape(mask.shape) + 1
+    relabelled[~mask] = 0
+    return relabelled
+
+
+def _overview_image(overview: dict, channel: str = None):
+    """(image, x axis, y axis) of an overview loaded with load_h5 (needs a channel) or load_xeol (peak counts)"""
+    if "maps" in overview:
+        if channel is None:
+            raise ValueError(f"Must choose a channel from {list(overview['maps'].keys())}!")
+        image = np.asarray(overview["maps"][channel], dtype=float)
+        x, y = np.asarray(overview["x"]), np.asarray(overview["y"])
+    else:
+        image = np.asarray(overview["peak_cps_per_pixel"], dtype=float)
+        x = np.asarray(overview["positions"]["p1"])
+        y = np.asarray(overview["positions"].get("p2", np.zeros((1, 1))))
+        x = x[0] if x.ndim == 2 else x
+        y = y[:, 0] if y.ndim == 2 else y
+    return image, x[: image.shape[1]], y[: image.shape[0]]
+
+
+def find_rois(
+    overview: dict,
+    channel: str = None,
+    threshold=None,
+    metric="sum",
+    min_area: int = 4,
+    margin: float = 1.0,
+    step: float = None,
+    max_rois: int = None,
+    connectivity: int = 8,
+) -> list:
+    """Finds features on an overview map and returns detail scan specs for them, best first
+
+    Args:
+        overview (dict): map loaded with s2driver.analysis.loading.load_h5 or load_xeol (2d scans)
+        channel (str, optional): XRF channel to segment, required for load_h5 overviews. Defaults to None.
+        threshold (float, optional): pixels above this value are features. Defaults to None (Otsu threshold).
+        metric (str or callable, optional): how to rank regions, one of ROI_METRICS or metric(values) -> float of the region's pixel values. Defaults to "sum".
+        min_area (int, optional): smallest region kept, in pixels. Defaults to 4.
+        margin (float, optional): added around each region's bounding box, in um. Defaults to 1.0.
+        step (float, optional): pixel size of the detail scans, in um. Defaults to None (the overview's pixel size).
+        max_rois (int, optional): return at most this many regions. Defaults to None (all).
+        connectivity (int, optional): 4 or 8, see label_components. Defaults to 8.
+
+    Raises:
+        ValueError: invalid metric, or no channel for an XRF overview
+
+    Returns:
+        list: one dict per region: "label", "area" (pixels), "score", "centroid" (x, y), "bbox" (xmin, xmax, ymin, ymax, including margin) and the scan spec "startpos1", "endpos1", "numpts1", "startpos2", "endpos2", "numpts2" in the overview's (absolute) coordinates, to use with absolute=True
+    """
+    if not callable(metric) and metric not in ROI_METRICS:
+        raise ValueError(f"Metric must be one of {ROI_METRICS} or a callable!")
+    image, x, y = _overview_image(overview, channel)
+    if threshold is None:
+        threshold = otsu_threshold(image)
+    finite = np.isfinite(image)
+    labels = label_components(finite & (np.where(finite, image, -np.inf) > threshold), connectivity)
+    n = labels.max()
+    if n == 0:
+        return []
+
+    iy, ix = np.nonzero(labels)
+    lab = labels[iy, ix] - 1
+    values = image[iy, ix]
+    area = np.bincount(lab, minlength=n)
+    total = np.bincount(lab, weights=values, minlength=n)
+    peak = np.full(n, -np.inf)
+    np.maximum.at(peak, lab, values)
+    xmin, xmax = np.full(n, np.inf), np.full(n, -np.inf)
+    ymin, ymax = np.full(n, np.inf), np.full(n, -np.inf)
+    np.minimum.at(xmin, lab, x[ix])
+    np.maximum.at(xmax, lab, x[ix])
+    np.minimum.at(ymin, lab, y[iy])
+    np.maximum.at(ymax, lab, y[iy])
+    cx = np.bincount(lab, weights=values * x[ix], minlength=n) / total
+    cy = np.bincount(lab, weights=values * y[iy], minlength=n) / total
+
+    if callable(metric):
+        order = np.argsort(lab, kind="stable")
+        splits = np.cumsum(area)[:-1]
+        score = np.array([metric(v) for v in np.split(values[order], splits)])
+    else:
+        score = {"sum": total, "mean": total / area, "max": peak, "area": area.astype(float)}[metric]
+
+    dx = np.abs(np.median(np.diff(x))) if len(x) > 1 else 1.0
+    dy = np.abs(np.median(np.diff(y))) if len(y) > 1 else 1.0
+    stepx = step or dx
+    stepy = step or dy
+    keep = np.flatnonzero(area >= min_area)
+    keep = keep[np.argsort(-score[keep])][:max_rois]
+
+    rois = []
+    for k in keep:
+        x0, x1 = xmin[k] - dx / 2 - margin, xmax[k] + dx / 2 + margin  # bbox covers whole pixels
+        y0, y1 = ymin[k] - dy / 2 - margin, ymax[k] + dy / 2 + margin
+        rois.append(
+            {
+                "label": int(k + 1),
+                "area": int(area[k]),
+                "score": float(score[k]),
+                "centroid": (float(cx[k]), float(cy[k])),
+                "bbox": (float(x0), float(x1), float(y0), float(y1)),
+                "startpos1": float(x0),
+                "endpos1": float(x1),
+                "numpts1": int(np.ceil((x1 - x0) / stepx)) + 1,
+                "startpos2": float(y0),
+                "endpos2": float(y1),
+                "numpts2": int(np.ceil((y1 - y0) / stepy)) + 1,
+            }
+        )
+    return rois
@@ -1,25 +1,161 @@
 import os
 import time
 import json
+import uuid
+import queue
+import logging
+from collections import deque, OrderedDict
+from functools import partial
+from threading import Thread
+from contextlib import contextmanager
+from concurrent.futures import Future
+import numpy as np
 
 from s2driver.closedloop.websocket import Client, Server
-from s2driver.analysis.loading import load_h5, load_xeol
+from s2driver.closedloop.encoding import encode_arrays, decode_arrays
+from s2driver.analysis.loading import (
+    load_h5,
+    load_xeol,
+    get_h5_filepath,
+    get_xeol_filepath,
+)
+from s2driver.analysis.fitting import fit_scan
+from s2driver.analysis.peaks import fit_xeol_peaks
 from s2driver.driving import *  # all driving commands, used by S2Server
+from s2driver.stopping import make_stopping_rule
+from s2driver.energy import EnergyAxis
+from s2driver.scanindex import load_scan_metadata, write_scan_metadata
 from s2driver.logging import initialize_logbook, get_experiment_dir
 
 logger = initialize_logbook()
 
+STREAMABLE_PRODUCTS = ["xrf", "xeol"]  # reduced results the S2Server can push to clients after a scan
+STREAM_FILE_TIMEOUT = 30  # seconds to wait for a scan's output file to appear before giving up on streaming it
+MIN_PROGRESS_INTERVAL = 0.2  # seconds, fastest progress update rate a subscriber can ask for
+TOPICS = ["completions", "progress", "logs"]  # S2Server publishes these to subscribed clients
+MAX_REQUEST_HISTORY = 1000  # beamline commands whose status the S2Server remembers, for clients that reattach after a disconnect
+_END_OF_BATCH = "_end_of_batch"  # queued after the commands of a batch, so the command worker can forget the batch
+
+
+class S2ServerError(Exception):
+    """Raised on the S2Client when a command failed on the S2Server"""
+
+
+class ProgressSubscription:
+    """Rate limits and coalesces the progress events sent to a subscriber. Scans report progress every few hundred ms - an event is only sent once the subscriber's interval has passed, and always carries the latest state, so intermediate updates are merged rather than queued."""
+
+    def __init__(
+        self,
+        interval: float = 1.0,
+        partial_data: bool = False,
+        detector_channels: list = None,
+    ):
+        """
+        Args:
+            interval (float, optional): minimum seconds between events. Clipped to MIN_PROGRESS_INTERVAL. Defaults to 1.0.
+            partial_data (bool, optional): whether to include rows of data completed since the previous event. Defaults to False.
+            detector_channels (list, optional): scan record detector channels (eg [1, 2] for D01, D02) to include in partial data. Defaults to None (XEOL only).
+        """
+        self.interval = max(interval, MIN_PROGRESS_INTERVAL)
+        self.partial_data = partial_data
+        self.detector_channels = detector_channels or []
+        self._last_sent = 0
+        self._last_state = None
+        self._rows_sent = 0
+
+    def is_due(self, progress: dict) -> bool:
+        """Whether an event should be sent for this progress update"""
+        state = (progress["scan_number"], progress["cpt"], progress["finished"])
+        if state == self._last_state:
+            return False  # nothing new to report
+        if progress["finished"]:
+            return True  # never drop the final update of a scan
+        return time.time() - self._last_sent >= self.interval
+
+    def build_event(self, progress: dict):
+        """Builds the event for a progress update and marks it as sent
+
+        Returns:
+            tuple: (event dict, dict of partial data arrays - empty if partial_data is False)
+        """
+        if self._last_state is None or self._last_state[0] != progress["scan_number"]:
+            self._rows_sent = 0  # new scan
+        event = {k: v for k, v in progress.items() if k != "scanner"}
+        arrays = {}
+        if self.partial_data:
+            arrays = _partial_rows(progress, self._rows_sent, self.detector_channels)
+            event["first_row"] = self._rows_sent
+            self._rows_sent = progress["cpt"]
+        self._last_sent = time.time()
+        self._last_state = (progress["scan_number"], progress["cpt"], progress["finished"])
+        return event, arrays
+
+
+def _partial_rows(progress: dict, first_row: int, detector_channels: list) -> dict:
+    """Collects data of the points (1d scans) or lines (2d scans) completed since first_row
+
+    Args:
+        progress (dict): progress reported by s2driver.driving._execute_scan
+        first_row (int): first point/line that has not been sent yet
+        detector_channels (list): scan record detector channels to include
+
+    Returns:
+        dict: name: array. "xeol_peak_counts" holds background-subtracted peak counts per pixel for XEOL scans. "D##" holds detector values - the new points for 1d scans, or the most recently completed line for 2d scans.
+    """
+    arrays = {}
+    cpt = progress["cpt"]
+    live = xeol_controller.live_data
+    if progress["scantype"].endswith("xeol") and live is not None and cpt > first_row:
+        rows = live["spectra"][first_row:cpt]
+        arrays["xeol_peak_counts"] = (rows - live["background"]).max(axis=-1)
+
+    scanner = progress["scanner"]
+    for channel in detector_channels:
+        if scanner is sc1:  # 1d scan, current array holds the points acquired so far
+            values = np.asarray(getattr(sc1, f"D{channel:02d}CA"))[first_row:cpt]
+        elif scanner is sc2 and cpt > first_row:  # 2d scan, data array holds the last completed line
+            values = np.asarray(getattr(sc1, f"D{channel:02d}DA"))[: sc1.NPTS]
+        else:
+            continue
+        arrays[f"D{channel:02d}"] = values
+    return arrays
+
 
 class S2Client(Client):
-    def __init__(self):
-        self.scan_in_progress = False
+    def __init__(self, stream: list = None, compress_stream: bool = False):
+        """Client to drive the beamline through an S2Server
+
+        Args:
+            stream (list, optional): reduced results that the server should push back after each scan, any of STREAMABLE_PRODUCTS. Streamed arrays are returned under result["data"][product]. Defaults to None (no streaming, load results from the filesystem instead).
+            compress_stream (bool, optional): whether the server should compress streamed arrays. Defaults to False.
+        """
         self.most_recent_completed_scan = PVS["next_scan"].value-1
+        self.stream = stream or []
+        self.compress_stream = compress_stream
+        for product in self.stream:
+            if product not in STREAMABLE_PRODUCTS:
+                raise ValueError(
+                    f"Cannot stream '{product}', must be one of {STREAMABLE_PRODUCTS}"
+                )
+        self._pending_requests = {}  # request_id: Future, resolved by the matching server response
+        self._streamed_data = {}  # request_id: {product: {name: array}}, attached to the result once the response arrives
+        self.progress = None  # most recent progress event received from the server
+        self.progress_callback = None
+        self.completions = deque(maxlen=100)  # most recent completions published by the server, including those of other clients
+        self.server_logs = deque(maxlen=1000)  # most recent server log records, if subscribed to "logs"
+        self._batch_items = None  # list of commands while inside a `batch` context, otherwise None
         super().__init__()
 
-    def _process_message(self, message: str):
+    def _process_message(self, message):
+        if isinstance(message, bytes):  # binary frames carry streamed scan results
+            self._receive_arrays(message)
+            return
+
         options = {
-            "scan_complete": self._mark_scan_complete,
-            "savedir": self._receive_savedir,
+            "response": self._resolve_request,
+            "progress": self._receive_progress,
+            "completion": self._receive_completion,
+            "log": self.server_logs.append,
             # "get_experiment_directory": self.share_experiment_directory,
         }
 
@@ -27,219 +163,682 @@ class S2Client(Client):
         func = options[d.pop("type")]
         func(d)
 
-    def _mark_scan_complete(self, d):
-        self.most_recent_completed_scan = d["scan_number"]
-        self.scan_in_progress = False
+    def _receive_progress(self, event: dict, arrays: dict = None):
+        if arrays is not None:
+            event["data"] = arrays
+        self.progress = event
+        if self.progress_callback is not None:
+            self.progress_callback(event)
+
+    def _receive_completion(self, d):
+        """Completion of a command issued by another client (or by an earlier connection of this one)"""
+        self.completions.append(d)
+        if d["request_id"] in self._pending_requests:
+            self._resolve_request(d)
+
+    def _resolve_request(self, d):
+        """Resolves the future of the request that this response answers
+
+        Args:
+            d (dict): response from the S2Server. Contains the request_id, the command type, a result payload (scan number, timings) and an error message (None if the command succeeded)
+        """
+        future = self._pending_requests.pop(d["request_id"], None)
+        if future is None:
+            logger.warning(
+                "Received response to unknown request %s (%s), ignoring it",
+                d["request_id"],
+                d["command"],
+            )
+            return
+        self._resolve_request_with(future, d)
+
+    def _resolve_request_with(self, future: Future, d: dict):
+        scan_number = d["result"].get("scan_number")
+        if scan_number is not None:
+            self.most_recent_completed_scan = scan_number
+        streamed = self._streamed_data.pop(d["request_id"], None)
+        if streamed is not None:
+            d["result"]["data"] = streamed
+        if d["error"] is not None:
+            future.set_exception(
+                S2ServerError(f"'{d['command']}' failed on the server: {d['error']}")
+            )
+        else:
+            future.set_result(d["result"])
+
+    def stop(self):
+        super().stop()
+        self._on_disconnect()
+
+    def _on_disconnect(self):
+        """Fails every pending request, their responses can no longer arrive on this connection. Requests that were already sent keep running on the server - reconnect and `reattach` to them."""
+        pending, self._pending_requests = self._pending_requests, {}
+        for request_id, future in pending.items():
+            if not future.done():
+                future.set_exception(
+                    S2ServerError(f"Lost connection to the server before request {request_id} completed")
+                )
+
+    def _receive_arrays(self, frame: bytes):
+        """Stores streamed scan results until the response of their request arrives (the server always streams results before responding)"""
+        metadata, arrays = decode_arrays(frame)
+        if metadata.pop("type") == "progress":
+            self._receive_progress(metadata, arrays)
+            return
+        self._streamed_data.setdefault(metadata["request_id"], {})[
+            metadata["product"]
+        ] = arrays
+
+    def _send_command(self, command_type: str, block: bool = True, **kwargs):
+        """Sends a command to the S2Server, tagged with a unique request id
+
+        Args:
+            command_type (str): type of command, must be one of the S2Server's options
+            block (bool, optional): if True, waits for the server to finish the command and returns its result. Defaults to True.
+            kwargs: arguments to the command
+
+        Raises:
+            S2ServerError: the command failed on the server (only raised here if block=True, otherwise raised by future.result())
+
+        Returns:
+            dict or concurrent.futures.Future: the result payload (block=True), or a future that resolves to it (block=False, or inside a `batch` context). Use asyncio.wrap_future to await the future from asyncio code.
+        """
+        request_id = uuid.uuid4().hex
+        future = Future()
+        future.request_id = request_id  # lets callers reattach to the request after a disconnect, see reattach
+        self._pending_requests[request_id] = future
+        command = {
+            "type": command_type,
+            "request_id": request_id,
+            **kwargs,
+        }
+        if len(self.stream) > 0:
+            command["stream"] = self.stream
+            command["compress_stream"] = self.compress_stream
+        if self._batch_items is not None:
+            self._batch_items.append(command)
+            return future
+        self.send(json.dumps(command))
+        if block:
+            return future.result()
+        return future
+
+    @contextmanager
+    def batch(self, abort_on_error: bool = True):
+        """Collects commands and submits them to the server as a single message. The server executes them back to back and responds to each one as it completes. Commands issued inside the context never block, they return futures instead. More commands (or batches) can be submitted while earlier ones are still running.
+
+        Example:
+            with client.batch():
+                client.set_transmittance(0.5)
+                futures = [client.timeseries_xeol(10, dwelltime=t) for t in [100, 200, 500]]
+            scan_numbers = [f.result()["scan_number"] for f in futures]
+
+        If the body of the context raises, nothing is sent and the futures of the collected commands fail with S2ServerError.
+
+        Args:
+            abort_on_error (bool, optional): if True, the server skips the remaining commands of the batch once one of them fails. Defaults to True.
+        """
+        if self._batch_items is not None:
+            raise Exception("Already collecting a batch, batches cannot be nested!")
+        self._batch_items = []
+        try:
+            yield
+        except BaseException as e:
+            self._fail_batch(self._batch_items, e)
+            raise
+        finally:
+            items, self._batch_items = self._batch_items, None
+        if len(items) > 0:
+            try:
+                self.send(
+                    json.dumps(
+                        {
+                            "type": "batch",
+                            "batch_id": uuid.uuid4().hex,
+                            "abort_on_error": abort_on_error,
+                            "items": items,
+                        }
+                    )
+                )
+            except Exception as e:
+                self._fail_batch(items, e)
+                raise
+
+    def _fail_batch(self, items: list, exception: BaseException):
+        """Fails the futures of batch commands that were never sent, so callers holding them do not wait forever"""
+        for command in items:
+            future = self._pending_requests.pop(command["request_id"], None)
+            if future is not None and not future.done():
+                future.set_exception(
+                    S2ServerError(f"Batch was not sent, request {command['request_id']} never ran: {exception!r}")
+                )
 
     ### Methods that communicate with APSServer
     # receiving save directory to facilitate file loading
     def get_savedir(self):
-        self.send(json.dumps({"type": "get_savepath"}))
-
-    def _receive_savedir(self, d):
+        d = self._send_command("request_savedir")
         self.xrfdir = os.path.join(d["rootdir"], d["subdir"])
         self.xeoldir = os.path.join(d["rootdir"], "XEOL")
         self.basename = d["basename"]
+        return d
+
+    def get_state(self):
+        """Current motor positions (um), transmittance (None if not set through the server) and dwelltime (ms) of the beamline, eg as the starting state for s2driver.closedloop.scheduling.order_trials"""
+        d = self._send_command("get_state")
+        return {k: d[k] for k in ["samx", "samy", "samz", "transmittance", "dwelltime"]}
+
+    def get_request_status(self, request_ids: list) -> dict:
+        """Status of earlier beamline commands, including those issued by other (or previous) connections
+
+        Args:
+            request_ids (list): request ids, eg future.request_id of non-blocking commands
+
+        Returns:
+            dict: request_id: None if the server does not know the request, otherwise {"command", "status" (queued, running, finished or failed), "scan_number", "result", "error"}. For running commands, scan_number is the number the (first) scan will be saved under, for finished ones the number of the last scan.
+        """
+        return self._send_command("get_request_status", request_ids=request_ids)["requests"]
+
+    def reattach(self, request_id: str, scan_number: int = None) -> Future:
+        """Gets a future for a command issued by an earlier connection, eg after a kernel crash or a dropped websocket. Subscribes to "completions" so the future resolves when the command finishes.
+
+        Args:
+            request_id (str): id of the request to reattach to
+            scan_number (int, optional): scan number the request was running when it was last seen, or any scan of it. Used if the server no longer knows the request (eg it was restarted): the scan index of every scan of a finished request records the request and all of its scan numbers. Defaults to None.
+
+        Raises:
+            S2ServerError: the request is unknown to the server and could not be matched to a scan (raised by future.result())
+
+        Returns:
+            concurrent.futures.Future: resolves to the result payload of the command
+        """
+        future = Future()
+        future.request_id = request_id
+        self._pending_requests[request_id] = future  # registered first, so a completion arriving meanwhile is not missed
+        self.subscribe(["completions"])
+        record = self.get_request_status([request_id])[request_id]
+        if record is not None and record["status"] in ["queued", "running"]:
+            return future  # resolved by the completion
+        if self._pending_requests.pop(request_id, None) is None:
+            return future  # the completion arrived while we were asking
+        metadata = load_scan_metadata(scan_number) if record is None and scan_number is not None else {}
+        if record is not None:
+            self._resolve_request_with(future, {"request_id": request_id, **record})
+        elif metadata.get("request_id") == request_id:
+            scan_numbers = [int(n) for n in np.atleast_1d(metadata.get("request_scan_numbers", scan_number))]
+            future.set_result({"scan_number": scan_numbers[-1], "scan_numbers": scan_numbers})
+        else:
+            future.set_exception(
+                S2ServerError(f"Request {request_id} is unknown to the server, it may have been lost")
+            )
+        return future
+
+    # control of the beamline and subscriptions
+    def acquire_control(self, force: bool = False):
+        """Makes this client the one allowed to issue beamline commands. A client also acquires control automatically with its first command if nobody else holds it.
+
+        Args:
+            force (bool, optional): take control even if another client holds it. Defaults to False.
+        """
+        return self._send_command("acquire_control", force=force)
+
+    def release_control(self):
+        return self._send_command("release_control")
+
+    def subscribe(self, topics: list):
+        """Subscribes to server topics (any of TOPICS). "completions" delivers results of every command on the beamline to self.completions, "logs" delivers server log records to self.server_logs. Use subscribe_progress for progress events."""
+        return self._send_command("subscribe", topics=topics)
+
+    def unsubscribe(self, topics: list):
+        return self._send_command("unsubscribe", topics=topics)
+
+    # progress of running scans
+    def subscribe_progress(
+        self,
+        interval: float = 1.0,
+        partial_data: bool = False,
+        detector_channels: list = None,
+        callback=None,
+    ):
+        """Asks the server to send progress events while scans run. The latest event is stored in self.progress.
+
+        Args:
+            interval (float, optional): minimum seconds between events, updates in between are merged. Defaults to 1.0.
+            partial_data (bool, optional): whether events should carry the data rows completed since the previous event (under event["data"]). Defaults to False.
+            detector_channels (list, optional): scan record detector channels to include in partial data. Defaults to None.
+            callback (callable, optional): called with each event. Runs on the websocket thread, so it should return quickly. Defaults to None.
+        """
+        self.progress_callback = callback
+        return self._send_command(
+            "subscribe_progress",
+            interval=interval,
+            partial_data=partial_data,
+            detector_channels=detector_channels or [],
+        )
 
-    def _wait_for_scan_complete(self):
-        self.scan_in_progress = True
-        while self.scan_in_progress:
-            time.sleep(1)
+    def unsubscribe_progress(self):
+        self.progress_callback = None
+        return self._send_command("unsubscribe_progress")
 
     # scan methods
     def movr_x(self, pos, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "movr_x",
-                    "pos": pos,
-                }
-            )
+        return self._send_command(
+            "movr_x",
+            block=block,
+            pos=pos,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def movr_y(self, pos, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "movr_y",
-                    "pos": pos,
-                }
-            )
+        return self._send_command(
+            "movr_y",
+            block=block,
+            pos=pos,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan1d_x(self, startpos, endpos, numpts, dwelltime, absolute=False, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan1d_x",
-                    "startpos": startpos,
-                    "endpos": endpos,
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan1d_x",
+            block=block,
+            startpos=startpos,
+            endpos=endpos,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            absolute=absolute,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan1d_x_xeol(
         self, startpos, endpos, numpts, dwelltime, absolute=False, block=True
     ):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan1d_x_xeol",
-                    "startpos": startpos,
-                    "endpos": endpos,
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan1d_x_xeol",
+            block=block,
+            startpos=startpos,
+            endpos=endpos,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            absolute=absolute,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan1d_y(self, startpos, endpos, numpts, dwelltime, absolute=False, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan1d_y",
-                    "startpos": startpos,
-                    "endpos": endpos,
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan1d_y",
+            block=block,
+            startpos=startpos,
+            endpos=endpos,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            absolute=absolute,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan1d_y_xeol(
         self, startpos, endpos, numpts, dwelltime, absolute=False, block=True
     ):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan1d_y_xeol",
-                    "startpos": startpos,
-                    "endpos": endpos,
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan1d_y_xeol",
+            block=block,
+            startpos=startpos,
+            endpos=endpos,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            absolute=absolute,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan2d(
-        self, xmin, xmax, numx, ymin, ymax, numy, dwelltime, absolute=False, block=True
+        self,
+        xmin,
+        xmax,
+        numx,
+        ymin,
+        ymax,
+        numy,
+        dwelltime,
+        absolute=False,
+        serpentine=False,
+        block=True,
     ):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan2d",
-                    "xmin": xmin,
-                    "xmax": xmax,
-                    "numx": numx,
-                    "ymin": ymin,
-                    "ymax": ymax,
-                    "numy": numy,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan2d",
+            block=block,
+            startpos1=xmin,
+            endpos1=xmax,
+            numpts1=numx,
+            startpos2=ymin,
+            endpos2=ymax,
+            numpts2=numy,
+            dwelltime=dwelltime,
+            absolute=absolute,
+            serpentine=serpentine,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def scan2d_xeol(
-        self, xmin, xmax, numx, ymin, ymax, numy, dwelltime, absolute=False, block=True
+        self,
+        xmin,
+        xmax,
+        numx,
+        ymin,
+        ymax,
+        numy,
+        dwelltime,
+        absolute=False,
+        serpentine=False,
+        block=True,
     ):
-        self.send(
-            json.dumps(
-                {
-                    "type": "scan2d_xeol",
-                    "xmin": xmin,
-                    "xmax": xmax,
-                    "numx": numx,
-                    "ymin": ymin,
-                    "ymax": ymax,
-                    "numy": numy,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                }
-            )
+        return self._send_command(
+            "scan2d_xeol",
+            block=block,
+            startpos1=xmin,
+            endpos1=xmax,
+            numpts1=numx,
+            startpos2=ymin,
+            endpos2=ymax,
+            numpts2=numy,
+            dwelltime=dwelltime,
+            absolute=absolute,
+            serpentine=serpentine,
+        )
+
+    def masked_scan2d(
+        self,
+        xmin,
+        xmax,
+        numx,
+        ymin,
+        ymax,
+        numy,
+        dwelltime,
+        mask,
+        absolute=False,
+        xeol=False,
+        block=True,
+    ):
+        """Scans the scan2d grid, only visiting pixels inside a mask. See s2driver.driving.masked_scan2d.
+
+        Args:
+            mask (array-like): boolean mask of the pixels to visit, shape (numy, numx)
+            xeol (bool, optional): whether to capture an XEOL spectrum at every point. Defaults to False.
+
+        Returns:
+            dict: result payload. "scan_numbers" lists every segment, the first one holds the grid (see s2driver.analysis.loading.load_masked_scan). Also reports the estimated time "saving_fraction" etc.
+        """
+        return self._send_command(
+            "masked_scan2d",
+            block=block,
+            startpos1=xmin,
+            endpos1=xmax,
+            numpts1=numx,
+            startpos2=ymin,
+            endpos2=ymax,
+            numpts2=numy,
+            dwelltime=dwelltime,
+            mask=np.asarray(mask, dtype=bool).tolist(),
+            absolute=absolute,
+            xeol=xeol,
+        )
+
+    def mosaic_scan(
+        self,
+        xmin,
+        xmax,
+        ymin,
+        ymax,
+        step,
+        dwelltime,
+        tile_size,
+        overlap=0.1,
+        scantype="flyscan2d",
+        absolute=False,
+        block=True,
+    ):
+        """Maps a region larger than one scan as a mosaic of overlapping tiles. See s2driver.driving.mosaic_scan.
+
+        Args:
+            xmin (float): starting samx position, in um
+            xmax (float): ending samx position, in um
+            ymin (float): starting samy position, in um
+            ymax (float): ending samy position, in um
+            step (float): pixel size, in um
+            dwelltime (float): dwelltime (ms) per point
+            tile_size (float): width and height of a tile, in um
+            overlap (float, optional): fraction of a tile shared with each neighbour. Defaults to 0.1.
+            scantype (str, optional): scan used for every tile, "flyscan2d", "scan2d" or "scan2d_xeol". Defaults to "flyscan2d".
+            absolute (bool, optional): whether positions are absolute (True) or relative to the current position (False). Defaults to False.
+            block (bool, optional): whether to wait for the mosaic to finish. Defaults to True.
+
+        Returns:
+            dict: result payload. "scan_numbers" lists every tile, the first one holds the plan (see s2driver.analysis.mosaic.stitch_mosaic).
+        """
+        return self._send_command(
+            "mosaic_scan",
+            block=block,
+            xmin=xmin,
+            xmax=xmax,
+            ymin=ymin,
+            ymax=ymax,
+            step=step,
+            dwelltime=dwelltime,
+            tile_size=tile_size,
+            overlap=overlap,
+            scantype=scantype,
+            absolute=absolute,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def flyscan2d(
         self, xmin, xmax, numx, ymin, ymax, numy, dwelltime, absolute=False, block=True
     ):
-        self.send(
-            json.dumps(
-                {
-                    "type": "flyscan2d",
-                    "xmin": xmin,
-                    "xmax": xmax,
-                    "numx": numx,
-                    "ymin": ymin,
-                    "ymax": ymax,
-                    "numy": numy,
-                    "dwelltime": dwelltime,
-                    "absolute": absolute,
-                    "wait_for_h5": True,
-                }
-            )
+        return self._send_command(
+            "flyscan2d",
+            block=block,
+            startpos1=xmin,
+            endpos1=xmax,
+            numpts1=numx,
+            startpos2=ymin,
+            endpos2=ymax,
+            numpts2=numy,
+            dwelltime=dwelltime,
+            absolute=absolute,
+            wait_for_h5=True,
         )
-        if block:
-            self._wait_for_scan_complete()
-
-    def timeseries(self, numpts, dwelltime, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "timeseries",
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                }
-            )
+
+    def trajectory_scan(
+        self,
+        x,
+        y,
+        dwelltime,
+        absolute=False,
+        max_points=None,
+        optimize=False,
+        xeol=False,
+        block=True,
+    ):
+        """Scans samx/samy through a list of points, eg from s2driver.trajectories
+
+        Args:
+            x (array-like): samx positions, in um
+            y (array-like): samy positions, in um
+            dwelltime (float): dwelltime (ms) per point
+            absolute (bool, optional): whether positions are absolute (True) or relative to the current position (False). Defaults to False.
+            max_points (int, optional): maximum points per scan, longer trajectories are split across scans. Defaults to None (scan record maximum).
+            optimize (bool, optional): whether the server should reorder the points to minimize travel time. Defaults to False.
+            xeol (bool, optional): whether to capture an XEOL spectrum at every point. Defaults to False.
+            block (bool, optional): whether to wait for the scans to finish. Defaults to True.
+
+        Returns:
+            dict: result payload. "scan_numbers" lists every scan the trajectory was split into, "scan_number" is the last one.
+        """
+        return self._send_command(
+            "trajectory_scan",
+            block=block,
+            x=np.asarray(x, dtype=float).tolist(),
+            y=np.asarray(y, dtype=float).tolist(),
+            dwelltime=dwelltime,
+            absolute=absolute,
+            max_points=max_points,
+            optimize=optimize,
+            xeol=xeol,
         )
-        if block:
-            self._wait_for_scan_complete()
-
-    def timeseries_xeol(self, numpts, dwelltime, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "timeseries_xeol",
-                    "numpts": numpts,
-                    "dwelltime": dwelltime,
-                }
-            )
+
+    def adaptive_scan(
+        self,
+        xmin,
+        xmax,
+        ymin,
+        ymax,
+        step,
+        dwelltime,
+        detector_channel=None,
+        xeol=False,
+        coarse_spacing=8,
+        threshold=0.1,
+        max_points=None,
+        absolute=False,
+        block=True,
+    ):
+        """Maps a region coarse-to-fine, only refining where the signal varies. See s2driver.driving.adaptive_scan.
+
+        Args:
+            xmin (float): starting samx position, in um
+            xmax (float): ending samx position, in um
+            ymin (float): starting samy position, in um
+            ymax (float): ending samy position, in um
+            step (float): target resolution, in um
+            dwelltime (float): dwelltime (ms) per point
+            detector_channel (int, optional): scan record detector (D01-D70) that drives refinement. Required unless xeol is True. Defaults to None.
+            xeol (bool, optional): drive refinement with the XEOL peak counts instead. Defaults to False.
+            coarse_spacing (int, optional): spacing of the initial grid, in multiples of step. Must be a power of two. Defaults to 8.
+            threshold (float, optional): cells whose corner values differ by at least this fraction of the measured range are refined. Defaults to 0.1.
+            max_points (int, optional): point budget. Defaults to None (no budget).
+            absolute (bool, optional): whether positions are absolute (True) or relative to the current position (False). Defaults to False.
+            block (bool, optional): whether to wait for the scan to finish. Defaults to True.
+
+        Returns:
+            dict: result payload. "x", "y" and the reconstructed "map" and "sampled" mask as np.ndarrays, and the "scan_numbers" of every batch.
+        """
+        result = self._send_command(
+            "adaptive_scan",
+            block=block,
+            xmin=xmin,
+            xmax=xmax,
+            ymin=ymin,
+            ymax=ymax,
+            step=step,
+            dwelltime=dwelltime,
+            detector_channel=detector_channel,
+            xeol=xeol,
+            coarse_spacing=coarse_spacing,
+            threshold=threshold,
+            max_points=max_points,
+            absolute=absolute,
+        )
+        if isinstance(result, dict):  # not a future, see _send_command
+            for key in ["x", "y", "map", "sampled"]:
+                result[key] = np.asarray(result[key])
+        return result
+
+    def autofocus(
+        self,
+        xmin,
+        xmax,
+        numx,
+        dwelltime,
+        detector_channel,
+        focus_range=(-20, 20),
+        tolerance=1.0,
+        max_scans=8,
+        block=True,
+    ):
+        """Moves samz to where an edge in short samx line scans is sharpest. See s2driver.driving.autofocus.
+
+        Args:
+            xmin (float): start of the line scan across the edge, relative to the current position, in um
+            xmax (float): end of the line scan across the edge, relative to the current position, in um
+            numx (int): number of points per line scan
+            dwelltime (float): dwelltime (ms) per point
+            detector_channel (int): scan record detector (D01-D70) that shows the edge
+            focus_range (tuple, optional): samz range to search, relative to the current position, in um. Defaults to (-20, 20).
+            tolerance (float, optional): focus precision, in um. Defaults to 1.0.
+            max_scans (int, optional): maximum number of line scans. Defaults to 8.
+            block (bool, optional): whether to wait for autofocus to finish. Defaults to True.
+
+        Returns:
+            dict: result payload, with the focus curve ("z", "width"), "best_z" and "scan_numbers"
+        """
+        return self._send_command(
+            "autofocus",
+            block=block,
+            startpos=xmin,
+            endpos=xmax,
+            numpts=numx,
+            dwelltime=dwelltime,
+            detector_channel=detector_channel,
+            focus_range=list(focus_range),
+            tolerance=tolerance,
+            max_scans=max_scans,
+        )
+
+    def xanes_scan(self, energies, dwelltime, axes, focal_length=None, xeol=False, block=True):
+        """Measures a spectrum at the current position by stepping the energy within one scan. See s2driver.driving.xanes_scan.
+
+        Args:
+            energies (array-like): beam energies, in eV
+            dwelltime (float): dwelltime (ms) per energy
+            axes (list): EnergyAxis list (or dicts of EnergyAxis arguments) of the energy axes to drive, at most four
+            focal_length (float, optional): zone plate focal length at the current energy, in um. Needed to keep the sample in focus. Defaults to None.
+            xeol (bool, optional): whether to capture an XEOL spectrum at every energy. Defaults to False.
+            block (bool, optional): whether to wait for the scan to finish. Defaults to True.
+        """
+        return self._send_command(
+            "xanes_scan",
+            block=block,
+            energies=np.asarray(energies, dtype=float).tolist(),
+            dwelltime=dwelltime,
+            axes=[a if isinstance(a, dict) else vars(a) for a in axes],
+            focal_length=focal_length,
+            xeol=xeol,
+        )
+
+    def timeseries(
+        self, numpts, dwelltime, stopping=None, detector_channel=None, block=True
+    ):
+        """Records a timeseries at the current position
+
+        Args:
+            numpts (int): maximum number of points to record
+            dwelltime (float): dwelltime (ms) per point
+            stopping (dict, optional): stopping rule spec (see s2driver.stopping.make_stopping_rule), eg {"rule": "precision", "rel_precision": 0.01}. The scan stops once the rule converges, the result then has "stopped_early" True. Defaults to None.
+            detector_channel (int, optional): scan record detector fed to the stopping rule. Required with stopping. Defaults to None.
+            block (bool, optional): whether to wait for the scan to finish. Defaults to True.
+        """
+        return self._send_command(
+            "timeseries",
+            block=block,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            stopping=stopping,
+            detector_channel=detector_channel,
+        )
+
+    def timeseries_xeol(self, numpts, dwelltime, stopping=None, block=True):
+        """Records an XEOL timeseries at the current position
+
+        Args:
+            numpts (int): maximum number of points to record
+            dwelltime (float): dwelltime (ms) per point
+            stopping (dict, optional): stopping rule spec fed with the XEOL peak counts, eg {"rule": "decay", "rel_precision": 0.05}. Defaults to None.
+            block (bool, optional): whether to wait for the scan to finish. Defaults to True.
+        """
+        return self._send_command(
+            "timeseries_xeol",
+            block=block,
+            numpts=numpts,
+            dwelltime=dwelltime,
+            stopping=stopping,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     def set_transmittance(self, transmittance: float, block=True):
-        self.send(
-            json.dumps(
-                {
-                    "type": "set_transmittance",
-                    "transmittance": transmittance,
-                }
-            )
+        return self._send_command(
+            "set_transmittance",
+            block=block,
+            transmittance=transmittance,
         )
-        if block:
-            self._wait_for_scan_complete()
 
     ### Methods to process data
     def load_h5(
@@ -264,11 +863,57 @@ class S2Client(Client):
             scan_number = self.most_recent_completed_scan
         return load_xeol(scan_number, wlmin, wlmax)
 
+    def fit_scan(
+        self,
+        elements: list,
+        scan_number=None,
+        incident_energy: float = None,
+        bin_factor: int = 4,
+        clip_flyscan=True,
+    ):
+        """Quick-look element maps from the raw spectra of a scan, without waiting for MAPS. See s2driver.analysis.fitting.fit_scan."""
+        if scan_number is None:
+            scan_number = self.most_recent_completed_scan
+        return fit_scan(
+            scan_number,
+            elements,
+            incident_energy=incident_energy,
+            bin_factor=bin_factor,
+            clip_flyscan=clip_flyscan,
+        )
+
+    def fit_xeol_peaks(self, scan_number=None, profile="gaussian", wlmin=None, wlmax=None):
+        """Peak center, width and amplitude maps (with uncertainties) of a scan's XEOL spectra. See s2driver.analysis.peaks.fit_xeol_peaks."""
+        if scan_number is None:
+            scan_number = self.most_recent_completed_scan
+        return fit_xeol_peaks(scan_number, profile=profile, wlmin=wlmin, wlmax=wlmax)
+
+
+class _LogPublisher(logging.Handler):
+    """Publishes s2driver log records to clients subscribed to the "logs" topic"""
+
+    def __init__(self, server):
+        super().__init__(level=logging.INFO)
+        self.server = server
+
+    def emit(self, record):
+        if not getattr(self.server, "running", False):
+            return
+        try:
+            msg = {
+                "type": "log",
+                "time": record.created,
+                "level": record.levelname,
+                "message": record.getMessage(),
+            }
+            self.server.publish("logs", json.dumps(msg), droppable=True)
+        except Exception:
+            self.handleError(record)
+
 
 class S2Server(Server):
-    def _process_message(self, message: str):
-        options = {
-            "request_savedir": self._send_savedir,
+    def __init__(self):
+        self.options = {
             "movr_x": self._movr_x,
             "movr_y": self._movr_y,
             "scan1d_x": self._scan1d_x,
@@ -278,37 +923,397 @@ class S2Server(Server):
             "scan2d": self._scan2d,
             "scan2d_xeol": self._scan2d_xeol,
             "flyscan2d": self._flyscan2d,
+            "trajectory_scan": self._trajectory_scan,
+            "adaptive_scan": self._adaptive_scan,
+            "masked_scan2d": self._masked_scan2d,
+            "mosaic_scan": self._mosaic_scan,
+            "xanes_scan": self._xanes_scan,
+            "autofocus": self._autofocus,
             "timeseries": self._timeseries,
             "timeseries_xeol": self._timeseries_xeol,
             "set_transmittance": self._set_transmittance,
             # "get_experiment_directory": self.share_experiment_directory,
-        }
+        }  # commands that drive the beamline, executed in order by the command worker
+        self.immediate_options = {
+            "request_savedir": self._send_savedir,
+            "get_state": self._get_state,
+            "acquire_control": self._acquire_control,
+            "release_control": self._release_control,
+            "subscribe": self._subscribe,
+            "unsubscribe": self._unsubscribe,
+            "subscribe_progress": self._subscribe_progress,
+            "unsubscribe_progress": self._unsubscribe_progress,
+            "get_request_status": self._get_request_status,
+        }  # commands that only report state or configure a connection, answered as soon as they arrive. Called with (d, connection)
+        self.owner = None  # the only connection allowed to issue beamline commands
+        self.transmittance = None  # last transmittance set through the server, None if unknown
+        self.progress_subscriptions = {}  # connection: ProgressSubscription
+        self.request_history = OrderedDict()  # request_id: status of the most recent beamline commands, see _get_request_status
+        add_progress_callback(self._publish_progress)
+        self._log_publisher = _LogPublisher(self)
+        logger.addHandler(self._log_publisher)
+
+        self._commands = queue.Queue()
+        self._failed_batches = set()  # batch_ids whose remaining items should be skipped
+        self._worker = Thread(target=self._command_worker, daemon=True)
+        self._worker.start()
+        super().__init__()
 
+    def stop(self):
+        """Stops the server. Queued beamline commands are dropped, and the command being executed is waited on."""
+        while True:
+            try:
+                command_type, request_id, *_ = self._commands.get_nowait()
+            except queue.Empty:
+                break
+            if command_type != _END_OF_BATCH:
+                self._record_request(request_id, status="failed", error="The server stopped before the command ran")
+        self._commands.put(None)  # tells the command worker to exit
+        super().stop()
+        remove_progress_callback(self._publish_progress)
+        logger.removeHandler(self._log_publisher)
+        self._worker.join()
+
+    def _process_message(self, message: str, connection):
         d = json.loads(message)
-        func = options[d.pop("type")]
-        logger.info(f"APSServer received instructions of type '{func}'")
-        func(d)
+        command_type = d.pop("type")
+        if command_type == "batch":
+            logger.info(
+                f"APSServer received batch of {len(d['items'])} instructions"
+            )
+            for item in d["items"]:
+                self._enqueue_command(
+                    item,
+                    connection,
+                    batch_id=d["batch_id"],
+                    abort_on_error=d.get("abort_on_error", True),
+                )
+            self._commands.put((_END_OF_BATCH, None, None, None, d["batch_id"], False))
+        else:
+            d["type"] = command_type
+            self._enqueue_command(d, connection)
+
+    def _enqueue_command(
+        self, d: dict, connection, batch_id: str = None, abort_on_error: bool = False
+    ):
+        """Validates a command and queues it for the command worker. Unknown commands and beamline commands from clients that do not hold control are rejected immediately, and commands that only report state are answered without waiting for the queue.
+
+        Args:
+            d (dict): command, including its type and request_id
+            connection (Connection): client that sent the command
+            batch_id (str, optional): id of the batch this command belongs to. Defaults to None.
+            abort_on_error (bool, optional): whether a failure of this command should skip the remaining commands in its batch. Defaults to False.
+        """
+        command_type = d.pop("type")
+        request_id = d.pop("request_id", None)
+        logger.info(f"APSServer received instructions of type '{command_type}'")
+        if command_type in self.immediate_options:
+            self._execute_command(
+                partial(self.immediate_options[command_type], connection=connection),
+                command_type,
+                request_id,
+                d,
+                connection,
+            )
+        elif command_type in self.options:
+            if self.owner is None:
+                self.owner = connection
+                logger.info("APSServer: beamline control acquired by a new client")
+            if self.owner is not connection:
+                self._respond(
+                    request_id,
+                    command_type,
+                    {},
+                    "Another client is controlling the beamline, call acquire_control(force=True) to take over",
+                    connection,
+                )
+                return
+            self._record_request(request_id, command=command_type, status="queued")
+            self._commands.put(
+                (command_type, request_id, d, connection, batch_id, abort_on_error)
+            )
+        else:
+            self._respond(
+                request_id,
+                command_type,
+                {},
+                f"Unknown command type '{command_type}', must be one of {list(self.options)}",
+                connection,
+            )
+
+    def _on_disconnect(self, connection):
+        self.progress_subscriptions.pop(connection, None)
+        if self.owner is connection:
+            self.owner = None
+            logger.info("APSServer: client controlling the beamline disconnected, control released")
+
+    def _command_worker(self):
+        """Executes queued commands back to back, so the beamline never waits on the network between commands"""
+        while True:
+            command = self._commands.get()
+            if command is None:  # put by stop
+                return
+            command_type, request_id, d, connection, batch_id, abort_on_error = command
+            if command_type == _END_OF_BATCH:
+                self._failed_batches.discard(batch_id)
+                continue
+            if batch_id is not None and batch_id in self._failed_batches:
+                self._respond(
+                    request_id,
+                    command_type,
+                    {},
+                    "Skipped because an earlier command in its batch failed",
+                    connection,
+                )
+                continue
+            self._record_request(
+                request_id, status="running", scan_number=get_next_scan_number()
+            )
+            error = self._execute_command(
+                self.options[command_type], command_type, request_id, d, connection
+            )
+            if error is not None and batch_id is not None and abort_on_error:
+                self._failed_batches.add(batch_id)
+
+    def _execute_command(
+        self, func, command_type: str, request_id: str, d: dict, connection
+    ) -> str:
+        """Executes a single command and responds to the client with its outcome
+
+        Args:
+            func (callable): server method that executes the command
+            command_type (str): type of the command
+            request_id (str): id of the request, echoed back in the response
+            d (dict): command arguments
+            connection (Connection): client that sent the command
+
+        Returns:
+            str: error message if the command failed, otherwise None
+        """
+        started = time.time()
+        try:
+            result = func(d) or {}
+            error = None
+        except Exception as e:
+            logger.error(f"APSServer failed to execute '{command_type}': {e!r}")
+            result = {}
+            error = f"{type(e).__name__}: {e}"
+        finished = time.time()
+        result.update(
+            {"started": started, "finished": finished, "duration": finished - started}
+        )
+        if error is None and "scan_number" in result:
+            scan_numbers = [int(n) for n in result.get("scan_numbers", [])]
+            if result["scan_number"] not in scan_numbers:
+                scan_numbers.append(int(result["scan_number"]))
+            for scan_number in scan_numbers:  # every scan, so reattach finds the request by the first scan it was seen running
+                try:
+                    write_scan_metadata(
+                        scan_number,
+                        {"request_id": request_id, "command": command_type, "request_scan_numbers": scan_numbers},
+                    )
+                except Exception as e:
+                    logger.error(f"APSServer failed to index scan {scan_number}: {e!r}")
+            if d.get("stream"):
+                self._stream_results(request_id, command_type, result, d, connection)
+        self._respond(request_id, command_type, result, error, connection)
+        return error
+
+    def _stream_results(
+        self, request_id: str, command_type: str, result: dict, d: dict, connection
+    ):
+        """Pushes reduced results of a completed scan to the client as binary frames. Failures are reported in result["stream_errors"] rather than failing the command, since the scan itself succeeded.
+
+        Args:
+            request_id (str): id of the request that ran the scan
+            command_type (str): type of the command that ran the scan
+            result (dict): result payload of the command, must contain the scan number
+            d (dict): command arguments, including the list of products to "stream" and whether to "compress_stream"
+            connection (Connection): client to stream to
+        """
+        reducers = {
+            "xrf": self._reduce_xrf,
+            "xeol": self._reduce_xeol,
+        }
+        scan_number = result["scan_number"]
+        errors = {}
+        for product in d["stream"]:
+            try:
+                arrays, metadata = reducers[product](scan_number, command_type)
+                metadata.update(
+                    {
+                        "type": "result",
+                        "request_id": request_id,
+                        "scan_number": scan_number,
+                        "product": product,
+                    }
+                )
+                self.send(
+                    encode_arrays(
+                        arrays, metadata=metadata, compress=d.get("compress_stream", False)
+                    ),
+                    connection,
+                )
+            except Exception as e:
+                logger.error(f"APSServer failed to stream {product} for scan {scan_number}: {e!r}")
+                errors[product] = f"{type(e).__name__}: {e}"
+        if len(errors) > 0:
+            result["stream_errors"] = errors
+
+    def _wait_for_file(self, fpath: str):
+        """Blocks until a scan output file exists
+
+        Raises:
+            TimeoutError: the file did not appear within STREAM_FILE_TIMEOUT seconds
+        """
+        t0 = time.time()
+        while not os.path.exists(fpath):
+            if time.time() - t0 > STREAM_FILE_TIMEOUT:
+                raise TimeoutError(f"{fpath} did not appear within {STREAM_FILE_TIMEOUT} s")
+            time.sleep(0.1)
+
+    def _reduce_xrf(self, scan_number: int, command_type: str):
+        """Element maps, axes and integrated spectrum of a scan. Full spectra stay on the server."""
+        self._wait_for_file(get_h5_filepath(scan_number))
+        data = load_h5(scan_number, clip_flyscan=command_type == "flyscan2d")
+        arrays = {f"maps/{channel}": m for channel, m in data["maps"].items()}
+        for key in ["x", "y", "energy", "intspectra"]:
+            arrays[key] = np.asarray(data[key])
+        return arrays, {"fitted": bool(data["fitted"])}
+
+    def _reduce_xeol(self, scan_number: int, command_type: str):
+        """XEOL summary maps and the map-averaged spectrum of a scan. Full spectra stay on the server."""
+        self._wait_for_file(get_xeol_filepath(scan_number))
+        data = load_xeol(scan_number)
+        arrays = {
+            key: np.asarray(data[key])
+            for key in ["wavelength", "map_avg_cps", "peak_cps_per_pixel", "peak_wl_per_pixel"]
+        }
+        for axis, positions in data["positions"].items():
+            arrays[f"positions/{axis}"] = positions
+        return arrays, {}
+
+    def _respond(
+        self, request_id: str, command_type: str, result: dict, error: str, connection
+    ):
+        """Sends the outcome of a command back to the client that requested it, and publishes it to clients subscribed to "completions"
 
-    def _send_savedir(self, d):
+        Args:
+            request_id (str): id of the request this response answers
+            command_type (str): type of the command that was executed
+            result (dict): result payload (scan number, timings, etc.)
+            error (str): error message if the command failed, otherwise None
+            connection (Connection): client that sent the command
+        """
+        msg = {
+            "request_id": request_id,
+            "command": command_type,
+            "result": result,
+            "error": error,
+        }
+        self.send(json.dumps({"type": "response", **msg}), connection)
+        if command_type in self.options:
+            self._record_request(
+                request_id,
+                command=command_type,
+                status="failed" if error is not None else "finished",
+                scan_number=result.get("scan_number"),
+                result=result,
+                error=error,
+            )
+            self.publish(
+                "completions",
+                json.dumps({"type": "completion", **msg}),
+                exclude=connection,
+            )
+
+    def _record_request(self, request_id: str, **status):
+        """Updates the status of a beamline command in the request history, forgetting the oldest commands beyond MAX_REQUEST_HISTORY"""
+        if request_id is None:
+            return
+        record = self.request_history.setdefault(
+            request_id,
+            {"command": None, "status": None, "scan_number": None, "result": None, "error": None},
+        )
+        record.update(status)
+        while len(self.request_history) > MAX_REQUEST_HISTORY:
+            self.request_history.popitem(last=False)
+
+    def _get_request_status(self, d, connection):
+        return {
+            "requests": {
+                request_id: self.request_history.get(request_id)
+                for request_id in d["request_ids"]
+            }
+        }
+
+    def _acquire_control(self, d, connection):
+        if self.owner is not None and self.owner is not connection and not d["force"]:
+            raise Exception("Another client is controlling the beamline, use force=True to take over")
+        self.owner = connection
+
+    def _release_control(self, d, connection):
+        if self.owner is connection:
+            self.owner = None
+
+    def _subscribe(self, d, connection):
+        for topic in d["topics"]:
+            if topic not in TOPICS:
+                raise ValueError(f"Unknown topic '{topic}', must be one of {TOPICS}")
+        connection.topics.update(d["topics"])
+
+    def _unsubscribe(self, d, connection):
+        connection.topics.difference_update(d["topics"])
+
+    def _subscribe_progress(self, d, connection):
+        self.progress_subscriptions[connection] = ProgressSubscription(
+            interval=d["interval"],
+            partial_data=d["partial_data"],
+            detector_channels=d["detector_channels"],
+        )
+        connection.topics.add("progress")
+
+    def _unsubscribe_progress(self, d, connection):
+        self.progress_subscriptions.pop(connection, None)
+        connection.topics.discard("progress")
+
+    def _publish_progress(self, progress: dict):
+        """Progress callback registered with s2driver.driving, forwards throttled progress events to each subscriber at its own rate"""
+        for connection, subscription in list(self.progress_subscriptions.items()):
+            if not subscription.is_due(progress):
+                continue
+            event, arrays = subscription.build_event(progress)
+            if len(arrays) > 0:
+                msg = encode_arrays(arrays, metadata={"type": "progress", **event})
+            else:
+                msg = json.dumps({"type": "progress", **event})
+            self.send(msg, connection, droppable=True)
+
+    def _get_state(self, d, connection):
+        return {
+            "samx": samx.RBV,
+            "samy": samy.RBV,
+            "samz": samz.RBV,
+            "transmittance": self.transmittance,
+            "dwelltime": PVS["dwell_step"].value * 1e3,  # step scan dwelltime is in seconds, report ms
+        }
+
+    def _send_savedir(self, d, connection):
         rootdir = PVS["filesys"].value
         subdir = PVS["subdir"].value
         # basename = PVS["basename"].value
         basename = "2idd"
-        self.send_message(
-            json.dumps({"rootdir": rootdir, "subdir": subdir, "basename": basename})
-        )
+        return {"rootdir": rootdir, "subdir": subdir, "basename": basename}
 
-    def _mark_scan_complete(self):
-        msg = {"type": "scan_complete", "scan_number": PVS["next_scan"].value - 1}
-        self.send(json.dumps(msg))
+    def _completed_scan(self) -> dict:
+        """Result payload for a command that executed a scan"""
+        return {"scan_number": PVS["next_scan"].value - 1}
 
     def _movr_x(self, d):
         movr(samx, d["pos"])
-        self._mark_scan_complete()
 
     def _movr_y(self, d):
         movr(samy, d["pos"])
-        self._mark_scan_complete()
 
     def _scan1d_x(self, d):
         scan1d(
@@ -319,7 +1324,7 @@ class S2Server(Server):
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _scan1d_x_xeol(self, d):
         scan1d_xeol(
@@ -330,7 +1335,7 @@ class S2Server(Server):
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _scan1d_y(self, d):
         scan1d(
@@ -341,7 +1346,7 @@ class S2Server(Server):
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _scan1d_y_xeol(self, d):
         scan1d_xeol(
@@ -352,7 +1357,7 @@ class S2Server(Server):
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _scan2d(self, d):
         scan2d(
@@ -366,8 +1371,9 @@ class S2Server(Server):
             numpts2=d["numpts2"],
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
+            serpentine=d.get("serpentine", False),
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _scan2d_xeol(self, d):
         scan2d_xeol(
@@ -381,8 +1387,9 @@ class S2Server(Server):
             numpts2=d["numpts2"],
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
+            serpentine=d.get("serpentine", False),
         )
-        self._mark_scan_complete()
+        return self._completed_scan()
 
     def _flyscan2d(self, d):
         flyscan2d(
@@ -394,17 +1401,134 @@ class S2Server(Server):
             numpts2=d["numpts2"],
             dwelltime=d["dwelltime"],
             absolute=d["absolute"],
+            wait_for_h5=d.get("wait_for_h5", False),
+        )
+        return self._completed_scan()
+
+    def _trajectory_scan(self, d):
+        first_scan = PVS["next_scan"].value
+        trajectory_scan(
+            x=d["x"],
+            y=d["y"],
+            dwelltime=d["dwelltime"],
+            absolute=d["absolute"],
+            max_points=d.get("max_points"),
+            optimize=d.get("optimize", False),
+            xeol=d.get("xeol", False),
         )
-        self._mark_scan_complete()
+        result = self._completed_scan()
+        result["scan_numbers"] = list(range(first_scan, result["scan_number"] + 1))
+        return result
+
+    def _masked_scan2d(self, d):
+        report = masked_scan2d(
+            startpos1=d["startpos1"],
+            endpos1=d["endpos1"],
+            numpts1=d["numpts1"],
+            startpos2=d["startpos2"],
+            endpos2=d["endpos2"],
+            numpts2=d["numpts2"],
+            dwelltime=d["dwelltime"],
+            mask=d["mask"],
+            absolute=d["absolute"],
+            xeol=d.get("xeol", False),
+        )
+        result = self._completed_scan()
+        result.update(
+            {k: v.tolist() if isinstance(v, np.ndarray) else float(v) for k, v in report.items()}
+        )
+        return result
+
+    def _mosaic_scan(self, d):
+        plan = mosaic_scan(
+            startpos1=d["xmin"],
+            endpos1=d["xmax"],
+            startpos2=d["ymin"],
+            endpos2=d["ymax"],
+            step=d["step"],
+            dwelltime=d["dwelltime"],
+            tile_size=d["tile_size"],
+            overlap=d.get("overlap", 0.1),
+            scantype=d.get("scantype", "flyscan2d"),
+            absolute=d["absolute"],
+        )
+        result = self._completed_scan()
+        result["scan_numbers"] = plan["scan_numbers"].tolist()
+        return result
+
+    def _xanes_scan(self, d):
+        xanes_scan(
+            energies=d["energies"],
+            dwelltime=d["dwelltime"],
+            axes=[EnergyAxis(**a) for a in d["axes"]],
+            focal_length=d.get("focal_length"),
+            xeol=d.get("xeol", False),
+        )
+        return self._completed_scan()
+
+    def _autofocus(self, d):
+        focus = autofocus(
+            startpos=d["startpos"],
+            endpos=d["endpos"],
+            numpts=d["numpts"],
+            dwelltime=d["dwelltime"],
+            detector_channel=d["detector_channel"],
+            focus_range=tuple(d.get("focus_range", (-20, 20))),
+            tolerance=d.get("tolerance", 1.0),
+            max_scans=d.get("max_scans", 8),
+        )
+        result = self._completed_scan()
+        result.update(
+            {k: v.tolist() if isinstance(v, np.ndarray) else float(v) for k, v in focus.items()}
+        )
+        return result
+
+    def _adaptive_scan(self, d):
+        adaptive = adaptive_scan(
+            startpos1=d["xmin"],
+            endpos1=d["xmax"],
+            startpos2=d["ymin"],
+            endpos2=d["ymax"],
+            step=d["step"],
+            dwelltime=d["dwelltime"],
+            detector_channel=d.get("detector_channel"),
+            xeol=d.get("xeol", False),
+            coarse_spacing=d.get("coarse_spacing", 8),
+            threshold=d.get("threshold", 0.1),
+            max_points=d.get("max_points"),
+            absolute=d["absolute"],
+        )
+        result = self._completed_scan()
+        result.update({k: v.tolist() for k, v in adaptive.items()})
+        return result
+
+    def _stopped_scan(self, d) -> dict:
+        """Result payload for a scan that may have been ended by a stopping rule"""
+        result = self._completed_scan()
+        if d.get("stopping"):
+            metadata = load_scan_metadata(result["scan_number"])
+            result["npts_completed"] = metadata.get("npts_completed")
+            result["stopped_early"] = bool(metadata.get("stopped_early", False))
+        return result
 
     def _timeseries(self, d):
-        timeseries(numpts=d["numpts"], dwelltime=d["dwelltime"])
-        self._mark_scan_complete()
+        timeseries(
+            numpts=d["numpts"],
+            dwelltime=d["dwelltime"],
+            stopping_rule=make_stopping_rule(d["stopping"]) if d.get("stopping") else None,
+            detector_channel=d.get("detector_channel"),
+        )
+        return self._stopped_scan(d)
 
     def _timeseries_xeol(self, d):
-        timeseries_xeol(numpts=d["numpts"], dwelltime=d["dwelltime"])
-        self._mark_scan_complete()
+        timeseries_xeol(
+            numpts=d["numpts"],
+            dwelltime=d["dwelltime"],
+            stopping_rule=make_stopping_rule(d["stopping"]) if d.get("stopping") else None,
+        )
+        return self._stopped_scan(d)
 
     def _set_transmittance(self, d):
+        self.transmittance = None  # filters may be in an unknown state if this fails partway
         set_transmittance(d["transmittance"])
-        self._mark_scan_complete()
+        self.transmittance = d["transmittance"]
@@ -0,0 +1,78 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+### Binary frames
+# A frame is a 4-byte big-endian header length, a utf-8 json header, then the raw array buffers back to back.
+# The header only carries metadata (names, dtypes, shapes, buffer sizes) - array values are never json encoded.
+HEADER_LENGTH = struct.Struct(">I")
+COMPRESSION_LEVEL = 1  # zlib level. Low levels are much faster and still shrink sparse maps considerably
+
+
+def encode_arrays(arrays: dict, metadata: dict = None, compress: bool = False) -> bytes:
+    """Packs numpy arrays into a single binary websocket frame
+
+    Args:
+        arrays (dict): name: np.ndarray. Arrays must have a numeric (non-object) dtype
+        metadata (dict, optional): json-serializable information to send along with the arrays. Defaults to None.
+        compress (bool, optional): whether to zlib compress each array buffer. Defaults to False.
+
+    Raises:
+        ValueError: an array has an object dtype, which has no binary representation
+
+    Returns:
+        bytes: encoded frame, to be decoded with decode_arrays
+    """
+    header = {
+        "metadata": metadata or {},
+        "compression": "zlib" if compress else None,
+        "arrays": [],
+    }
+    buffers = []
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        if arr.dtype.hasobject:
+            raise ValueError(f"Cannot binary encode array '{name}' of dtype {arr.dtype}")
+        buf = arr.tobytes()
+        if compress:
+            buf = zlib.compress(buf, COMPRESSION_LEVEL)
+        header["arrays"].append(
+            {
+                "name": name,
+                "dtype": arr.dtype.str,  # includes byte order, eg '<f8'
+                "shape": list(arr.shape),
+                "nbytes": len(buf),
+            }
+        )
+        buffers.append(buf)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([HEADER_LENGTH.pack(len(header_bytes)), header_bytes, *buffers])
+
+
+def decode_arrays(frame: bytes):
+    """Unpacks a binary frame created by encode_arrays
+
+    Args:
+        frame (bytes): encoded frame
+
+    Returns:
+        tuple: (metadata dict, dict of name: np.ndarray). Arrays are read-only views into the received buffers, copy them before modifying in place.
+    """
+    (header_length,) = HEADER_LENGTH.unpack_from(frame, 0)
+    offset = HEADER_LENGTH.size
+    header = json.loads(bytes(frame[offset : offset + header_length]).decode("utf-8"))
+    offset += header_length
+
+    view = memoryview(frame)
+    arrays = {}
+    for spec in header["arrays"]:
+        buf = view[offset : offset + spec["nbytes"]]
+        offset += spec["nbytes"]
+        if header["compression"] == "zlib":
+            buf = zlib.decompress(buf)
+        arrays[spec["name"]] = np.frombuffer(buf, dtype=np.dtype(spec["dtype"])).reshape(
+            spec["shape"]
+        )
+    return header["metadata"], arrays
@@ -0,0 +1,700 @@
+import os
+import json
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from ax.service.ax_client import AxClient
+from ax.exceptions.generation_strategy import MaxParallelismReachedException
+
+from s2driver.logging import initialize_logbook
+
+logger = initialize_logbook()
+
+STAGES = ["generate", "measure", "analyze", "complete"]
+
+
+def _atomic_write_json(obj, fpath: str):
+    """Writes json to a temporary file next to fpath, then moves it into place. A crash mid-write leaves the previous file intact."""
+    tmp_fpath = fpath + ".tmp"
+    with open(tmp_fpath, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+
+
+class PipelinedRunner:
+    """Runs an Ax optimization on the beamline as a three stage pipeline. While trial N is measured, trial N-1 is analyzed and completed and trial N+1 is generated, so the beam only waits on the optimizer when fitting takes longer than a measurement.
+
+    Trial N is still running while trial N+1 is generated, so Ax treats it as a pending point. The generation strategy must therefore allow a parallelism of at least 2 (max_parallelism in each GenerationStep).
+
+    Example:
+        client = S2Client()
+        runner = PipelinedRunner(
+            ax_client,
+            measure=lambda p: client.timeseries_xeol(20, p["dwelltime"], block=False),
+            analyze=lambda p, result: evaluate_XEOL(load_xeol(result["scan_number"])),
+        )
+        runner.run(num_trials=30)
+        runner.timing_report()
+
+    With a checkpoint_path, the optimizer state, the scan number of every trial and the requests of trials still being measured are saved after every completion. After a crash, continue the campaign with `PipelinedRunner.resume(checkpoint_path, measure, analyze, client=S2Client())`.
+    """
+
+    def __init__(
+        self,
+        ax_client: AxClient,
+        measure,
+        analyze,
+        checkpoint_path: str = None,
+        client=None,
+    ):
+        """
+        Args:
+            ax_client (AxClient): client with the experiment already created
+            measure (callable): measure(parameters) -> concurrent.futures.Future that resolves to the measurement result, eg a non-blocking S2Client command. Must return quickly, the measurement itself runs on the beamline.
+            analyze (callable): analyze(parameters, result) -> raw_data, as accepted by ax_client.complete_trial
+            checkpoint_path (str, optional): json file to save the campaign to after every completion. Defaults to None (no checkpoints).
+            client (S2Client, optional): client the measurements are issued through. Used to record the scan numbers of running measurements in checkpoints, and to reattach to them on resume. Defaults to None.
+        """
+        self.ax_client = ax_client
+        self.measure = measure
+        self.analyze = analyze
+        self.checkpoint_path = checkpoint_path
+        self.client = client
+        self.timings = []  # one dict per trial, seconds spent in each stage
+        self.results = {}  # trial_index: measurement result
+        self.scan_numbers = {}  # trial_index: scan number of its (final) measurement
+        self._in_flight = {}  # trial_index: {"parameters", "request_id", "scan_number", "fidelity"} of measurements not completed yet
+        self._to_measure = deque()  # (parameters, trial_index, in-flight entry) of recovered trials that must be measured again
+        self._recovered = []  # measurements reattached by resume, completed at the start of the next run
+        self._wall_time = 0
+        self._ax_executor = ThreadPoolExecutor(max_workers=1)  # every Ax call goes through this thread, AxClient is not thread safe
+
+    def run(self, num_trials: int):
+        """Runs num_trials trials through the pipeline. Blocks until all of them are completed.
+
+        Args:
+            num_trials (int): number of trials to measure
+        """
+        t_start = time.time()
+        self._complete_recovered()
+        next_trial = self._ax_executor.submit(self._generate)
+        previous = None  # (trial_index, parameters, measurement future, timing) of the trial being analyzed
+        last_measurement_end = None
+        try:
+            for i in range(num_trials):
+                parameters, trial_index, timing = next_trial.result()  # only blocks if generation is slower than the previous measurement
+
+                t0 = time.time()
+                if last_measurement_end is None:
+                    timing["beam_idle"] = t0 - t_start
+                else:
+                    timing["beam_idle"] = t0 - last_measurement_end
+                measurement = self.measure(parameters)
+                self._track(trial_index, parameters, measurement)
+
+                # analyze N-1 and generate N+1 while N is being measured
+                next_trial = self._ax_executor.submit(
+                    self._complete_and_generate, previous, i + 1 < num_trials
+                )
+                try:
+                    measurement.result()
+                except Exception as e:
+                    logger.error(f"Measurement of trial {trial_index} failed: {e!r}")
+                last_measurement_end = time.time()
+                timing["measure"] = last_measurement_end - t0
+                previous = (trial_index, parameters, measurement, timing)
+            next_trial.result()  # wait for the last generation/completion to finish
+            self._ax_executor.submit(self._complete_and_generate, previous, False).result()
+        finally:
+            self._wall_time += time.time() - t_start
+
+    def _generate(self):
+        t0 = time.time()
+        if self._to_measure:
+            parameters, trial_index, entry = self._to_measure.popleft()  # recovered trial, already known to Ax
+            timing = {"trial_index": trial_index, "generate": 0, "fidelity": entry.get("fidelity")}
+            self.timings.append(timing)
+            return parameters, trial_index, timing
+        try:
+            parameters, trial_index = self.ax_client.get_next_trial()
+        except MaxParallelismReachedException as e:
+            raise MaxParallelismReachedException(
+                "PipelinedRunner keeps one trial pending while generating the next, set max_parallelism >= 2 in the generation strategy"
+            ) from e
+        timing = {"trial_index": trial_index, "generate": time.time() - t0}
+        self.timings.append(timing)
+        return parameters, trial_index, timing
+
+    def _track(self, trial_index: int, parameters: dict, measurement, fidelity: int = None):
+        """Remembers a measurement until it is completed, so checkpoints can reattach to it"""
+        self._in_flight[trial_index] = {
+            "parameters": parameters,
+            "request_id": getattr(measurement, "request_id", None),  # set on S2Client futures
+            "scan_number": None,
+            "fidelity": fidelity,
+        }
+
+    def _finish_tracking(self, trial_index: int, result):
+        self._in_flight.pop(trial_index, None)
+        if isinstance(result, dict) and result.get("scan_number") is not None:
+            self.scan_numbers[trial_index] = result["scan_number"]
+
+    def _complete(self, previous):
+        """Analyzes a measured trial and reports its data (or failure) to Ax"""
+        if previous is None:
+            return
+        trial_index, parameters, measurement, timing = previous
+        if measurement.exception() is not None:
+            self._finish_tracking(trial_index, None)
+            self.ax_client.log_trial_failure(trial_index=trial_index)
+            return
+        result = measurement.result()
+        self.results[trial_index] = result
+        self._finish_tracking(trial_index, result)
+
+        t0 = time.time()
+        try:
+            raw_data = self.analyze(parameters, result)
+        except Exception as e:
+            logger.error(f"Analysis of trial {trial_index} failed: {e!r}")
+            self.ax_client.log_trial_failure(trial_index=trial_index)
+            return
+        t1 = time.time()
+        self.ax_client.complete_trial(trial_index=trial_index, raw_data=raw_data)
+        timing["analyze"] = t1 - t0
+        timing["complete"] = time.time() - t1
+
+    def _complete_and_generate(self, previous, generate: bool):
+        self._complete(previous)
+        if self.checkpoint_path is not None:
+            try:
+                self.save_checkpoint()
+            except Exception as e:
+                logger.error(f"Failed to save checkpoint to {self.checkpoint_path}: {e!r}")
+        if generate:
+            return self._generate()
+
+    def _complete_recovered(self):
+        """Waits for the measurements reattached by resume and completes them"""
+        recovered, self._recovered = self._recovered, []
+        for previous in recovered:
+            self._ax_executor.submit(self._complete_and_generate, previous, False).result()
+
+    def save_checkpoint(self, fpath: str = None):
+        """Saves the optimizer state, the trial -> scan number mapping and the measurements in flight, atomically. Called after every completion when the runner has a checkpoint_path. Only call it yourself between runs, AxClient is not thread safe.
+
+        Args:
+            fpath (str, optional): json file to save to. Defaults to self.checkpoint_path.
+        """
+        fpath = fpath or self.checkpoint_path
+        in_flight = {k: dict(v) for k, v in list(self._in_flight.items())}
+        request_ids = [e["request_id"] for e in in_flight.values() if e["request_id"] is not None]
+        if self.client is not None and len(request_ids) > 0:
+            try:
+                statuses = self.client.get_request_status(request_ids)
+                for entry in in_flight.values():
+                    record = statuses.get(entry["request_id"])
+                    if record is not None and record["scan_number"] is not None:
+                        entry["scan_number"] = record["scan_number"]
+            except Exception as e:
+                logger.warning(f"Could not look up the scan numbers of running measurements: {e!r}")
+        checkpoint = {
+            "ax_client": self.ax_client.to_json_snapshot(),
+            "scan_numbers": self.scan_numbers,
+            "in_flight": in_flight,
+            "timings": self.timings,
+            "state": self._checkpoint_state(),
+            "saved": time.time(),
+        }
+        _atomic_write_json(checkpoint, fpath)
+
+    def _checkpoint_state(self) -> dict:
+        """Runner specific state saved with checkpoints, restored by _restore_state. Must be json serializable."""
+        return {}
+
+    def _restore_state(self, state: dict) -> set:
+        """Restores the state saved by _checkpoint_state
+
+        Returns:
+            set: indices of running trials the restored state already queues for measurement, which resume does not measure again
+        """
+        return set()
+
+    @classmethod
+    def resume(cls, checkpoint_path: str, measure, analyze, client=None, **kwargs):
+        """Restores a campaign from a checkpoint. Measurements that were running when the checkpoint was saved are reattached through the S2Server (by request id, or by scan number if the server was restarted) and completed at the start of the next run. Trials that cannot be reattached are measured again.
+
+        Args:
+            checkpoint_path (str): checkpoint saved by a runner. Also used as the checkpoint_path of the restored runner.
+            measure (callable): see __init__
+            analyze (callable): see __init__
+            client (S2Client, optional): connected client, needed to reattach to running measurements. Defaults to None (measure them again).
+            kwargs: other arguments to the runner's constructor
+
+        Returns:
+            PipelinedRunner: runner that continues the campaign with run()
+        """
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        ax_client = AxClient.from_json_snapshot(checkpoint["ax_client"])
+        runner = cls(
+            ax_client,
+            measure,
+            analyze,
+            checkpoint_path=checkpoint_path,
+            client=client,
+            **kwargs,
+        )
+        runner.scan_numbers = {int(k): v for k, v in checkpoint["scan_numbers"].items()}
+        runner.timings = checkpoint["timings"]
+        in_flight = {int(k): v for k, v in checkpoint["in_flight"].items()}
+        queued = runner._restore_state(checkpoint.get("state", {}))
+
+        for trial_index, trial in ax_client.experiment.trials.items():
+            if not trial.status.is_running or trial_index in queued:
+                continue
+            parameters = trial.arm.parameters
+            entry = in_flight.get(
+                trial_index,
+                {"parameters": parameters, "request_id": None, "scan_number": None, "fidelity": None},
+            )
+            if entry["request_id"] is not None and client is not None:
+                measurement = client.reattach(entry["request_id"], scan_number=entry["scan_number"])
+                if not (measurement.done() and measurement.exception() is not None):
+                    runner._track(trial_index, parameters, measurement, fidelity=entry["fidelity"])
+                    runner._recovered.append(
+                        runner._recovered_measurement(trial_index, parameters, measurement, entry)
+                    )
+                    logger.info(f"Reattached to the measurement of trial {trial_index}")
+                    continue
+            runner._to_measure.append((parameters, trial_index, entry))
+            logger.info(f"Trial {trial_index} could not be reattached, it will be measured again")
+        return runner
+
+    def _recovered_measurement(self, trial_index, parameters, measurement, entry):
+        """Builds the `previous` tuple that _complete expects for a reattached measurement"""
+        timing = {"trial_index": trial_index, "recovered": True}
+        self.timings.append(timing)
+        return (trial_index, parameters, measurement, timing)
+
+    def timing_report(self) -> dict:
+        """Summarizes where the time went across all trials run so far
+
+        Returns:
+            dict: total seconds per stage, total beam idle time, wall time, and the fraction of wall time the beam was idle
+        """
+        report = {
+            stage: sum(t.get(stage, 0) for t in self.timings) for stage in STAGES
+        }
+        report["beam_idle"] = sum(t.get("beam_idle", 0) for t in self.timings)
+        report["wall_time"] = self._wall_time
+        if self._wall_time > 0:
+            report["beam_idle_fraction"] = 1 - report["measure"] / self._wall_time
+        else:
+            report["beam_idle_fraction"] = None
+        return report
+
+
+def _points_in(fidelity: dict) -> int:
+    """Number of scan points of a fidelity level, ie the product of its numpts entries (numpts, numpts1, numpts2...)"""
+    points = 1
+    for key, value in fidelity.items():
+        if key.startswith("numpts"):
+            points *= value
+    return points
+
+
+class FidelityCostModel:
+    """Estimates the beamtime (s) of a measurement at a given fidelity as overhead + per_point * points + exposure, where exposure is points * dwelltime. Refine the coefficients from measured durations with `observe` and `fit`."""
+
+    def __init__(self, overhead: float = 10.0, per_point: float = 0.1):
+        """
+        Args:
+            overhead (float, optional): fixed seconds per scan (setup, background capture, file writing). Defaults to 10.0.
+            per_point (float, optional): seconds of dead time per scan point, on top of the exposure. Defaults to 0.1.
+        """
+        self.coefficients = np.array([overhead, per_point, 1.0])
+        self._observed_features = []
+        self._observed_durations = []
+
+    def features(self, fidelity: dict) -> np.ndarray:
+        points = _points_in(fidelity)
+        exposure = points * fidelity.get("dwelltime", 0) / 1e3  # dwelltime in ms
+        return np.array([1.0, points, exposure])
+
+    def cost(self, fidelity: dict) -> float:
+        """Estimated seconds to measure at this fidelity"""
+        return float(self.features(fidelity) @ self.coefficients)
+
+    def observe(self, fidelity: dict, duration: float):
+        """Records a measured scan duration, to be used by `fit`"""
+        self._observed_features.append(self.features(fidelity))
+        self._observed_durations.append(duration)
+
+    def fit(self, min_observations: int = 3):
+        """Refits the coefficients to the observed durations by least squares. Negative coefficients are clipped to zero.
+
+        Args:
+            min_observations (int, optional): do nothing until at least this many scans were observed. Defaults to 3.
+        """
+        if len(self._observed_durations) < min_observations:
+            return
+        X = np.array(self._observed_features)
+        y = np.array(self._observed_durations)
+        coefficients, *_ = np.linalg.lstsq(X, y, rcond=None)
+        self.coefficients = np.clip(coefficients, 0, None)
+
+
+def _as_mean_sem(raw_data) -> dict:
+    """Normalizes Ax raw data ({metric: mean} or {metric: (mean, sem)}) to {metric: (mean, sem)}"""
+    normalized = {}
+    for metric, value in raw_data.items():
+        if isinstance(value, (tuple, list)):
+            normalized[metric] = (value[0], value[1])
+        else:
+            normalized[metric] = (value, None)
+    return normalized
+
+
+def _serialize_mean_sem(data: dict) -> dict:
+    """{metric: (mean, sem)} as json serializable {metric: [mean, sem]}"""
+    return {metric: [float(mean), None if sem is None else float(sem)] for metric, (mean, sem) in data.items()}
+
+
+class MultiFidelityRunner(PipelinedRunner):
+    """PipelinedRunner that measures every trial at the cheapest fidelity first (eg a timeseries_xeol with few points) and only promotes it to the next fidelity when the surrogate predicts that it is likely enough to improve on the full fidelity results to be worth the beamtime of the promotion (see is_predicted_improvement), or by any other rule passed as `promote`. Unpromoted trials are completed with their low fidelity data, with inflated standard errors so the surrogate trusts them less than full fidelity data.
+
+    Promoted measurements jump the queue: they run before the next newly generated trial, which stays pending in Ax meanwhile. The generation strategy must therefore allow a parallelism of at least 3.
+
+    Example:
+        runner = MultiFidelityRunner(
+            ax_client,
+            measure=lambda p, f: client.timeseries_xeol(f["numpts"], p["dwelltime"], block=False),
+            analyze=lambda p, result: evaluate_XEOL(load_xeol(result["scan_number"])),
+            fidelities=[{"numpts": 5}, {"numpts": 50}],
+        )
+        runner.run(num_trials=30)
+        runner.fidelity_report()
+
+    Checkpoints also hold the promotions waiting to be measured, the fidelity of every completed trial, the full fidelity data the promotion rules compare against and the observed low vs full fidelity discrepancies, so a resumed campaign measures queued promotions instead of starting them over.
+    """
+
+    def __init__(
+        self,
+        ax_client: AxClient,
+        measure,
+        analyze,
+        fidelities: list,
+        cost_model: FidelityCostModel = None,
+        promote=None,
+        min_full_fidelity_trials: int = 3,
+        promotion_sigma: float = 1.0,
+        promotion_threshold: float = 0.2,
+        sem_inflation: float = 3.0,
+        checkpoint_path: str = None,
+        client=None,
+    ):
+        """
+        Args:
+            ax_client (AxClient): client with the experiment already created
+            measure (callable): measure(parameters, fidelity) -> concurrent.futures.Future that resolves to the measurement result. fidelity is one of the fidelities dicts.
+            analyze (callable): analyze(parameters, result) -> raw_data, as accepted by ax_client.complete_trial
+            fidelities (list): fidelity levels, from cheapest to full fidelity, eg [{"numpts": 5}, {"numpts": 50}]. Entries are passed to measure and to the cost model.
+            cost_model (FidelityCostModel, optional): beamtime estimates per fidelity. Defaults to a FidelityCostModel with default coefficients.
+            promote (callable, optional): promote(trial_index, parameters, raw_data, fidelity_level) -> bool, decides whether a trial is measured again at the next fidelity. Defaults to the `is_predicted_improvement` method.
+            min_full_fidelity_trials (int, optional): promote every trial until this many trials have full fidelity data to compare against. Defaults to 3.
+            promotion_sigma (float, optional): slack of is_not_dominated, in low fidelity standard errors. Larger values promote more trials. Defaults to 1.0.
+            promotion_threshold (float, optional): probability of improvement is_predicted_improvement requires for a promotion that costs as much as a full fidelity measurement. Cheaper promotions need proportionally less. Defaults to 0.2.
+            sem_inflation (float, optional): factor applied to the standard errors of trials completed at a lower fidelity. Raw data without a sem gets the observed low vs full fidelity discrepancy instead (see _low_fidelity_sem). Defaults to 3.0.
+            checkpoint_path (str, optional): see PipelinedRunner. Defaults to None.
+            client (S2Client, optional): see PipelinedRunner. Defaults to None.
+        """
+        super().__init__(
+            ax_client, measure, analyze, checkpoint_path=checkpoint_path, client=client
+        )
+        if len(fidelities) == 0:
+            raise ValueError("Must specify at least one fidelity level!")
+        self.fidelities = fidelities
+        self.cost_model = cost_model or FidelityCostModel()
+        self.promote = promote or self.is_predicted_improvement
+        self.min_full_fidelity_trials = min_full_fidelity_trials
+        self.promotion_sigma = promotion_sigma
+        self.promotion_threshold = promotion_threshold
+        self.sem_inflation = sem_inflation
+        self.fidelity_of = {}  # trial_index: fidelity level the trial was completed at
+        self._full_fidelity_data = []  # {metric: (mean, sem)} of trials completed at full fidelity
+        self._promoted_data = {}  # trial_index: {fidelity level: {metric: (mean, sem)}} of promoted trials not yet at full fidelity
+        self._discrepancies = {}  # fidelity level: {metric: [low fidelity mean - full fidelity mean]}
+        self._promotions = deque()  # (trial_index, parameters, fidelity level) waiting to be measured
+
+    @property
+    def _full_level(self) -> int:
+        return len(self.fidelities) - 1
+
+    def _objectives(self) -> list:
+        """(metric name, minimize) of each objective of the experiment"""
+        objective = self.ax_client.experiment.optimization_config.objective
+        objectives = getattr(objective, "objectives", [objective])
+        return [(o.metric.name, o.minimize) for o in objectives]
+
+    def is_not_dominated(self, trial_index, parameters, raw_data, fidelity_level) -> bool:
+        """Fallback promotion rule of is_predicted_improvement while Ax has no model, a dominance check against the observed full fidelity results. A low fidelity result is promoted unless some full fidelity result is better on every objective, by more than promotion_sigma low fidelity standard errors (or strictly better, if no sem is reported).
+
+        Returns:
+            bool: whether to measure the trial at the next fidelity
+        """
+        if len(self._full_fidelity_data) < self.min_full_fidelity_trials:
+            return True
+        low = _as_mean_sem(raw_data)
+        objectives = self._objectives()
+        for full in self._full_fidelity_data:
+            dominated = True
+            for metric, minimize in objectives:
+                mean, sem = low[metric]
+                slack = self.promotion_sigma * (sem or 0)
+                if minimize:
+                    better = full[metric][0] < mean - slack
+                else:
+                    better = full[metric][0] > mean + slack
+                if not better:
+                    dominated = False
+                    break
+            if dominated:
+                return False
+        return True
+
+    def _predict(self, parameters) -> dict:
+        """Surrogate {metric: (mean, sem)} of every objective at parameters, or None while Ax has no model to predict with (eg during the initial Sobol steps)"""
+        try:
+            return self.ax_client.get_model_predictions_for_parameterizations(
+                parameterizations=[parameters],
+                metric_names=[metric for metric, _ in self._objectives()],
+            )[0]
+        except Exception as e:
+            logger.debug(f"No surrogate prediction available: {e!r}")
+            return None
+
+    def is_predicted_improvement(self, trial_index, parameters, raw_data, fidelity_level) -> bool:
+        """Default promotion rule. Combines the surrogate prediction at the trial's parameters with its low fidelity result (weighted by their standard errors) into the probability that the trial beats the best full fidelity result on at least one objective. The trial is promoted if that probability is at least promotion_threshold * cost of the next fidelity level / cost of a full fidelity measurement, using the cost model. Falls back to is_not_dominated while Ax cannot predict yet.
+
+        Returns:
+            bool: whether to measure the trial at the next fidelity
+        """
+        if len(self._full_fidelity_data) < self.min_full_fidelity_trials:
+            return True
+        prediction = self._predict(parameters)
+        if prediction is None:
+            return self.is_not_dominated(trial_index, parameters, raw_data, fidelity_level)
+        low = self._inflate_sem(raw_data, fidelity_level)
+
+        probability = 0
+        for metric, minimize in self._objectives():
+            mean, sem = prediction[metric]
+            low_mean, low_sem = low[metric]
+            if low_sem and sem:
+                weight = sem**2 / (sem**2 + low_sem**2)
+                mean = mean + weight * (low_mean - mean)
+                sem = sem * low_sem / math.sqrt(sem**2 + low_sem**2)
+            observed = [full[metric][0] for full in self._full_fidelity_data]
+            best = min(observed) if minimize else max(observed)
+            improvement = best - mean if minimize else mean - best
+            if sem:
+                p = 0.5 * (1 + math.erf(improvement / (sem * math.sqrt(2))))
+            else:
+                p = float(improvement > 0)
+            probability = max(probability, p)
+
+        cost = self.cost_model.cost(self.fidelities[fidelity_level + 1])
+        full_cost = self.cost_model.cost(self.fidelities[-1])
+        threshold = self.promotion_threshold * cost / full_cost
+        logger.debug(
+            f"Trial {trial_index}: probability of improvement {probability:.3f}, promotion threshold {threshold:.3f}"
+        )
+        return probability >= threshold
+
+    def _low_fidelity_sem(self, metric: str, level: int):
+        """Standard error assumed for low fidelity data that reports none: the root mean square discrepancy between low and full fidelity results of promoted trials at this level, or, until two such pairs exist, the spread of the full fidelity results. None if neither is available yet."""
+        discrepancies = self._discrepancies.get(level, {}).get(metric, [])
+        if len(discrepancies) >= 2:
+            return float(np.sqrt(np.mean(np.square(discrepancies))))
+        observed = [full[metric][0] for full in self._full_fidelity_data if metric in full]
+        if len(observed) >= 2:
+            return float(np.std(observed, ddof=1))
+        return None
+
+    def _inflate_sem(self, raw_data, level: int) -> dict:
+        inflated = {}
+        for metric, (mean, sem) in _as_mean_sem(raw_data).items():
+            if sem is None:
+                inflated[metric] = (mean, self._low_fidelity_sem(metric, level))
+            else:
+                inflated[metric] = (mean, sem * self.sem_inflation)
+        return inflated
+
+    def run(self, num_trials: int):
+        """Runs num_trials trials through the pipeline, measuring promoted trials again at higher fidelities as they come up. Blocks until all of them are completed.
+
+        Args:
+            num_trials (int): number of new trials to generate
+        """
+        t_start = time.time()
+        self._complete_recovered()
+        ready = deque()  # generated trials waiting to be measured
+        ax_task = self._ax_executor.submit(self._generate)
+        n_generated = 1
+        previous = None  # (trial_index, parameters, measurement future, timing, fidelity level) of the measurement being analyzed
+        last_measurement_end = None
+        try:
+            while True:
+                generated = ax_task.result()  # previous trial is analyzed, so any promotion is known now
+                if generated is not None:
+                    ready.append(generated)
+
+                if self._promotions:
+                    trial_index, parameters, level = self._promotions.popleft()
+                    timing = {"trial_index": trial_index}
+                    self.timings.append(timing)
+                elif ready:
+                    parameters, trial_index, timing = ready.popleft()
+                    level = timing.get("fidelity") or 0  # recovered trials restart at the fidelity they were at
+                elif previous is not None:
+                    # nothing left to measure, but the last measurement may still be promoted
+                    ax_task = self._ax_executor.submit(self._complete_and_generate, previous, False)
+                    previous = None
+                    continue
+                else:
+                    break
+                timing["fidelity"] = level
+
+                t0 = time.time()
+                if last_measurement_end is None:
+                    timing["beam_idle"] = t0 - t_start
+                else:
+                    timing["beam_idle"] = t0 - last_measurement_end
+                measurement = self.measure(parameters, self.fidelities[level])
+                self._track(trial_index, parameters, measurement, fidelity=level)
+
+                generate = not ready and n_generated < num_trials
+                n_generated += generate
+                ax_task = self._ax_executor.submit(self._complete_and_generate, previous, generate)
+                try:
+                    measurement.result()
+                except Exception as e:
+                    logger.error(f"Measurement of trial {trial_index} failed: {e!r}")
+                last_measurement_end = time.time()
+                timing["measure"] = last_measurement_end - t0
+                previous = (trial_index, parameters, measurement, timing, level)
+        finally:
+            self._wall_time += time.time() - t_start
+
+    def _complete(self, previous):
+        """Analyzes a measurement, then either queues the trial for the next fidelity or reports its data (or failure) to Ax"""
+        if previous is None:
+            return
+        trial_index, parameters, measurement, timing, level = previous
+        if measurement.exception() is not None:
+            self._finish_tracking(trial_index, None)
+            self.ax_client.log_trial_failure(trial_index=trial_index)
+            return
+        result = measurement.result()
+        self.results[trial_index] = result
+        self._finish_tracking(trial_index, result)
+        if isinstance(result, dict) and result.get("duration") is not None:
+            self.cost_model.observe(self.fidelities[level], result["duration"])
+            self.cost_model.fit()
+
+        t0 = time.time()
+        try:
+            raw_data = self.analyze(parameters, result)
+        except Exception as e:
+            logger.error(f"Analysis of trial {trial_index} failed: {e!r}")
+            self.ax_client.log_trial_failure(trial_index=trial_index)
+            return
+        t1 = time.time()
+        timing["analyze"] = t1 - t0
+
+        if level < self._full_level and self.promote(trial_index, parameters, raw_data, level):
+            logger.info(f"Promoting trial {trial_index} to fidelity level {level + 1}")
+            self._promoted_data.setdefault(trial_index, {})[level] = _as_mean_sem(raw_data)
+            self._promotions.append((trial_index, parameters, level + 1))
+            return
+        if level < self._full_level:
+            raw_data = self._inflate_sem(raw_data, level)
+        else:
+            full = _as_mean_sem(raw_data)
+            self._full_fidelity_data.append(full)
+            for low_level, low in self._promoted_data.pop(trial_index, {}).items():
+                discrepancies = self._discrepancies.setdefault(low_level, {})
+                for metric, (mean, _) in low.items():
+                    if metric in full:
+                        discrepancies.setdefault(metric, []).append(mean - full[metric][0])
+        self._promoted_data.pop(trial_index, None)
+        self.ax_client.complete_trial(trial_index=trial_index, raw_data=raw_data)
+        self.fidelity_of[trial_index] = level
+        timing["complete"] = time.time() - t1
+
+    def _checkpoint_state(self) -> dict:
+        """Promotions waiting to be measured, the fidelity each trial was completed at, the full fidelity data the promotion rules compare against, and the low fidelity results and discrepancies _low_fidelity_sem estimates from"""
+        return {
+            "promotions": [list(p) for p in list(self._promotions)],
+            "fidelity_of": self.fidelity_of,
+            "full_fidelity_data": [_serialize_mean_sem(data) for data in self._full_fidelity_data],
+            "promoted_data": {
+                trial_index: {level: _serialize_mean_sem(data) for level, data in levels.items()}
+                for trial_index, levels in self._promoted_data.items()
+            },
+            "discrepancies": {
+                level: {metric: [float(d) for d in values] for metric, values in metrics.items()}
+                for level, metrics in self._discrepancies.items()
+            },
+        }
+
+    def _restore_state(self, state: dict) -> set:
+        self._promotions = deque(
+            (int(trial_index), parameters, int(level)) for trial_index, parameters, level in state.get("promotions", [])
+        )
+        self.fidelity_of = {int(k): v for k, v in state.get("fidelity_of", {}).items()}
+        self._full_fidelity_data = [
+            {metric: tuple(value) for metric, value in data.items()} for data in state.get("full_fidelity_data", [])
+        ]
+        self._promoted_data = {
+            int(trial_index): {
+                int(level): {metric: tuple(value) for metric, value in data.items()} for level, data in levels.items()
+            }
+            for trial_index, levels in state.get("promoted_data", {}).items()
+        }
+        self._discrepancies = {int(level): metrics for level, metrics in state.get("discrepancies", {}).items()}
+        return {trial_index for trial_index, _, _ in self._promotions}
+
+    def _recovered_measurement(self, trial_index, parameters, measurement, entry):
+        timing = {"trial_index": trial_index, "recovered": True, "fidelity": entry.get("fidelity") or 0}
+        self.timings.append(timing)
+        return (trial_index, parameters, measurement, timing, timing["fidelity"])
+
+    def fidelity_report(self) -> dict:
+        """Summarizes the beamtime spent at each fidelity level
+
+        Returns:
+            dict: per fidelity level, the number of measurements, the measured seconds, and the estimated cost of one measurement. Also the estimated seconds saved by not measuring every trial at full fidelity.
+        """
+        report = {}
+        for level, fidelity in enumerate(self.fidelities):
+            measured = [t["measure"] for t in self.timings if t.get("fidelity") == level and "measure" in t]
+            report[level] = {
+                "fidelity": fidelity,
+                "measurements": len(measured),
+                "beamtime": sum(measured),
+                "estimated_cost": self.cost_model.cost(fidelity),
+            }
+        full_cost = self.cost_model.cost(self.fidelities[-1])
+        report["estimated_savings"] = sum(
+            full_cost - sum(self.cost_model.cost(self.fidelities[l]) for l in range(level + 1))
+            for level in self.fidelity_of.values()
+            if level < self._full_level
+        )
+        return report
@@ -0,0 +1,168 @@
+import numpy as np
+
+from s2driver.filters import TRANSMITTANCE_TO_FILTERS, find_nearest_transmittance
+
+### Default transition costs
+# Rough starting points, in seconds per unit change. Refine them from measured timings with TransitionCostModel.fit
+DEFAULT_WEIGHTS = {
+    "samx": 0.01,  # s/um
+    "samy": 0.01,  # s/um
+    "samz": 0.01,  # s/um
+    "dwelltime": 0.0,  # s/ms, changing the dwell time is a single caput
+}
+DEFAULT_FILTER_COST = 2.0  # s per filter inserted or removed
+DEFAULT_OVERHEAD = 0.0  # s per transition, regardless of what changes
+
+
+def _filters_for(transmittance) -> set:
+    if transmittance is None:
+        return set()
+    return set(TRANSMITTANCE_TO_FILTERS[find_nearest_transmittance(transmittance)])
+
+
+class TransitionCostModel:
+    """Estimates the seconds needed to switch the beamline between two states. A state is a dict such as {"samx": 10.0, "samy": -3.0, "transmittance": 0.5, "dwelltime": 100}; keys that are missing from either state are treated as unchanged.
+
+    The estimate is linear in a feature vector [1, |change| per weighted key..., number of filter actuations]. Subclass and override `features` (or `cost`) to plug in a different model.
+    """
+
+    def __init__(
+        self,
+        weights: dict = None,
+        filter_cost: float = DEFAULT_FILTER_COST,
+        overhead: float = DEFAULT_OVERHEAD,
+    ):
+        """
+        Args:
+            weights (dict, optional): seconds per unit change for each state key. Defaults to DEFAULT_WEIGHTS.
+            filter_cost (float, optional): seconds per filter actuation. Defaults to DEFAULT_FILTER_COST.
+            overhead (float, optional): fixed seconds per transition. Defaults to DEFAULT_OVERHEAD.
+        """
+        weights = weights or DEFAULT_WEIGHTS
+        self.keys = list(weights.keys())
+        self.coefficients = np.array([overhead, *weights.values(), filter_cost], dtype=float)
+        self._observed_features = []
+        self._observed_durations = []
+
+    def features(self, state_from: dict, state_to: dict) -> np.ndarray:
+        deltas = []
+        for key in self.keys:
+            if state_from.get(key) is None or state_to.get(key) is None:
+                deltas.append(0.0)
+            else:
+                deltas.append(abs(state_to[key] - state_from[key]))
+        if "transmittance" in state_to:
+            filter_changes = len(
+                _filters_for(state_from.get("transmittance"))
+                ^ _filters_for(state_to["transmittance"])
+            )
+        else:
+            filter_changes = 0
+        return np.array([1.0, *deltas, filter_changes])
+
+    def cost(self, state_from: dict, state_to: dict) -> float:
+        """Estimated seconds to go from state_from to state_to"""
+        return float(self.features(state_from, state_to) @ self.coefficients)
+
+    def cost_matrix(self, states: list) -> np.ndarray:
+        """Estimated transition costs between all pairs of states. Entry [i, j] is the cost of going from states[i] to states[j]."""
+        n = len(states)
+        features = np.array(
+            [self.features(a, b) for a in states for b in states]
+        ).reshape(n, n, -1)
+        costs = features @ self.coefficients
+        np.fill_diagonal(costs, 0)
+        return costs
+
+    def observe(self, state_from: dict, state_to: dict, duration: float):
+        """Records a measured transition, to be used by `fit`
+
+        Args:
+            state_from (dict): state before the transition
+            state_to (dict): state after the transition
+            duration (float): measured seconds, eg the "duration" of the S2Client results of the commands that made the transition
+        """
+        self._observed_features.append(self.features(state_from, state_to))
+        self._observed_durations.append(duration)
+
+    def fit(self, min_observations: int = None):
+        """Refits the coefficients to the observed transitions by least squares. Negative coefficients are clipped to zero.
+
+        Args:
+            min_observations (int, optional): do nothing until at least this many transitions were observed. Defaults to the number of coefficients.
+        """
+        if min_observations is None:
+            min_observations = len(self.coefficients)
+        if len(self._observed_durations) < min_observations:
+            return
+        X = np.array(self._observed_features)
+        y = np.array(self._observed_durations)
+        coefficients, *_ = np.linalg.lstsq(X, y, rcond=None)
+        self.coefficients = np.clip(coefficients, 0, None)
+
+
+def trial_to_state(parameters: dict, parameter_map: dict = None) -> dict:
+    """Converts trial parameters to a beamline state
+
+    Args:
+        parameters (dict): trial parameters, eg from ax_client.get_next_trials
+        parameter_map (dict, optional): parameter name: state key, for parameters whose names differ from the state keys, eg {"filter_transmittance": "transmittance"}. Defaults to None.
+
+    Returns:
+        dict: beamline state
+    """
+    parameter_map = parameter_map or {}
+    return {parameter_map.get(k, k): v for k, v in parameters.items()}
+
+
+def order_trials(
+    candidates: list,
+    current_state: dict,
+    cost_model: TransitionCostModel = None,
+    parameter_map: dict = None,
+):
+    """Orders a batch of candidate trials to minimize the estimated total transition cost, starting from the current beamline state. Uses a nearest neighbour tour refined by 2-opt.
+
+    Args:
+        candidates (list): trial parameter dicts
+        current_state (dict): current beamline state, eg from S2Client.get_state
+        cost_model (TransitionCostModel, optional): transition cost estimates. Defaults to a TransitionCostModel with default weights.
+        parameter_map (dict, optional): see trial_to_state. Defaults to None.
+
+    Returns:
+        tuple: (list of candidate indices in the order they should be run, estimated total transition cost in seconds)
+    """
+    if cost_model is None:
+        cost_model = TransitionCostModel()
+    if len(candidates) == 0:
+        return [], 0.0
+    states = [current_state] + [trial_to_state(c, parameter_map) for c in candidates]
+    costs = cost_model.cost_matrix(states)
+
+    # nearest neighbour from the current state (node 0)
+    path = [0]
+    remaining = np.ones(len(states), dtype=bool)
+    remaining[0] = False
+    while remaining.any():
+        candidates_costs = np.where(remaining, costs[path[-1]], np.inf)
+        nxt = int(np.argmin(candidates_costs))
+        path.append(nxt)
+        remaining[nxt] = False
+    path = np.array(path)
+
+    # 2-opt, keeping the start fixed. Costs may be asymmetric so whole paths are compared
+    def path_cost(p):
+        return costs[p[:-1], p[1:]].sum()
+
+    best = path_cost(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                candidate = np.concatenate([path[:i], path[i : j + 1][::-1], path[j + 1 :]])
+                c = path_cost(candidate)
+                if c < best - 1e-9:
+                    path, best = candidate, c
+                    improved = True
+    return [int(i) - 1 for i in path[1:]], float(best)
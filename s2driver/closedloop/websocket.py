@@ -1,10 +1,12 @@
 import asyncio
 import websockets
+from collections import deque
 from threading import Thread
 from abc import ABC, abstractmethod
 from functools import partial
 
 PORT = 8765  # not chosen for any particular reason, just needs to match between Server and Client
+MAX_BUFFERED_MESSAGES = 256  # per connection. Beyond this, the oldest droppable messages (eg progress, logs) are discarded for that connection
 
 
 def future_callback(source, future):
@@ -22,10 +24,9 @@ class WebsocketBase(ABC):
         # self.loop.run_until_complete(client_main())
 
     async def consumer_handler(self, websocket):
-        while self.running:
-            async for message in websocket:
-                # print(f"{self} received: {message}")
-                self._process_message(message)
+        async for message in websocket:  # ends when the connection closes
+            # print(f"{self} received: {message}")
+            self._process_message(message)
 
     async def producer_handler(self, websocket):
         while self.running:
@@ -108,37 +109,132 @@ class Client(WebsocketBase):
                 [consumer_task, producer_task],
                 return_when=asyncio.FIRST_COMPLETED,
             )
+            for task in pending:
+                task.cancel()
+        self._on_disconnect()
+
+    def _on_disconnect(self):
+        """Called on the event loop thread when the connection to the server is lost"""
+        pass
+
+
+class Connection:
+    """A client connected to a Server. Every connection buffers its own outgoing messages, so a slow client only delays itself, never the other clients."""
+
+    def __init__(self, websocket, max_buffered: int = MAX_BUFFERED_MESSAGES):
+        self.websocket = websocket
+        self.max_buffered = max_buffered
+        self.topics = set()  # topics this client subscribed to, see Server.publish
+        self.dropped = 0  # number of droppable messages discarded because this client fell behind
+        self._buffer = deque()  # (message, droppable)
+        self._ready = asyncio.Event()
+
+    def put(self, msg, droppable: bool = False):
+        """Buffers a message for this client. Must be called from the event loop thread.
+
+        Args:
+            msg (str or bytes): message to send
+            droppable (bool, optional): whether the message may be discarded if the buffer is full. Messages that are not droppable (eg command responses) are always delivered. Defaults to False.
+        """
+        self._buffer.append((msg, droppable))
+        if len(self._buffer) > self.max_buffered:
+            for i, (_, is_droppable) in enumerate(self._buffer):
+                if is_droppable:
+                    del self._buffer[i]
+                    self.dropped += 1
+                    break
+        self._ready.set()
+
+    async def producer_handler(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while len(self._buffer) > 0:
+                msg, _ = self._buffer.popleft()
+                await self.websocket.send(msg)
 
 
 class Server(WebsocketBase):
-    """This is the Maestro side"""
+    """This is the Maestro side. Accepts any number of client connections."""
 
     def __init__(self):
+        self.connections = set()
         super().__init__()
         self.start()
         # self.loop.run_until_complete(client_main())
 
-    async def server_handler(self, websocket, path):
-        consumer_task = asyncio.create_task(self.consumer_handler(websocket))
-        producer_task = asyncio.create_task(self.producer_handler(websocket))
+    async def consumer_handler(self, websocket, connection: Connection):
+        async for message in websocket:
+            self._process_message(message, connection)
+
+    async def server_handler(self, websocket, path=None):
+        connection = Connection(websocket)
+        self.connections.add(connection)
+        self._on_connect(connection)
+        consumer_task = asyncio.create_task(self.consumer_handler(websocket, connection))
+        producer_task = asyncio.create_task(connection.producer_handler())
         for future in [consumer_task, producer_task]:
             future.add_done_callback(partial(future_callback, self))
         done, pending = await asyncio.wait(
             [consumer_task, producer_task],
             return_when=asyncio.FIRST_COMPLETED,
         )
-        self.running = False
-        # print(f"{self} done, {pending} pending")
-        # for task in pending:
-        #     task.cancel()
-        # consumer_task = self.loop.call_soon_threadsafe(self.consumer_handler, websocket)
-        # producer_task = self.loop.call_soon_threadsafe(self.producer_handler, websocket)
-        # done, pending = await asyncio.wait(
-        #     [consumer_task, producer_task],
-        #     return_when=self.loop.FIRST_COMPLETED,
-        # )
-        # for task in pending:
-        #     task.cancel()
+        for task in pending:
+            task.cancel()
+        self.connections.discard(connection)
+        self._on_disconnect(connection)
+
+    def _on_connect(self, connection: Connection):
+        """Called on the event loop thread when a client connects"""
+        pass
+
+    def _on_disconnect(self, connection: Connection):
+        """Called on the event loop thread when a client disconnects"""
+        pass
+
+    def send(self, msg, connection: Connection = None, droppable: bool = False):
+        """Sends a message to one client, or to all connected clients
+
+        Args:
+            msg (str or bytes): message. Strings are sent as text frames, bytes as binary frames
+            connection (Connection, optional): client to send to. Defaults to None (all clients).
+            droppable (bool, optional): whether the message may be discarded for clients that fall behind. Defaults to False.
+
+        Raises:
+            Exception: Can only send when websocket is running
+        """
+        if not self.running:
+            raise Exception("Server is not running, cannot add message to queue!")
+        self.loop.call_soon_threadsafe(
+            self._deliver, msg, connection, None, droppable, None
+        )
+
+    def publish(self, topic: str, msg, droppable: bool = False, exclude: Connection = None):
+        """Sends a message to all clients subscribed to a topic
+
+        Args:
+            topic (str): topic of the message
+            msg (str or bytes): message
+            droppable (bool, optional): whether the message may be discarded for clients that fall behind. Defaults to False.
+            exclude (Connection, optional): client to skip, eg the one that already received the message directly. Defaults to None.
+        """
+        if not self.running:
+            raise Exception("Server is not running, cannot add message to queue!")
+        self.loop.call_soon_threadsafe(
+            self._deliver, msg, None, topic, droppable, exclude
+        )
+
+    def _deliver(self, msg, connection, topic, droppable, exclude):
+        if connection is not None:
+            targets = [connection] if connection in self.connections else []
+        else:
+            targets = [
+                c
+                for c in self.connections
+                if (topic is None or topic in c.topics) and c is not exclude
+            ]
+        for target in targets:
+            target.put(msg, droppable=droppable)
 
     async def _main(self):
         async with websockets.serve(self.server_handler, "localhost", PORT) as server:
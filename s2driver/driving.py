@@ -12,6 +12,14 @@ from s2driver.filters import (
     find_nearest_transmittance,
 )
 from s2driver.xeol.xeol import XEOLController
+from s2driver.stopping import StoppingRule
+from s2driver.scanindex import write_scan_metadata, load_scan_metadata
+from s2driver.trajectories import split_trajectory, masked_serpentine
+from s2driver.routing import TravelTimeModel, optimize_route, route_time, DEFAULT_SETTLE
+from s2driver.adaptive import AdaptiveGrid
+from s2driver.mosaic import plan_mosaic, tile_extent
+from s2driver.energy import MONO_AXIS, energy_table
+from s2driver.focus import edge_widths, golden_section_search
 import numpy as np
 
 logger = initialize_logbook()
@@ -89,7 +97,8 @@ MOVEMENT_THRESHOLD = {
 }  # movements that change motor positions by greater than this threshold amount will require user confirmation to proceed
 
 ### Scanners
-sc1 = epics.devices.Scan("2idd:scan1")
+SC1_PREFIX = "2idd:scan1"  # also the target of sc2's positioners in serpentine scans
+sc1 = epics.devices.Scan(SC1_PREFIX)
 sc2 = epics.devices.Scan("2idd:scan2")
 flyh = epics.devices.Scan("2idd:FscanH")
 fly1 = epics.devices.Scan("2idd:Fscan1")
@@ -103,6 +112,11 @@ CANCEL_PVS = {
 ### XEOL
 xeol_controller = XEOLController()
 
+### Progress reporting
+SCAN_POLL_INTERVAL = 0.2  # seconds between checks on a running scan
+NEXT_SCAN_TIMEOUT = 60  # seconds to wait for saveData to finalize a scan before starting the next one
+PROGRESS_CALLBACKS = []  # functions called with the progress of running scans, see add_progress_callback
+
 ### Single-Action Commands
 def _check_for_huge_movement(motor: epics.Motor, target_position: float):
     """Checks if the movement step requested by the user is suspiciously large
@@ -114,9 +128,12 @@ def _check_for_huge_movement(motor: epics.Motor, target_position: float):
     Raises:
         Exception: The motor step was put in incorrectly, and the movement was aborted.
     """
+    threshold = MOVEMENT_THRESHOLD.get(motor)
+    if threshold is None:  # no threshold set for this motor
+        return
     current_position = motor.VAL  # current setpoint
     delta = abs(target_position - current_position)
-    if delta > MOVEMENT_THRESHOLD[motor]:
+    if delta > threshold:
         response = input(
             f"You asked to move {motor} by {delta:.2f} (from {current_position} to {target_position} - is that correct? (y/n)"
         )
@@ -240,6 +257,15 @@ def get_next_scan_number() -> int:
     return PVS["next_scan"].value
 
 
+def _wait_for_next_scan_number(previous: int, timeout: float = NEXT_SCAN_TIMEOUT):
+    """Waits until saveData has finalized scan previous and moved on to the next scan number"""
+    t0 = time.time()
+    while get_next_scan_number() <= previous:
+        if time.time() - t0 > timeout:
+            raise TimeoutError(f"Scan {previous} was not finalized within {timeout} s!")
+        time.sleep(0.1)
+
+
 ### Scanning Commands
 def prescan(*args, **kwargs) -> bool:
     """Checks whether a scan is valid.
@@ -339,36 +365,152 @@ def _set_scanner(
     )
 
 
-def _execute_scan(scanner: epics.devices.Scan, scantype: str):
+def add_progress_callback(func):
+    """Registers a function to be called periodically while scans run
+
+    Args:
+        func (callable): called with a progress dict (see _report_progress) every SCAN_POLL_INTERVAL seconds during a scan, and once more when the scan finishes. Must be fast, it runs in the thread that tracks the scan.
+    """
+    if func not in PROGRESS_CALLBACKS:
+        PROGRESS_CALLBACKS.append(func)
+
+
+def remove_progress_callback(func):
+    """Unregisters a function added with add_progress_callback"""
+    if func in PROGRESS_CALLBACKS:
+        PROGRESS_CALLBACKS.remove(func)
+
+
+def _report_progress(
+    scanner: epics.devices.Scan,
+    scannum: int,
+    scantype: str,
+    current_point: int,
+    npts: int,
+    t0: float,
+    finished: bool = False,
+    aborted: bool = False,
+):
+    """Passes the progress of a running scan to all registered progress callbacks
+
+    Args:
+        scanner (epics.devices.Scan): scanner whose progress is being tracked (the outer scanner for 2d scans)
+        scannum (int): scan number
+        scantype (str): type of scan, as logged by _execute_scan
+        current_point (int): number of completed points (lines for 2d scans)
+        npts (int): total number of points (lines for 2d scans)
+        t0 (float): time.time() at which the scan started
+        finished (bool, optional): whether the scan has ended. Defaults to False.
+        aborted (bool, optional): whether the scan was canceled before completing. Defaults to False.
+    """
+    elapsed = time.time() - t0
+    if current_point > 0:
+        remaining = elapsed / current_point * (npts - current_point)
+    else:
+        remaining = None  # no rate estimate before the first point completes
+    progress = {
+        "scanner": scanner,
+        "scan_number": scannum,
+        "scantype": scantype,
+        "cpt": current_point,
+        "npts": npts,
+        "elapsed": elapsed,
+        "remaining": remaining,
+        "finished": finished,
+        "aborted": aborted,
+    }
+    for func in list(PROGRESS_CALLBACKS):
+        try:
+            func(progress)
+        except Exception as e:
+            logger.debug("Progress callback %s failed: %s", func, e)
+
+
+def _execute_scan(scanner: epics.devices.Scan, scantype: str, stop_condition=None) -> dict:
     """Executes a scan. Blocks and prints a progress bar for the scan. Will unblock when scan is complete.
 
     Args:
         scanner (epics.devices.Scan): scanner object to track progress of
+        scantype (str): type of scan, used for logging and progress reports
+        stop_condition (callable, optional): stop_condition(current_point) -> bool, checked every SCAN_POLL_INTERVAL while the scan runs. The scan is aborted once it returns True. Defaults to None.
+
+    Returns:
+        dict: {"npts_completed": number of completed points (lines for 2d scans), "stopped_early": whether stop_condition ended the scan, "aborted": whether the scan was canceled with ctrl-c}
     """
     npts = scanner.NPTS
     scannum = get_next_scan_number()
     open_shutter()
+    t0 = time.time()
+    current_point = 0
+    stopped_early = False
+    aborted = False
     try:
         scanner.execute = 1  # start the scan
         logger.info("Started %s %i", scantype, scannum)
         with tqdm(total=npts, desc=f"Scan {scannum}") as pbar:
             while scanner.BUSY == 0:
                 time.sleep(0.1)  # wait for scan to begin
-            current_point = 0
+            t0 = time.time()
             while scanner.BUSY == 1:
                 if scanner.CPT != current_point:
                     current_point = scanner.CPT
                     pbar.n = current_point  # update progress bar to current number of points completed
                     pbar.display()
-                time.sleep(1)
-            pbar.n = npts  # complete the progress bar
+                    if (
+                        stop_condition is not None
+                        and not stopped_early
+                        and stop_condition(current_point)
+                    ):
+                        CANCEL_PVS[scanner].put(1)
+                        stopped_early = True
+                        logger.info(
+                            "Stopping rule converged, stopped %s %i after %i/%i points",
+                            scantype,
+                            scannum,
+                            current_point,
+                            npts,
+                        )
+                _report_progress(scanner, scannum, scantype, current_point, npts, t0)
+                time.sleep(SCAN_POLL_INTERVAL)
+            if not stopped_early:
+                current_point = npts
+            pbar.n = current_point  # complete the progress bar
             pbar.display()
+        _report_progress(scanner, scannum, scantype, current_point, npts, t0, finished=True)
     except KeyboardInterrupt:
         cancel = CANCEL_PVS.get(scanner, None)
         if cancel is not None:
             cancel.put(1)
         logger.info(f"Scan {scannum} canceled using ctrl-c!")
+        aborted = True
+        _report_progress(
+            scanner, scannum, scantype, current_point, npts, t0, finished=True, aborted=True
+        )
     close_shutter()
+    return {"npts_completed": current_point, "stopped_early": stopped_early, "aborted": aborted}
+
+
+def _stopping_condition(stopping_rule: StoppingRule, read_points):
+    """Builds a stop_condition for _execute_scan that feeds each newly completed point to a stopping rule
+
+    Args:
+        stopping_rule (StoppingRule): rule to evaluate
+        read_points (callable): read_points(first, last) -> values of the completed points [first, last)
+
+    Returns:
+        callable: stop_condition(current_point) -> bool
+    """
+    fed = 0
+
+    def stop_condition(current_point: int) -> bool:
+        nonlocal fed
+        if current_point <= fed:
+            return False
+        values = read_points(fed, current_point)
+        fed = current_point
+        return stopping_rule.update(values)
+
+    return stop_condition
 
 
 @scan_moderator
@@ -453,6 +595,50 @@ def scan1d_xeol(
     xeol_thread.join()  # will join when xeol data has been saved to file
 
 
+def _set_serpentine(motor1: epics.Motor, numpts2: int) -> dict:
+    """Makes a 2d step scan bidirectional. sc2's second and third positioners write sc1's start and end positions from lookup tables before every line, swapping them on odd lines. sc1 stays where each line ends (PASM=STAY) instead of moving back, and its positions are made absolute so the lines do not walk along with motor1. Call after sc1 and sc2 are set up.
+
+    Args:
+        motor1 (epics.Motor): motor scanned by sc1
+        numpts2 (int): number of lines (sc2 points)
+
+    Returns:
+        dict: sc1's settings and motor1's position before the scan, to pass to _clear_serpentine
+    """
+    saved = {
+        "origin": motor1.VAL,
+        "PASM": sc1.PASM,
+        "P1AR": sc1.P1AR,
+        "P1SP": sc1.P1SP,
+        "P1EP": sc1.P1EP,
+    }
+    start, end = saved["P1SP"], saved["P1EP"]
+    if saved["P1AR"] == 1:  # relative to the motor position
+        start += saved["origin"]
+        end += saved["origin"]
+    sc1.P1AR = 0
+    sc1.PASM = 0  # STAY, the next line starts where this one ended
+    odd = np.arange(numpts2) % 2 == 1
+    sc2.P2PV = SC1_PREFIX + ".P1SP"
+    sc2.P3PV = SC1_PREFIX + ".P1EP"
+    sc2.P2AR = 0  # tables hold field values, not motor offsets
+    sc2.P3AR = 0
+    sc2.P2SM = 1
+    sc2.P3SM = 1
+    sc2.put("P2PA", np.where(odd, end, start), wait=True)
+    sc2.put("P3PA", np.where(odd, start, end), wait=True)
+    logger.debug("Set scanner %s to serpentine over %i lines", sc2, numpts2)
+    return saved
+
+
+def _clear_serpentine(motor1: epics.Motor, saved: dict):
+    """Undoes _set_serpentine, putting sc1's settings back and motor1 back where it started, as a linear scan leaves it"""
+    _restore_linear_mode(sc2)
+    for field in ["PASM", "P1AR", "P1SP", "P1EP"]:
+        sc1.put(field, saved[field])
+    motor1.move(saved["origin"], wait=True)
+
+
 @scan_moderator
 def scan2d(
     motor1: epics.Motor,
@@ -465,6 +651,8 @@ def scan2d(
     numpts2: int,
     dwelltime: float,
     absolute: bool = False,
+    serpentine: bool = False,
+    drift_tracker=None,
 ):
     """Scans across two motors
 
@@ -479,7 +667,14 @@ def scan2d(
         numpts2 (int): number of scan points, inclusive of startpos/endpos
         dwelltime (float): counting time at each point of the scan, in ms
         absolute (bool, optional): whether startpos and endpos are relative to the current motor position (False) or absolute motor coordinates (True). Defaults to False (relative).
+        serpentine (bool, optional): whether to alternate the direction of motor1 every line, which skips the flyback move at the end of each line. s2driver.analysis.loading.load_h5 flips the reversed lines back. Defaults to False.
+        drift_tracker (DriftTracker, optional): shifts the scan by the drift it predicts, so the scan covers the features it covered on the tracker's reference map. See s2driver.analysis.drift. Defaults to None (no correction).
     """
+    if drift_tracker is not None:
+        startpos1, endpos1, startpos2, endpos2 = drift_tracker.correct(
+            startpos1, endpos1, startpos2, endpos2
+        )
+        logger.info("Shifted scan by predicted drift (%.2f, %.2f) um", *drift_tracker.predict())
     _set_scanner(
         scanner=sc1,
         motor=motor1,
@@ -498,7 +693,16 @@ def scan2d(
     )
     _set_dwell_time(dwelltime)
 
-    _execute_scan(sc2, scantype="scan2d")
+    if not serpentine:
+        _execute_scan(sc2, scantype="scan2d")
+        return
+    scannum = get_next_scan_number()
+    saved = _set_serpentine(motor1, numpts2)
+    try:
+        _execute_scan(sc2, scantype="scan2d")
+        write_scan_metadata(scannum, {"scantype": "scan2d", "serpentine": True})
+    finally:
+        _clear_serpentine(motor1, saved)
 
 
 @scan_moderator
@@ -513,6 +717,7 @@ def scan2d_xeol(
     numpts2: int,
     dwelltime: float,
     absolute: bool = False,
+    serpentine: bool = False,
 ):
     """Scans across two motors
 
@@ -527,6 +732,7 @@ def scan2d_xeol(
         numpts2 (int): number of scan points, inclusive of startpos/endpos
         dwelltime (float): counting time at each point of the scan, in ms
         absolute (bool, optional): whether startpos and endpos are relative to the current motor position (False) or absolute motor coordinates (True). Defaults to False (relative).
+        serpentine (bool, optional): whether to alternate the direction of motor1 every line, which skips the flyback move at the end of each line. The XEOL capture and s2driver.analysis.loading.load_h5 flip the reversed lines back. Defaults to False.
     """
 
     if not xeol_controller.IS_PRESENT:
@@ -551,16 +757,26 @@ def scan2d_xeol(
     )
     _set_dwell_time(dwelltime)
 
+    scannum = PVS["next_scan"].value
     xeol_output_filepath = os.path.join(
         get_experiment_dir(),
         "XEOL",
-        f'2idd_{PVS["next_scan"].value:04d}_XEOL.h5',
+        f"2idd_{scannum:04d}_XEOL.h5",
     )
-    xeol_thread = xeol_controller.prime_for_scan(
-        scantype="scan2d", output_filepath=xeol_output_filepath
-    )
-    _execute_scan(sc2, scantype="scan2d_xeol")
-    xeol_thread.join()  # will join when xeol data has been saved to file
+    if serpentine:
+        saved = _set_serpentine(motor1, numpts2)
+    try:
+        xeol_thread = xeol_controller.prime_for_scan(
+            scantype="scan2d_serpentine" if serpentine else "scan2d",
+            output_filepath=xeol_output_filepath,
+        )
+        _execute_scan(sc2, scantype="scan2d_xeol")
+        xeol_thread.join()  # will join when xeol data has been saved to file
+        if serpentine:
+            write_scan_metadata(scannum, {"scantype": "scan2d_xeol", "serpentine": True})
+    finally:
+        if serpentine:
+            _clear_serpentine(motor1, saved)
 
 
 @scan_moderator
@@ -574,6 +790,7 @@ def flyscan2d(
     dwelltime: float,
     absolute: bool = False,
     wait_for_h5: bool = False,
+    drift_tracker=None,
 ):
     """Executes a flyscan using samx and samy. At 2idd, flyscanning requires that the x scanner is in absolute coordinates and that the y scanner is in relative coordinates.
 
@@ -586,7 +803,48 @@ def flyscan2d(
         numpts2 (int): number of steps to break the y scan into
         dwelltime (float): dwelltime (ms) per point
         absolute (bool, optional): whether startpos and endpos are relative to the current motor position (False) or absolute motor coordinates (True). In either case the coordinates will be converted to absolute x, relative y for flyscanner. Defaults to False (relative).
+        wait_for_h5 (bool, optional): whether to wait for the MAPS .h5 file to be written. Defaults to False.
+        drift_tracker (DriftTracker, optional): shifts the scan by the drift it predicts, so the scan covers the features it covered on the tracker's reference map. See s2driver.analysis.drift. Defaults to None (no correction).
     """
+    if drift_tracker is not None:
+        startpos1, endpos1, startpos2, endpos2 = drift_tracker.correct(
+            startpos1, endpos1, startpos2, endpos2
+        )
+        logger.info("Shifted scan by predicted drift (%.2f, %.2f) um", *drift_tracker.predict())
+    _set_flyscanners(
+        startpos1=startpos1,
+        endpos1=endpos1,
+        numpts1=numpts1,
+        startpos2=startpos2,
+        endpos2=endpos2,
+        numpts2=numpts2,
+        absolute=absolute,
+    )
+    _set_dwell_time(dwelltime)
+
+    h5_output_filepath = os.path.join(
+        get_experiment_dir(),
+        "img.dat",
+        f'{PVS["basename"].value}_{PVS["next_scan"].value:04d}.h5',
+    )
+    _execute_scan(fly1, scantype="flyscan2d")
+
+    if wait_for_h5:
+        while not os.path.exists(h5_output_filepath):
+            time.sleep(0.1)  # wait for the file to appear (ie write has begun)
+        time.sleep(3)  # wait for file to be completely written to disk
+
+
+def _set_flyscanners(
+    startpos1: float,
+    endpos1: float,
+    numpts1: int,
+    startpos2: float,
+    endpos2: float,
+    numpts2: int,
+    absolute: bool = False,
+):
+    """Prepares flyh/fly1 for a samx/samy flyscan, see flyscan2d"""
     if absolute:
         y0 = (startpos2 + endpos2) / 2
         mov(samy, y0)  # move such that we are centered on scan in y dimension.
@@ -615,29 +873,28 @@ def flyscan2d(
         numpts=numpts2,
         absolute=False,
     )  # flyy must be relative
-    _set_dwell_time(dwelltime)
-
-    h5_output_filepath = os.path.join(
-        get_experiment_dir(),
-        "img.dat",
-        f'{PVS["basename"].value}_{PVS["next_scan"].value:04d}.h5',
-    )
-    _execute_scan(fly1, scantype="flyscan2d")
-
-    if wait_for_h5:
-        while not os.path.exists(h5_output_filepath):
-            time.sleep(0.1)  # wait for the file to appear (ie write has begun)
-        time.sleep(3)  # wait for file to be completely written to disk
 
 
 @scan_moderator
-def timeseries(numpts: int, dwelltime: float):
+def timeseries(
+    numpts: int,
+    dwelltime: float,
+    stopping_rule: StoppingRule = None,
+    detector_channel: int = None,
+):
     """Record data with constant beam exposure at a single point. This is currently done by a scan1d over samx with a relative move of 0 lol.
 
     Args:
         numpts (int): number of scans to record
         dwelltime (float): duration (ms) to expose each scan
+        stopping_rule (StoppingRule, optional): if given, the scan is stopped as soon as this rule converges on the values of detector_channel. Whether the scan was stopped early is recorded in the scan index. Defaults to None (always record numpts).
+        detector_channel (int, optional): index of the scan record detector (D01-D70) fed to stopping_rule. Required if stopping_rule is given. Defaults to None.
+
+    Raises:
+        ValueError: stopping_rule given without a detector_channel
     """
+    if stopping_rule is not None and detector_channel is None:
+        raise ValueError("Must specify the detector_channel to feed to the stopping rule!")
     _set_scanner(
         scanner=sc1,
         motor=samx,
@@ -648,16 +905,37 @@ def timeseries(numpts: int, dwelltime: float):
     )
     _set_dwell_time(dwelltime)
 
-    _execute_scan(sc1, scantype="timeseries")
+    scannum = get_next_scan_number()
+    stop_condition = None
+    if stopping_rule is not None:
+        stop_condition = _stopping_condition(
+            stopping_rule,
+            lambda first, last: np.asarray(getattr(sc1, f"D{detector_channel:02d}CA"))[
+                first:last
+            ],
+        )
+    outcome = _execute_scan(sc1, scantype="timeseries", stop_condition=stop_condition)
+    if stopping_rule is not None:
+        write_scan_metadata(scannum, {"scantype": "timeseries", "npts": numpts, **outcome})
+
+
+def _xeol_peak_counts(first: int, last: int) -> np.ndarray:
+    """Background subtracted peak counts of the XEOL spectra of completed points [first, last) of the scan being captured"""
+    live_data = xeol_controller.live_data
+    if live_data is None:
+        return np.array([])  # capture thread has not started filling its buffer yet
+    spectra = live_data["spectra"][first:last]
+    return (spectra - live_data["background"]).max(axis=-1)
 
 
 @scan_moderator
-def timeseries_xeol(numpts: int, dwelltime: float):
+def timeseries_xeol(numpts: int, dwelltime: float, stopping_rule: StoppingRule = None):
     """Record data with constant beam exposure at a single point. This is currently done by a scan1d over samx with a relative move of 0 lol.
 
     Args:
         numpts (int): number of scans to record
         dwelltime (float): duration (ms) to expose each scan
+        stopping_rule (StoppingRule, optional): if given, the scan is stopped as soon as this rule converges on the background subtracted XEOL peak counts, eg a DecayRule. The XEOL file then only holds the completed points, and is flagged "stopped_early". Defaults to None (always record numpts).
     """
     _set_scanner(
         scanner=sc1,
@@ -669,13 +947,931 @@ def timeseries_xeol(numpts: int, dwelltime: float):
     )
     _set_dwell_time(dwelltime)
 
+    scannum = get_next_scan_number()
     xeol_output_filepath = os.path.join(
         get_experiment_dir(),
         "XEOL",
-        f'2idd_{PVS["next_scan"].value:04d}_XEOL.h5',
+        f"2idd_{scannum:04d}_XEOL.h5",
     )
     xeol_thread = xeol_controller.prime_for_scan(
         scantype="timeseries", output_filepath=xeol_output_filepath
     )
-    _execute_scan(sc1, scantype="timeseries_xeol")
+    stop_condition = None
+    if stopping_rule is not None:
+        stop_condition = _stopping_condition(stopping_rule, _xeol_peak_counts)
+    outcome = _execute_scan(sc1, scantype="timeseries_xeol", stop_condition=stop_condition)
     xeol_thread.join()  # will join when xeol data has been saved to file
+    if stopping_rule is not None:
+        write_scan_metadata(
+            scannum, {"scantype": "timeseries_xeol", "npts": numpts, **outcome}
+        )
+
+
+def _restore_linear_mode(scanner: epics.devices.Scan):
+    """Puts a scanner back in the linear mode used by every other scan, and detaches its extra positioners"""
+    for i in range(1, 5):
+        scanner.put(f"P{i}SM", 0)
+        if i > 1:
+            scanner.put(f"P{i}PV", "")
+    logger.debug("Restored scanner %s to linear mode", scanner)
+
+
+def travel_time_model() -> TravelTimeModel:
+    """Travel time model for samx/samy, using the velocities and settle delays (DLY) of the motor records"""
+    velocities = [samx.VELO * 1e3, samy.VELO * 1e3]  # motor records are in mm/s, routes in um
+    settle = [max(samx.DLY, DEFAULT_SETTLE), max(samy.DLY, DEFAULT_SETTLE)]
+    return TravelTimeModel(velocities=velocities, settle=settle)
+
+
+@scan_moderator
+def trajectory_scan(
+    x,
+    y,
+    dwelltime: float,
+    absolute: bool = False,
+    max_points: int = None,
+    optimize: bool = False,
+    xeol: bool = False,
+):
+    """Scans samx/samy through an arbitrary list of points, using the scan record's lookup table mode. Trajectories longer than the record can hold are split across consecutive scans. The points of each scan are written to its scan index. Returns once saveData has finalized the last scan, so get_next_scan_number() is one past it. See s2driver.trajectories for spiral, Fermat spiral and jittered trajectories.
+
+    Args:
+        x (array-like): samx positions, in um
+        y (array-like): samy positions, in um
+        dwelltime (float): counting time at each point of the scan, in ms
+        absolute (bool, optional): whether x and y are relative to the current motor positions (False) or absolute motor coordinates (True). Defaults to False (relative).
+        max_points (int, optional): maximum number of points per scan. Defaults to the maximum the scan record supports (MPTS).
+        optimize (bool, optional): whether to reorder the points to minimize travel time first, see s2driver.routing.optimize_route. Defaults to False (scan in the given order).
+        xeol (bool, optional): whether to capture an XEOL spectrum at every point. Defaults to False.
+
+    Raises:
+        ValueError: x and y are empty, not 1D or of different lengths
+    """
+    if xeol and not xeol_controller.IS_PRESENT:
+        raise Exception(
+            "XEOL Controller is not present, probably the spectrometer was not connected when s2driver was initialized. Can't run an XEOL measurement!"
+        )
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.ndim != 1 or x.shape != y.shape:
+        raise ValueError(f"x and y must be 1D and of equal length, got shapes {x.shape} and {y.shape}!")
+    if len(x) == 0:
+        raise ValueError("Trajectory is empty, nothing to scan!")
+    if not absolute:
+        x = x + samx.VAL
+        y = y + samy.VAL
+    if optimize:
+        order, report = optimize_route(
+            x, y, model=travel_time_model(), start=(samx.VAL, samy.VAL)
+        )
+        x, y = x[order], y[order]
+        logger.info(
+            "Reordered trajectory, estimated travel time %.1f s -> %.1f s (%.0f%% saved)",
+            report["original_time"],
+            report["optimized_time"],
+            100 * report["saving_fraction"],
+        )
+    for motor, positions in [(samx, x), (samy, y)]:
+        farthest = positions[np.argmax(np.abs(positions - motor.VAL))]
+        _check_for_huge_movement(motor, farthest)
+    max_points = min(max_points or sc1.MPTS, sc1.MPTS)
+    chunks = split_trajectory(x, y, max_points)
+    _set_dwell_time(dwelltime)
+
+    sc1.P1PV = samx.NAME + ".VAL"
+    sc1.P2PV = samy.NAME + ".VAL"
+    sc1.P1AR = 0  # table positions are absolute
+    sc1.P2AR = 0
+    try:
+        sc1.P1SM = 1  # lookup table mode
+        sc1.P2SM = 1
+        for i, (chunk_x, chunk_y) in enumerate(chunks):
+            if i > 0:
+                _wait_for_next_scan_number(scannum)  # saveData lags behind the end of the previous chunk
+            scannum = get_next_scan_number()
+            sc1.NPTS = len(chunk_x)
+            sc1.put("P1PA", chunk_x, wait=True)
+            sc1.put("P2PA", chunk_y, wait=True)
+            logger.debug(
+                "Set scanner %s to trajectory chunk %i/%i (%i points)",
+                sc1,
+                i + 1,
+                len(chunks),
+                len(chunk_x),
+            )
+            if xeol:
+                xeol_thread = xeol_controller.prime_for_scan(
+                    scantype="scan1d",
+                    output_filepath=os.path.join(
+                        get_experiment_dir(), "XEOL", f"2idd_{scannum:04d}_XEOL.h5"
+                    ),
+                )
+            outcome = _execute_scan(sc1, scantype="trajectory_scan")
+            if xeol:
+                xeol_thread.join()  # will join when xeol data has been saved to file
+            write_scan_metadata(
+                scannum,
+                {
+                    "scantype": "trajectory_scan",
+                    "x": chunk_x,
+                    "y": chunk_y,
+                    "chunk": i,
+                    "n_chunks": len(chunks),
+                    **outcome,
+                },
+            )
+            if outcome["aborted"]:
+                logger.info(
+                    "Trajectory scan aborted, skipping the remaining %i chunks",
+                    len(chunks) - i - 1,
+                )
+                break
+        _wait_for_next_scan_number(scannum)  # callers read the scan numbers used from get_next_scan_number
+    finally:
+        _restore_linear_mode(sc1)
+
+
+def masked_scan2d(
+    startpos1: float,
+    endpos1: float,
+    numpts1: int,
+    startpos2: float,
+    endpos2: float,
+    numpts2: int,
+    dwelltime: float,
+    mask,
+    absolute: bool = False,
+    xeol: bool = False,
+) -> dict:
+    """Scans the samx/samy grid of a scan2d, but only visits pixels inside a mask (eg the sample, thresholded from a previous coarse map). Masked pixels are scanned in serpentine order as lookup table segments, see trajectory_scan. The grid and mask are saved to the scan index of the first segment, use s2driver.analysis.loading.load_masked_scan to put the data back on the full grid.
+
+    Args:
+        startpos1 (float): starting samx position, in um
+        endpos1 (float): ending samx position, in um
+        numpts1 (int): number of samx points, inclusive of startpos/endpos
+        startpos2 (float): starting samy position, in um
+        endpos2 (float): ending samy position, in um
+        numpts2 (int): number of samy points, inclusive of startpos/endpos
+        dwelltime (float): counting time at each point of the scan, in ms
+        mask (array-like): boolean mask of the pixels to visit, shape (numpts2, numpts1)
+        absolute (bool, optional): whether startpos and endpos are relative to the current motor position (False) or absolute motor coordinates (True). Defaults to False (relative).
+        xeol (bool, optional): whether to capture an XEOL spectrum at every point. Defaults to False.
+
+    Raises:
+        ValueError: mask does not match the grid, or is empty
+
+    Returns:
+        dict: estimated "full_time" and "masked_time" (s) of the full grid and the masked scan, the time "saving" (s) and "saving_fraction", the mask "coverage" and the "scan_numbers" of every segment
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != (numpts2, numpts1):
+        raise ValueError(
+            f"Mask shape {mask.shape} does not match the scan grid {(numpts2, numpts1)}!"
+        )
+    if not mask.any():
+        raise ValueError("Mask is empty, nothing to scan!")
+    if not absolute:
+        startpos1 += samx.VAL
+        endpos1 += samx.VAL
+        startpos2 += samy.VAL
+        endpos2 += samy.VAL
+    xaxis = np.linspace(startpos1, endpos1, numpts1)
+    yaxis = np.linspace(startpos2, endpos2, numpts2)
+    iy, ix = masked_serpentine(mask)
+    full_iy, full_ix = masked_serpentine(np.ones_like(mask))
+
+    model = travel_time_model()
+    start = (samx.VAL, samy.VAL)
+    full_time = numpts1 * numpts2 * dwelltime / 1e3 + route_time(
+        np.column_stack([xaxis[full_ix], yaxis[full_iy]]), model, start=start
+    )
+    masked_time = len(iy) * dwelltime / 1e3 + route_time(
+        np.column_stack([xaxis[ix], yaxis[iy]]), model, start=start
+    )
+    report = {
+        "full_time": full_time,
+        "masked_time": masked_time,
+        "saving": full_time - masked_time,
+        "saving_fraction": 1 - masked_time / full_time,
+        "coverage": mask.mean(),
+    }
+    logger.info(
+        "Masked scan visits %i/%i pixels, estimated time %.1f s -> %.1f s (%.0f%% saved)",
+        len(iy),
+        mask.size,
+        full_time,
+        masked_time,
+        100 * report["saving_fraction"],
+    )
+
+    first_scan = get_next_scan_number()
+    trajectory_scan(
+        x=xaxis[ix], y=yaxis[iy], dwelltime=dwelltime, absolute=True, xeol=xeol
+    )
+    report["scan_numbers"] = np.arange(first_scan, get_next_scan_number())  # trajectory_scan waits for the last segment to be finalized
+    write_scan_metadata(
+        first_scan,
+        {
+            "masked_scan2d": {
+                "x_axis": xaxis,
+                "y_axis": yaxis,
+                "mask": mask.astype(np.int64),
+                "iy": iy,
+                "ix": ix,
+                **report,
+            },
+        },
+    )
+    return report
+
+
+def _trajectory_values(scan_number: int, detector_channel: int = None, xeol: bool = False):
+    """Positions and values of the points of the trajectory scan that just finished
+
+    Args:
+        scan_number (int): scan number of the trajectory scan
+        detector_channel (int, optional): scan record detector (D01-D70) to read. Defaults to None.
+        xeol (bool, optional): read background subtracted XEOL peak counts instead. Defaults to False.
+
+    Returns:
+        tuple: (x, y, values) arrays, in the order the points were measured
+    """
+    metadata = load_scan_metadata(scan_number)
+    x = np.asarray(metadata["x"])
+    y = np.asarray(metadata["y"])
+    n = int(metadata["npts_completed"])
+    if xeol:
+        live_data = xeol_controller.live_data
+        values = (live_data["spectra"][:n] - live_data["background"]).max(axis=-1)
+    else:
+        values = np.asarray(getattr(sc1, f"D{detector_channel:02d}DA"))[:n]
+    return x[:n], y[:n], values
+
+
+def adaptive_scan(
+    startpos1: float,
+    endpos1: float,
+    startpos2: float,
+    endpos2: float,
+    step: float,
+    dwelltime: float,
+    detector_channel: int = None,
+    xeol: bool = False,
+    coarse_spacing: int = 8,
+    threshold: float = 0.1,
+    max_points: int = None,
+    absolute: bool = False,
+) -> dict:
+    """Maps a samx/samy region coarse-to-fine. Starts on a coarse grid, then repeatedly measures lookup-table batches of new points only in cells whose signal varies, until the cells reach the target resolution or the point budget is spent. The full resolution map is interpolated from all measured points and saved to the scan index of the first scan.
+
+    Args:
+        startpos1 (float): starting samx position, in um
+        endpos1 (float): ending samx position, in um
+        startpos2 (float): starting samy position, in um
+        endpos2 (float): ending samy position, in um
+        step (float): target resolution, in um. The region is extended up to one coarse cell so the grid fits.
+        dwelltime (float): counting time at each point, in ms
+        detector_channel (int, optional): scan record detector (D01-D70) that drives refinement, eg an XRF ROI or a scaler. Required unless xeol is True. Defaults to None.
+        xeol (bool, optional): drive refinement with the XEOL peak counts instead. Defaults to False.
+        coarse_spacing (int, optional): spacing of the initial grid, in multiples of step. Must be a power of two. Defaults to 8.
+        threshold (float, optional): cells whose corner values differ by at least this fraction of the measured range are refined. Defaults to 0.1.
+        max_points (int, optional): point budget, including the coarse grid. Defaults to None (refine down to step everywhere it is needed).
+        absolute (bool, optional): whether positions are relative to the current motor positions (False) or absolute motor coordinates (True). Defaults to False (relative).
+
+    Raises:
+        ValueError: neither a detector_channel nor xeol was given
+
+    Returns:
+        dict: "x" and "y" axes (absolute, um), the reconstructed "map", the "sampled" mask, and the "scan_numbers" of every batch
+    """
+    if detector_channel is None and not xeol:
+        raise ValueError("Must specify a detector_channel or xeol=True to drive the refinement!")
+    if not absolute:
+        startpos1 += samx.VAL
+        endpos1 += samx.VAL
+        startpos2 += samy.VAL
+        endpos2 += samy.VAL
+    x0, y0 = min(startpos1, endpos1), min(startpos2, endpos2)
+    numx = AdaptiveGrid.fit_to_spacing(int(round(abs(endpos1 - startpos1) / step)) + 1, coarse_spacing)
+    numy = AdaptiveGrid.fit_to_spacing(int(round(abs(endpos2 - startpos2) / step)) + 1, coarse_spacing)
+    grid = AdaptiveGrid(numx, numy, coarse_spacing)
+
+    scan_numbers = []
+    points = grid.initial_points()
+    n_measured = 0
+    while len(points) > 0:
+        for batch in np.array_split(points, int(np.ceil(len(points) / sc1.MPTS))):
+            if scan_numbers:
+                _wait_for_next_scan_number(scan_numbers[-1])
+            scan_numbers.append(get_next_scan_number())
+            trajectory_scan(
+                x=x0 + batch[:, 1] * step,
+                y=y0 + batch[:, 0] * step,
+                dwelltime=dwelltime,
+                absolute=True,
+                optimize=True,
+                xeol=xeol,
+            )
+            x, y, values = _trajectory_values(scan_numbers[-1], detector_channel, xeol)
+            measured = np.column_stack(
+                [np.round((y - y0) / step), np.round((x - x0) / step)]
+            ).astype(int)
+            grid.record(measured, values)
+            n_measured += len(values)
+            if len(values) < len(batch):
+                logger.info("Adaptive scan aborted after %i points", n_measured)
+                points = []
+                break
+        else:
+            budget = None if max_points is None else max_points - n_measured
+            points = grid.refine(threshold=threshold, max_new_points=budget)
+            logger.info(
+                "Adaptive scan measured %i/%i points, refining %i more",
+                n_measured,
+                numx * numy,
+                len(points),
+            )
+
+    result = {
+        "x": x0 + np.arange(numx) * step,
+        "y": y0 + np.arange(numy) * step,
+        "map": grid.reconstruct(),
+        "sampled": grid.sampled,
+        "scan_numbers": np.array(scan_numbers),
+    }
+    write_scan_metadata(
+        scan_numbers[0],
+        {
+            "scantype": "adaptive_scan",
+            **result,
+            "sampled": result["sampled"].astype(np.int64),
+        },
+    )
+    return result
+
+
+MOSAIC_SCANTYPES = ["flyscan2d", "scan2d", "scan2d_xeol"]  # scans that can be used for mosaic tiles
+
+
+def _run_tile(scantype: str, extent: tuple, step: float, dwelltime: float):
+    startpos1, endpos1, numpts1, startpos2, endpos2, numpts2 = extent
+    if scantype == "flyscan2d":
+        flyscan2d(
+            startpos1=startpos1,
+            endpos1=endpos1 + 2 * step,  # last two columns of a flyscan are clipped by load_h5
+            numpts1=numpts1 + 2,
+            startpos2=startpos2,
+            endpos2=endpos2,
+            numpts2=numpts2,
+            dwelltime=dwelltime,
+            absolute=True,
+        )
+        return
+    scan = scan2d if scantype == "scan2d" else scan2d_xeol
+    scan(
+        motor1=samx,
+        startpos1=startpos1,
+        endpos1=endpos1,
+        numpts1=numpts1,
+        motor2=samy,
+        startpos2=startpos2,
+        endpos2=endpos2,
+        numpts2=numpts2,
+        dwelltime=dwelltime,
+        absolute=True,
+    )
+
+
+def _stage_tile(scantype: str, extent: tuple):
+    """Moves samx/samy to where a tile scan starts, so the scan itself begins without a long move. Flyscans start centered in y."""
+    startpos1, _, _, startpos2, endpos2, _ = extent
+    samx.move(startpos1, wait=True)
+    samy.move((startpos2 + endpos2) / 2 if scantype == "flyscan2d" else startpos2, wait=True)
+
+
+def mosaic_scan(
+    startpos1: float,
+    endpos1: float,
+    startpos2: float,
+    endpos2: float,
+    step: float,
+    dwelltime: float,
+    tile_size: float,
+    overlap: float = 0.1,
+    scantype: str = "flyscan2d",
+    absolute: bool = False,
+) -> dict:
+    """Maps a samx/samy region larger than one scan as a mosaic of overlapping tiles, scanned back to back in serpentine order. The motors are staged at the start of the next tile as soon as a tile finishes, and MAPS processing is not waited on between tiles. The plan and tile scan numbers are saved to the scan index of the first tile, use s2driver.analysis.mosaic.stitch_mosaic to assemble the tiles on disk.
+
+    Args:
+        startpos1 (float): starting samx position, in um
+        endpos1 (float): ending samx position, in um
+        startpos2 (float): starting samy position, in um
+        endpos2 (float): ending samy position, in um
+        step (float): pixel size, in um
+        dwelltime (float): dwelltime (ms) per point
+        tile_size (float): width and height of a tile, in um. Can be a (width, height) tuple.
+        overlap (float, optional): fraction of a tile shared with each neighbour, used to blend seams when stitching. Defaults to 0.1.
+        scantype (str, optional): scan used for every tile, one of MOSAIC_SCANTYPES. Defaults to "flyscan2d".
+        absolute (bool, optional): whether positions are relative to the current motor positions (False) or absolute motor coordinates (True). Defaults to False (relative).
+
+    Raises:
+        ValueError: invalid scantype
+
+    Returns:
+        dict: mosaic plan (see s2driver.mosaic.plan_mosaic), with the "scan_numbers" of every tile and the "scantype"
+    """
+    if scantype not in MOSAIC_SCANTYPES:
+        raise ValueError(f"Mosaic tiles must be one of {MOSAIC_SCANTYPES}, not {scantype}!")
+    if not absolute:
+        startpos1 += samx.VAL
+        endpos1 += samx.VAL
+        startpos2 += samy.VAL
+        endpos2 += samy.VAL
+    plan = plan_mosaic(
+        xmin=min(startpos1, endpos1),
+        xmax=max(startpos1, endpos1),
+        ymin=min(startpos2, endpos2),
+        ymax=max(startpos2, endpos2),
+        step=step,
+        tile_size=tile_size,
+        overlap=overlap,
+    )
+    n_tiles = len(plan["tiles"]["row"])
+    for motor, axis in [(samx, plan["x"]), (samy, plan["y"])]:
+        farthest = axis[np.argmax(np.abs(axis - motor.VAL))]
+        _check_for_huge_movement(motor, farthest)  # confirm the whole mosaic once, tiles are staged without asking
+    logger.info(
+        "Mosaic of %i tiles (%i x %i pixels total) with %s",
+        n_tiles,
+        len(plan["x"]),
+        len(plan["y"]),
+        scantype,
+    )
+
+    scan_numbers = []
+    _stage_tile(scantype, tile_extent(plan, 0))
+    for i in range(n_tiles):
+        if i > 0:
+            _wait_for_next_scan_number(scan_numbers[-1])
+        scan_numbers.append(get_next_scan_number())
+        _run_tile(scantype, tile_extent(plan, i), step, dwelltime)
+        logger.info("Finished mosaic tile %i/%i (scan %i)", i + 1, n_tiles, scan_numbers[-1])
+        if i + 1 < n_tiles:
+            _stage_tile(scantype, tile_extent(plan, i + 1))
+
+    plan["scan_numbers"] = np.array(scan_numbers)
+    plan["scantype"] = scantype
+    write_scan_metadata(scan_numbers[0], {"mosaic": plan})
+    return plan
+
+
+### Outer loops
+class Positioner:
+    """Anything an outer loop can step through: a motor, or a PV such as a temperature setpoint or monochromator energy"""
+
+    def __init__(
+        self,
+        target,
+        readback: str = None,
+        tolerance: float = None,
+        settle: float = 0.0,
+        timeout: float = 600.0,
+        name: str = None,
+    ):
+        """
+        Args:
+            target (epics.Motor or str): motor to move, or name of the PV to put positions to
+            readback (str, optional): PV to compare against the setpoint, eg a measured temperature. Only used with tolerance. Defaults to None.
+            tolerance (float, optional): wait until the readback is within this distance of the setpoint. Defaults to None (done when the put completes).
+            settle (float, optional): seconds to wait after every move. Defaults to 0.0.
+            timeout (float, optional): seconds to wait for the readback to reach tolerance. Defaults to 600.0.
+            name (str, optional): label used in logs and the scan index. Defaults to None (motor or PV name).
+        """
+        self.target = target
+        self.readback = readback
+        self.tolerance = tolerance
+        self.settle = settle
+        self.timeout = timeout
+        self.name = name or (target.NAME if isinstance(target, epics.Motor) else target)
+
+    def __repr__(self):
+        return f"Positioner({self.name})"
+
+    @property
+    def position(self) -> float:
+        """Current setpoint"""
+        if isinstance(self.target, epics.Motor):
+            return self.target.VAL
+        return epics.caget(self.target)
+
+    def move(self, position: float):
+        """Moves to a position and waits until it is reached
+
+        Args:
+            position (float): position to move to
+
+        Raises:
+            TimeoutError: the readback did not reach tolerance in time
+        """
+        if isinstance(self.target, epics.Motor):
+            self.target.move(position, wait=True)  # outer_scan confirms large moves once, up front
+        else:
+            epics.caput(self.target, position, wait=True)
+        if self.tolerance is not None:
+            t0 = time.time()
+            while abs(epics.caget(self.readback or self.target) - position) > self.tolerance:
+                if time.time() - t0 > self.timeout:
+                    raise TimeoutError(
+                        f"{self.name} did not reach {position} within {self.timeout} s!"
+                    )
+                time.sleep(0.5)
+        time.sleep(self.settle)
+        logger.debug("Moved %s to %s", self.name, position)
+
+
+def _set_inner_scan(scantype: str, kwargs: dict) -> epics.devices.Scan:
+    """Configures the scan records for an inner scan of outer_scan, once for all outer points
+
+    Args:
+        scantype (str): one of OUTER_SCAN_INNER_SCANTYPES
+        kwargs (dict): arguments of the corresponding scan command (motor(s), start/end positions, numbers of points, dwelltime, absolute)
+
+    Returns:
+        epics.devices.Scan: scanner to execute
+    """
+    absolute = kwargs.get("absolute", False)
+    if scantype == "flyscan2d":
+        _set_flyscanners(
+            **{k: kwargs[k] for k in ["startpos1", "endpos1", "numpts1", "startpos2", "endpos2", "numpts2"]},
+            absolute=absolute,
+        )
+        scanner = fly1
+    elif scantype == "scan1d":
+        _set_scanner(
+            scanner=sc1,
+            motor=kwargs["motor"],
+            startpos=kwargs["startpos"],
+            endpos=kwargs["endpos"],
+            numpts=kwargs["numpts"],
+            absolute=absolute,
+        )
+        scanner = sc1
+    else:
+        for scanner, i in [(sc1, 1), (sc2, 2)]:
+            _set_scanner(
+                scanner=scanner,
+                motor=kwargs[f"motor{i}"],
+                startpos=kwargs[f"startpos{i}"],
+                endpos=kwargs[f"endpos{i}"],
+                numpts=kwargs[f"numpts{i}"],
+                absolute=absolute,
+            )
+        scanner = sc2
+    _set_dwell_time(kwargs["dwelltime"])
+    return scanner
+
+
+OUTER_SCAN_INNER_SCANTYPES = ["scan1d", "scan2d", "flyscan2d"]
+
+
+def outer_scan(
+    positioners: list,
+    positions: list,
+    inner: str,
+    **inner_kwargs,
+) -> dict:
+    """Runs an inner scan at every point of a grid of outer positions, eg a theta series, focal series, temperature series or any PV. The inner scan records are configured once. After each inner scan the outer positioners move on right away, while saveData finalizes the inner scan's file. The outer positions of every sub-scan are saved to the scan index of the sub-scan, and the full table to that of the first sub-scan.
+
+    Args:
+        positioners (list): Positioners (or motors, or PV names) of the outer dimensions, outermost first
+        positions (list): positions of each outer dimension, one array-like per positioner. Every combination is visited, the last dimension changing fastest.
+        inner (str): inner scan, one of OUTER_SCAN_INNER_SCANTYPES
+        **inner_kwargs: arguments of the inner scan command, eg motor=samx, startpos=-5, endpos=5, numpts=51, dwelltime=50 for scan1d
+
+    Raises:
+        ValueError: invalid inner scan, or positions do not match positioners
+
+    Returns:
+        dict: "names" of the positioners, "positions" visited (n_points by n_dimensions, in scan order), "scan_numbers" of the inner scans, and "inner" scantype
+    """
+    if inner not in OUTER_SCAN_INNER_SCANTYPES:
+        raise ValueError(f"Inner scan must be one of {OUTER_SCAN_INNER_SCANTYPES}, not {inner}!")
+    if len(positioners) != len(positions):
+        raise ValueError("Must provide one array of positions per positioner!")
+    positioners = [p if isinstance(p, Positioner) else Positioner(p) for p in positioners]
+    grid = np.stack(
+        np.meshgrid(*[np.atleast_1d(np.asarray(p, dtype=float)) for p in positions], indexing="ij"), axis=-1
+    ).reshape(-1, len(positioners))
+    for positioner, axis in zip(positioners, grid.T):
+        if isinstance(positioner.target, epics.Motor):
+            farthest = axis[np.argmax(np.abs(axis - positioner.target.VAL))]
+            _check_for_huge_movement(positioner.target, farthest)  # confirm the whole series once, points are moved without asking
+    scanner = _set_inner_scan(inner, inner_kwargs)
+    names = ",".join(p.name for p in positioners)
+    logger.info("Outer scan over %s: %i %s scans", names, len(grid), inner)
+
+    scan_numbers = []
+    current = [None] * len(positioners)
+    for k, point in enumerate(grid):
+        for i, (positioner, value) in enumerate(zip(positioners, point)):
+            if value != current[i]:  # outer dimensions only move when they change
+                positioner.move(float(value))
+                current[i] = value
+        if k > 0:
+            _wait_for_next_scan_number(scan_numbers[-1])
+        scan_numbers.append(get_next_scan_number())
+        outcome = _execute_scan(scanner, scantype=inner)
+        write_scan_metadata(
+            scan_numbers[-1],
+            {"outer_point": {"parent": scan_numbers[0], "index": k, "names": names, "positions": point}},
+        )
+        if outcome["aborted"]:
+            logger.info("Outer scan aborted, skipping the remaining %i points", len(grid) - k - 1)
+            break
+
+    result = {
+        "names": names,
+        "positions": grid[: len(scan_numbers)],
+        "scan_numbers": np.array(scan_numbers),
+        "inner": inner,
+    }
+    write_scan_metadata(scan_numbers[0], {"outer_scan": result})
+    return result
+
+
+### Energy scans
+ENERGY_MOVE_TIMEOUT = 60  # seconds to wait for all energy axes to finish a move
+
+
+def _put_concurrently(values: dict, timeout: float = ENERGY_MOVE_TIMEOUT):
+    """Puts values to several PVs at once and waits until every put has completed
+
+    Args:
+        values (dict): PV name: value
+        timeout (float, optional): seconds to wait for the puts to complete. Defaults to ENERGY_MOVE_TIMEOUT.
+
+    Raises:
+        TimeoutError: not all puts completed in time
+    """
+    pvs = []
+    for name, value in values.items():
+        pv = epics.get_pv(name)
+        pv.put(value, use_complete=True)
+        pvs.append(pv)
+    t0 = time.time()
+    while not all(pv.put_complete for pv in pvs):
+        if time.time() - t0 > timeout:
+            raise TimeoutError(f"Energy axes did not finish moving within {timeout} s!")
+        time.sleep(0.01)
+
+
+def _check_energy_axes(axes: list):
+    """Energy scans drive the mono, undulator and zone plate through the PVs they are given, there are no default axes"""
+    if not axes:
+        raise ValueError("Must provide the EnergyAxis list of the beamline, there are no default energy axes!")
+    if not any(axis.name == MONO_AXIS for axis in axes):
+        raise ValueError(f"The energy axes must include the monochromator, named '{MONO_AXIS}'!")
+
+
+def _energy_reference(axes: list) -> dict:
+    """Current setpoint of every energy axis, by name"""
+    return {axis.name: epics.caget(axis.pv) for axis in axes}
+
+
+class EnergyPositioner(Positioner):
+    """Outer loop positioner that sets the beam energy, moving every coupled axis concurrently to precomputed table positions"""
+
+    def __init__(self, table: dict, axes: list, settle: float = 0.0):
+        """
+        Args:
+            table (dict): energy table, see s2driver.energy.energy_table
+            axes (list): EnergyAxis list the table was computed for
+            settle (float, optional): seconds to wait after every move. Defaults to 0.0.
+
+        Raises:
+            ValueError: no axes, or no MONO_AXIS among them
+        """
+        _check_energy_axes(axes)
+        super().__init__(target=None, settle=settle, name="energy")
+        self.table = table
+        self.axes = axes
+        self._order = np.argsort(table["energy"])
+
+    @property
+    def position(self) -> float:
+        """Current energy, in eV"""
+        return epics.caget(next(a.pv for a in self.axes if a.name == MONO_AXIS))
+
+    def move(self, position: float):
+        """Moves every energy axis to its position at an energy, interpolating the table between its energies
+
+        Args:
+            position (float): energy, in eV
+        """
+        energies = self.table["energy"][self._order]
+        _put_concurrently(
+            {
+                axis.pv: float(np.interp(position, energies, self.table[axis.name][self._order]))
+                for axis in self.axes
+            }
+        )
+        time.sleep(self.settle)
+        logger.debug("Set energy to %.2f eV", position)
+
+
+def energy_scan(
+    energies,
+    inner: str,
+    axes: list,
+    focal_length: float = None,
+    settle: float = 0.0,
+    **inner_kwargs,
+) -> dict:
+    """Runs an inner scan (eg a map) at every energy of a list, see outer_scan. Positions of the mono, undulator and zone plate are computed once for all energies, and coupled axes move concurrently. Every axis returns to its starting position afterwards.
+
+    Args:
+        energies (array-like): beam energies, in eV, eg from s2driver.energy.xanes_energies
+        inner (str): inner scan, one of OUTER_SCAN_INNER_SCANTYPES
+        axes (list): EnergyAxis list of the beamline's mono, undulator and (optionally) zone plate axes, see s2driver.energy.EnergyAxis
+        focal_length (float, optional): zone plate focal length at the current energy, in um. Required if any axis follows the focus.
+        settle (float, optional): seconds to wait after every energy change. Defaults to 0.0.
+        **inner_kwargs: arguments of the inner scan command
+
+    Raises:
+        ValueError: no axes, or no MONO_AXIS among them
+
+    Returns:
+        dict: outer_scan result, with the energy "table" added
+    """
+    _check_energy_axes(axes)
+    reference = _energy_reference(axes)
+    table = energy_table(energies, reference, axes=axes, focal_length=focal_length)
+    try:
+        result = outer_scan(
+            [EnergyPositioner(table, axes=axes, settle=settle)],
+            [table["energy"]],
+            inner,
+            **inner_kwargs,
+        )
+    finally:
+        _put_concurrently({axis.pv: reference[axis.name] for axis in axes})
+    result["table"] = table
+    write_scan_metadata(result["scan_numbers"][0], {"energy_table": table})
+    return result
+
+
+@scan_moderator
+def xanes_scan(
+    energies,
+    dwelltime: float,
+    axes: list,
+    focal_length: float = None,
+    xeol: bool = False,
+):
+    """Measures a spectrum at the current position by stepping the energy within one scan. The scan record drives up to four energy axes from lookup tables, moving them together at every point, so each energy step costs about as much as a motor step. The energy table is written to the scan index.
+
+    Args:
+        energies (array-like): beam energies, in eV, eg from s2driver.energy.xanes_energies
+        dwelltime (float): counting time at each energy, in ms
+        axes (list): EnergyAxis list, at most four (one per scan record positioner), including the MONO_AXIS
+        focal_length (float, optional): zone plate focal length at the current energy, in um. Required if any axis follows the focus.
+        xeol (bool, optional): whether to capture an XEOL spectrum at every energy. Defaults to False.
+
+    Raises:
+        ValueError: no axes or no MONO_AXIS among them, more than four axes, or more energies than the scan record can hold
+    """
+    _check_energy_axes(axes)
+    if len(axes) > 4:
+        raise ValueError("The scan record can only drive four energy axes at once!")
+    if len(energies) > sc1.MPTS:
+        raise ValueError(f"At most {sc1.MPTS} energies fit in one scan!")
+    if xeol and not xeol_controller.IS_PRESENT:
+        raise Exception(
+            "XEOL Controller is not present, probably the spectrometer was not connected when s2driver was initialized. Can't run an XEOL measurement!"
+        )
+    reference = _energy_reference(axes)
+    table = energy_table(energies, reference, axes=axes, focal_length=focal_length)
+    scannum = get_next_scan_number()
+    _set_dwell_time(dwelltime)
+    try:
+        sc1.NPTS = len(table["energy"])
+        for i, axis in enumerate(axes, start=1):
+            sc1.put(f"P{i}PV", axis.pv)
+            sc1.put(f"P{i}AR", 0)  # table positions are absolute
+            sc1.put(f"P{i}SM", 1)  # lookup table mode
+            sc1.put(f"P{i}PA", table[axis.name], wait=True)
+        if xeol:
+            xeol_thread = xeol_controller.prime_for_scan(
+                scantype="scan1d",
+                output_filepath=os.path.join(
+                    get_experiment_dir(), "XEOL", f"2idd_{scannum:04d}_XEOL.h5"
+                ),
+            )
+        outcome = _execute_scan(sc1, scantype="xanes_scan")
+        if xeol:
+            xeol_thread.join()  # will join when xeol data has been saved to file
+        write_scan_metadata(
+            scannum, {"scantype": "xanes_scan", "energy_table": table, **outcome}
+        )
+    finally:
+        _restore_linear_mode(sc1)
+        _put_concurrently({axis.pv: reference[axis.name] for axis in axes})
+
+
+### Autofocus
+def autofocus(
+    startpos: float,
+    endpos: float,
+    numpts: int,
+    dwelltime: float,
+    detector_channel: int,
+    motor: epics.Motor = samx,
+    focus_range: tuple = (-20, 20),
+    tolerance: float = 1.0,
+    max_scans: int = 8,
+) -> dict:
+    """Finds the samz position where a sharp edge looks sharpest. Runs short scan1ds across the edge at samz positions chosen by golden section search, measuring the edge width as the FWHM of the profile derivative, then refines the best position with a parabola. samz is left at the best position, and the focus curve is written to the scan index of the first line scan.
+
+    Args:
+        startpos (float): start of the line scan across the edge, relative to the current motor position, in um
+        endpos (float): end of the line scan across the edge, relative to the current motor position, in um
+        numpts (int): number of points per line scan
+        dwelltime (float): counting time at each point, in ms
+        detector_channel (int): scan record detector (D01-D70) that shows the edge, eg an XRF ROI
+        motor (epics.Motor, optional): motor to scan across the edge. Defaults to samx.
+        focus_range (tuple, optional): (lower, upper) samz range to search, relative to the current position, in um. Defaults to (-20, 20).
+        tolerance (float, optional): stop once the focus is bracketed to within this many um. Defaults to 1.0.
+        max_scans (int, optional): maximum number of line scans. Defaults to 8.
+
+    Returns:
+        dict: "z" and "width" of every line scan in order, the "best_z" (absolute samz position), and the "scan_numbers"
+    """
+    z0 = samz.VAL
+    scan_numbers = []
+
+    def measure(z):
+        mov(samz, z0 + z)
+        if scan_numbers:
+            _wait_for_next_scan_number(scan_numbers[-1])
+        scan_numbers.append(get_next_scan_number())
+        scan1d(
+            motor=motor,
+            startpos=startpos,
+            endpos=endpos,
+            numpts=numpts,
+            dwelltime=dwelltime,
+        )
+        profile = np.asarray(getattr(sc1, f"D{detector_channel:02d}DA"))[:numpts]
+        width = edge_widths(np.linspace(startpos, endpos, numpts), profile)
+        logger.info("Edge width at samz %+.2f um: %.3f um", z, width)
+        return width
+
+    best, history = golden_section_search(
+        measure,
+        lower=focus_range[0],
+        upper=focus_range[1],
+        tolerance=tolerance,
+        max_evaluations=max_scans,
+    )
+    mov(samz, z0 + best)
+    z, widths = np.array(history, dtype=float).T
+    result = {
+        "z": z0 + z,
+        "width": widths,
+        "best_z": z0 + best,
+        "scan_numbers": np.array(scan_numbers),
+    }
+    write_scan_metadata(scan_numbers[0], {"autofocus": result})
+    logger.info("Autofocus moved samz to %.2f after %i line scans", z0 + best, len(history))
+    return result
+
+
+def scan_rois(rois: list, dwelltime: float, scantype: str = "flyscan2d") -> list:
+    """Runs a detail scan over each region found on an overview map, eg by s2driver.analysis.roi.find_rois
+
+    Args:
+        rois (list): dicts holding absolute "startpos1", "endpos1", "numpts1", "startpos2", "endpos2", "numpts2"
+        dwelltime (float): dwelltime (ms) per point
+        scantype (str, optional): scan to run, one of MOSAIC_SCANTYPES. Defaults to "flyscan2d".
+
+    Raises:
+        ValueError: invalid scantype
+
+    Returns:
+        list: scan number of each region's scan, in order
+    """
+    if scantype not in MOSAIC_SCANTYPES:
+        raise ValueError(f"Region scans must be one of {MOSAIC_SCANTYPES}, not {scantype}!")
+    scan_numbers = []
+    for roi in rois:
+        if scan_numbers:
+            _wait_for_next_scan_number(scan_numbers[-1])
+        scan_numbers.append(get_next_scan_number())
+        _run_tile(
+            scantype,
+            tuple(roi[k] for k in ["startpos1", "endpos1", "numpts1", "startpos2", "endpos2", "numpts2"]),
+            step=(roi["endpos1"] - roi["startpos1"]) / max(roi["numpts1"] - 1, 1),
+            dwelltime=dwelltime,
+        )
+    return scan_numbers
@@ -0,0 +1,89 @@
+import numpy as np
+
+### Energy tables
+# Every axis that has to follow the beam energy moves linearly with it: the monochromator (eV), the undulator gap (keV), and the zone plate focus plus its runout corrections, which shift with the focal length (focal length * dE / E). Tables are computed once per scan, relative to the positions at the current energy, so no per-step calculation or serial moves are needed.
+
+
+class EnergyAxis:
+    """An axis that moves with the beam energy: position(E) = position(E_ref) + slope * shift, where shift is E - E_ref, or the focal length change for zone plate axes"""
+
+    def __init__(self, name: str, pv: str, slope: float, follows_focus: bool = False):
+        """
+        Args:
+            name (str): label of the axis, used as its column in energy tables
+            pv (str): setpoint PV of the axis
+            slope (float): position change per eV (or per um of focal length change if follows_focus)
+            follows_focus (bool, optional): whether the axis follows the zone plate focal length rather than the energy. Defaults to False.
+        """
+        self.name = name
+        self.pv = pv
+        self.slope = slope
+        self.follows_focus = follows_focus
+
+    def __repr__(self):
+        return f"EnergyAxis({self.name}, {self.pv})"
+
+
+MONO_AXIS = "mono"  # name of the axis whose position is the beam energy, in eV
+S26_ENERGY_AXES = [
+    # couplings from change_energy/defocus of the legacy S26 script, for reference only. These are sector 26 PVs, energy scans have no default axes and must be given the 2-ID-D ones
+    EnergyAxis(MONO_AXIS, "26idbDCM:sm8.VAL", slope=1.0),
+    EnergyAxis("undulator_ds", "26idbDCM:sm2.VAL", slope=1e-3),  # keV per eV
+    EnergyAxis("undulator_us", "26idbDCM:sm3.VAL", slope=1e-3),
+    EnergyAxis("focus", "26idcnpi:m12.VAL", slope=1.0, follows_focus=True),
+    EnergyAxis("hybrid_y", "26idcnpi:Y_HYBRID_SP.VAL", slope=-1.177 * 2 / 400, follows_focus=True),
+    EnergyAxis("hybrid_x", "26idcnpi:X_HYBRID_SP.VAL", slope=-0.31 * 2 / 400, follows_focus=True),
+]
+
+
+def energy_table(
+    energies,
+    reference_positions: dict,
+    axes: list = None,
+    focal_length: float = None,
+) -> dict:
+    """Positions of every energy axis at every energy
+
+    Args:
+        energies (array-like): beam energies, in eV
+        reference_positions (dict): current position of every axis by name. The MONO_AXIS entry is the current energy.
+        axes (list): EnergyAxis list, including the MONO_AXIS
+        focal_length (float, optional): zone plate focal length at the current energy, in um. Required if any axis follows the focus.
+
+    Raises:
+        ValueError: no axes were given, or an axis follows the focus but no focal_length was given
+
+    Returns:
+        dict: "energy" and one array of positions per axis name, in the order of energies
+    """
+    if not axes:
+        raise ValueError("Must provide the EnergyAxis list of the beamline, there are no default energy axes!")
+    energies = np.asarray(energies, dtype=float)
+    reference_energy = reference_positions[MONO_AXIS]
+    shift = energies - reference_energy
+    if any(axis.follows_focus for axis in axes) and focal_length is None:
+        raise ValueError("Must provide the zone plate focal_length to move focus axes with energy!")
+    table = {"energy": energies}
+    for axis in axes:
+        if axis.follows_focus:
+            table[axis.name] = reference_positions[axis.name] + axis.slope * shift * focal_length / reference_energy
+        else:
+            table[axis.name] = reference_positions[axis.name] + axis.slope * shift
+    return table
+
+
+def xanes_energies(edge: float, pre_edge=(-30, -10, 2.0), edge_region=(-10, 30, 0.5), post_edge=(30, 150, 5.0)) -> np.ndarray:
+    """Energies of a XANES scan around an absorption edge: coarse before the edge, fine across it, coarser after
+
+    Args:
+        edge (float): edge energy, in eV
+        pre_edge (tuple, optional): (start, stop, step) relative to the edge, in eV. Defaults to (-30, -10, 2.0).
+        edge_region (tuple, optional): (start, stop, step) relative to the edge, in eV. Defaults to (-10, 30, 0.5).
+        post_edge (tuple, optional): (start, stop, step) relative to the edge, in eV. Defaults to (30, 150, 5.0).
+
+    Returns:
+        np.ndarray: increasing energies, in eV
+    """
+    regions = [np.arange(start, stop, step) for start, stop, step in [pre_edge, edge_region, post_edge]]
+    regions.append([post_edge[1]])
+    return edge + np.unique(np.concatenate(regions))
@@ -0,0 +1,95 @@
+import numpy as np
+
+### Autofocus
+# Focus is found by minimizing the width of a sharp edge in short line scans. The edge width is the FWHM of the derivative of the edge profile, which needs no fitting and works on many profiles at once.
+
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2  # ~0.618
+
+
+def edge_widths(positions: np.ndarray, profiles: np.ndarray) -> np.ndarray:
+    """Widths of edges in line profiles, as the full width at half maximum of the profile derivative. Rising and falling edges both work.
+
+    Args:
+        positions (np.ndarray): scan positions, shape (npts,), or (n_profiles, npts) if they differ per profile
+        profiles (np.ndarray): measured values across the edge, shape (npts,) or (n_profiles, npts)
+
+    Returns:
+        np.ndarray: edge widths, in units of positions, one per profile (a float for a single profile). NaN where the derivative peak is not bounded by the scan on both sides.
+    """
+    single = np.ndim(profiles) == 1
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    positions = np.broadcast_to(np.asarray(positions, dtype=float), profiles.shape)
+    n = profiles.shape[1]
+    derivative = np.abs(np.gradient(profiles, axis=1) / np.gradient(positions, axis=1))
+    peak = np.argmax(derivative, axis=1)
+    half = derivative[np.arange(len(profiles)), peak] / 2
+    idx = np.arange(n)[None, :]
+    below = derivative < half[:, None]
+    left = np.max(np.where(below & (idx < peak[:, None]), idx, -1), axis=1)  # last point below half max before the peak
+    right = np.min(np.where(below & (idx > peak[:, None]), idx, n), axis=1)  # first point below half max after the peak
+    valid = (left >= 0) & (right < n)
+    left, right = np.clip(left, 0, n - 2), np.clip(right, 1, n - 1)
+
+    def crossing(i0, i1):
+        rows = np.arange(len(profiles))
+        d0, d1 = derivative[rows, i0], derivative[rows, i1]
+        x0, x1 = positions[rows, i0], positions[rows, i1]
+        frac = np.divide(half - d0, d1 - d0, out=np.zeros_like(half), where=d1 != d0)
+        return x0 + frac * (x1 - x0)
+
+    widths = np.abs(crossing(right - 1, right) - crossing(left, left + 1))
+    widths = np.where(valid, widths, np.nan)
+    return widths[0] if single else widths
+
+
+def parabola_vertex(z, widths) -> float:
+    """Position of the minimum of a parabola fit to (z, width) points. Returns None if the fit opens downwards."""
+    a, b, _ = np.polyfit(np.asarray(z, dtype=float), np.asarray(widths, dtype=float), 2)
+    if a <= 0:
+        return None
+    return -b / (2 * a)
+
+
+def golden_section_search(f, lower: float, upper: float, tolerance: float, max_evaluations: int = 10):
+    """Minimizes a unimodal function of one variable by golden section search, then refines the minimum with a parabola through the best three evaluations
+
+    Args:
+        f (callable): f(z) -> value to minimize. NaN values count as infinitely bad.
+        lower (float): lower bound of the search
+        upper (float): upper bound of the search
+        tolerance (float): stop once the bracket is narrower than this
+        max_evaluations (int, optional): maximum number of calls to f. Defaults to 10.
+
+    Returns:
+        tuple: (best z, history), where history is a list of (z, value) in evaluation order
+    """
+    history = []
+
+    def evaluate(z):
+        value = f(z)
+        history.append((z, value))
+        return np.inf if np.isnan(value) else value
+
+    a, b = lower, upper
+    c = b - GOLDEN_RATIO * (b - a)
+    d = a + GOLDEN_RATIO * (b - a)
+    fc, fd = evaluate(c), evaluate(d)
+    while b - a > tolerance and len(history) < max_evaluations:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - GOLDEN_RATIO * (b - a)
+            fc = evaluate(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + GOLDEN_RATIO * (b - a)
+            fd = evaluate(d)
+
+    z, values = np.array(history, dtype=float).T
+    finite = np.isfinite(values)
+    best = z[finite][np.argmin(values[finite])] if finite.any() else (lower + upper) / 2
+    if finite.sum() >= 3:
+        nearest = np.argsort(np.abs(z[finite] - best))[:3]
+        vertex = parabola_vertex(z[finite][nearest], values[finite][nearest])
+        if vertex is not None and a <= vertex <= b:
+            best = vertex
+    return best, history
@@ -10,12 +10,19 @@ def get_experiment_dir():
 )
 	return path
 
+LOGGER_NAME = "s2driver"  # every s2driver module logs to this one logger, so handlers added to it (eg the S2Server's "logs" topic) see all of them
+
+
 def initialize_logbook():
+    logger = logging.getLogger(LOGGER_NAME)
+    if logger.handlers:  # already set up by another module
+        return logger
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
     LOGBOOK_PATH = os.path.join(
         get_experiment_dir(),
         "s2driver.log",
     )
-    logger = logging.Logger("s2driver Logging", level=logging.DEBUG)
     fh = logging.FileHandler(LOGBOOK_PATH)
     sh = logging.StreamHandler(sys.stdout)
     sh.setLevel(logging.INFO)
@@ -35,5 +42,4 @@ def initialize_logbook():
 
 
 def get_logbook():
-    logger = logging.Logger("s2driver Logging", level=logging.DEBUG)
-    return logger
+    return logging.getLogger(LOGGER_NAME)
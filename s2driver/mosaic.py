@@ -0,0 +1,91 @@
+import numpy as np
+
+### Mosaic planning
+# A mosaic covers a region larger than one scan with overlapping rectangular tiles. All tiles share one global pixel grid (the mosaic's x/y axes), so tiles are placed by index when stitching, see s2driver.analysis.mosaic.
+
+
+def _tile_starts(num: int, tile_num: int, overlap: int) -> np.ndarray:
+    """First global index of every tile along one axis. The last tile is pulled back to end on the last pixel, overlapping its neighbour a bit more."""
+    if tile_num >= num:
+        return np.array([0])
+    stride = tile_num - overlap
+    n_tiles = int(np.ceil((num - tile_num) / stride)) + 1
+    starts = np.arange(n_tiles) * stride
+    starts[-1] = num - tile_num
+    return starts
+
+
+def plan_mosaic(
+    xmin: float,
+    xmax: float,
+    ymin: float,
+    ymax: float,
+    step: float,
+    tile_size: float,
+    overlap: float = 0.1,
+) -> dict:
+    """Splits a region into overlapping tiles on a common pixel grid, in serpentine order (rows in order, alternating direction along x) so consecutive tiles are always neighbours
+
+    Args:
+        xmin (float): lower x bound, in um
+        xmax (float): upper x bound, in um
+        ymin (float): lower y bound, in um
+        ymax (float): upper y bound, in um
+        step (float): pixel size, in um
+        tile_size (float): width and height of a tile, in um. Can be a (width, height) tuple.
+        overlap (float, optional): fraction of a tile shared with each neighbour. Defaults to 0.1.
+
+    Raises:
+        ValueError: overlap is not in [0, 1)
+
+    Returns:
+        dict: "x" and "y" axes of the mosaic, in um, and "tiles": arrays with one entry per tile, in scan order. "row" and "col" place the tile in the mosaic, "ix0"/"iy0" are the global indices of its first pixel and "numx"/"numy" its size in pixels.
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("Overlap must be in [0, 1)!")
+    tile_width, tile_height = np.broadcast_to(tile_size, 2)
+    numx = int(round((xmax - xmin) / step)) + 1
+    numy = int(round((ymax - ymin) / step)) + 1
+    tile_numx = min(int(round(tile_width / step)) + 1, numx)
+    tile_numy = min(int(round(tile_height / step)) + 1, numy)
+    xstarts = _tile_starts(numx, tile_numx, int(round(overlap * tile_numx)))
+    ystarts = _tile_starts(numy, tile_numy, int(round(overlap * tile_numy)))
+
+    rows, cols = np.meshgrid(np.arange(len(ystarts)), np.arange(len(xstarts)), indexing="ij")
+    cols[1::2] = cols[1::2, ::-1]  # serpentine
+    rows, cols = rows.ravel(), cols.ravel()
+    return {
+        "x": xmin + np.arange(numx) * step,
+        "y": ymin + np.arange(numy) * step,
+        "tiles": {
+            "row": rows,
+            "col": cols,
+            "ix0": xstarts[cols],
+            "iy0": ystarts[rows],
+            "numx": np.full(len(rows), tile_numx),
+            "numy": np.full(len(rows), tile_numy),
+        },
+    }
+
+
+def tile_extent(plan: dict, index: int) -> tuple:
+    """Scan range of a tile
+
+    Args:
+        plan (dict): mosaic plan, see plan_mosaic
+        index (int): tile index, in scan order
+
+    Returns:
+        tuple: (startpos1, endpos1, numpts1, startpos2, endpos2, numpts2), absolute positions in um
+    """
+    tiles = plan["tiles"]
+    ix0, iy0 = tiles["ix0"][index], tiles["iy0"][index]
+    numx, numy = int(tiles["numx"][index]), int(tiles["numy"][index])
+    return (
+        float(plan["x"][ix0]),
+        float(plan["x"][ix0 + numx - 1]),
+        numx,
+        float(plan["y"][iy0]),
+        float(plan["y"][iy0 + numy - 1]),
+        numy,
+    )
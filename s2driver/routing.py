@@ -0,0 +1,229 @@
+import time
+import numpy as np
+
+### Travel time defaults
+# Used when the motor records do not provide better numbers, see s2driver.driving.travel_time_model
+DEFAULT_VELOCITY = 100.0  # um/s
+DEFAULT_SETTLE = 0.05  # s after each move of an axis
+
+
+class TravelTimeModel:
+    """Estimates the time to move the sample between two positions. Axes move simultaneously, so a move takes as long as its slowest axis: max over axes of |delta| / velocity + settle time (settle only applies to axes that move)."""
+
+    def __init__(self, velocities=(DEFAULT_VELOCITY, DEFAULT_VELOCITY), settle=(DEFAULT_SETTLE, DEFAULT_SETTLE)):
+        """
+        Args:
+            velocities (tuple, optional): speed of each axis, in um/s. Defaults to DEFAULT_VELOCITY for x and y.
+            settle (tuple, optional): settle time of each axis after it moves, in s. Defaults to DEFAULT_SETTLE for x and y.
+        """
+        self.velocities = np.asarray(velocities, dtype=float)
+        self.settle = np.asarray(settle, dtype=float)
+
+    def time(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Travel times between positions, broadcast over leading dimensions
+
+        Args:
+            a (np.ndarray): start positions, shape (..., n_axes)
+            b (np.ndarray): end positions, shape (..., n_axes)
+
+        Returns:
+            np.ndarray: travel times in s, shape (...)
+        """
+        delta = np.abs(b - a)
+        times = None
+        for axis in range(delta.shape[-1]):  # much faster than reducing over a length 2 axis
+            axis_time = delta[..., axis] / self.velocities[axis] + (delta[..., axis] > 0) * self.settle[axis]
+            times = axis_time if times is None else np.maximum(times, axis_time)
+        return times
+
+
+def route_time(points: np.ndarray, model: TravelTimeModel, start: np.ndarray = None) -> float:
+    """Total travel time of visiting points in the given order
+
+    Args:
+        points (np.ndarray): positions, shape (n, n_axes)
+        model (TravelTimeModel): travel time estimates
+        start (np.ndarray, optional): position before the first point. Defaults to None (start at the first point).
+
+    Returns:
+        float: estimated seconds spent moving
+    """
+    if start is not None:
+        points = np.vstack([start, points])
+    return float(model.time(points[:-1], points[1:]).sum())
+
+
+def _nearest_neighbour(points: np.ndarray, start: np.ndarray, model: TravelTimeModel) -> np.ndarray:
+    remaining = [np.ascontiguousarray(points[:, axis]) for axis in range(points.shape[1])]  # unvisited points are swap-removed from the end
+    ids = np.arange(len(points))
+    order = np.empty(len(points), dtype=int)
+    current = np.array(start, dtype=float)
+    for k in range(len(points)):
+        m = len(points) - k
+        times = None
+        for axis, column in enumerate(remaining):
+            delta = np.abs(column[:m] - current[axis])
+            axis_time = delta / model.velocities[axis] + (delta > 0) * model.settle[axis]
+            times = axis_time if times is None else np.maximum(times, axis_time)
+        j = np.argmin(times)
+        order[k] = ids[j]
+        for axis, column in enumerate(remaining):
+            current[axis] = column[j]
+            column[j] = column[m - 1]
+        ids[j] = ids[m - 1]
+    return order
+
+
+def _select_disjoint(gains: np.ndarray, spans: np.ndarray, n: int) -> list:
+    """Greedily picks improving moves, largest gain first, whose spans of route positions do not overlap. Such moves only rearrange their own span, so they can all be applied in one go."""
+    touched = np.zeros(n + 2, dtype=bool)
+    selected = []
+    for m in np.argsort(-gains):
+        if gains[m] <= 1e-9:
+            break
+        lo, hi = spans[m]
+        if not touched[lo : hi + 1].any():
+            touched[lo : hi + 1] = True
+            selected.append(m)
+    return selected
+
+
+def _two_opt_pass(path: np.ndarray, coords: np.ndarray, model: TravelTimeModel, window: int) -> int:
+    """Windowed 2-opt over an open path (indices into coords) whose first node is fixed. Evaluates every reversal of up to window nodes at once. Modifies path in place, returns the number of improving moves."""
+    n = len(path) - 1  # position of the last node
+    if n < 2:
+        return 0
+    c = coords[path]
+    i = np.arange(1, n)
+    j = i[:, None] + np.arange(1, window + 1)[None, :]  # reverse positions i..j
+    valid = j <= n
+    j = np.minimum(j, n)
+    after_j = np.minimum(j + 1, n)
+    delta = model.time(c[i - 1][:, None], c[j]) - model.time(c[i - 1], c[i])[:, None]
+    delta += np.where(
+        j < n, model.time(c[i][:, None], c[after_j]) - model.time(c[j], c[after_j]), 0
+    )
+    delta[~valid] = np.inf
+    best = np.argmin(delta, axis=1)
+    gains = -delta[np.arange(len(i)), best]
+    best_j = j[np.arange(len(i)), best]
+    spans = np.column_stack([i - 1, best_j + 1])
+    selected = _select_disjoint(gains, spans, n)
+    for m in selected:
+        path[i[m] : best_j[m] + 1] = path[i[m] : best_j[m] + 1][::-1].copy()
+    return len(selected)
+
+
+def _or_opt_pass(
+    path: np.ndarray, coords: np.ndarray, model: TravelTimeModel, window: int, max_segment: int = 3
+) -> int:
+    """Windowed Or-opt over an open path (indices into coords) whose first node is fixed: moves segments of up to max_segment nodes elsewhere within window positions, possibly reversed. Evaluates every move of a segment length at once. Modifies path in place, returns the number of improving moves."""
+    moves = 0
+    for length in range(1, max_segment + 1):
+        n = len(path) - 1
+        if n < length + 1:
+            break
+        c = coords[path]
+        i = np.arange(1, n - length + 2)  # segment occupies positions i..i+length-1
+        last_i = i + length - 1
+        has_next = i + length <= n
+        next_i = np.minimum(i + length, n)
+        removal_gain = model.time(c[i - 1], c[i]) + np.where(
+            has_next, model.time(c[last_i], c[next_i]) - model.time(c[i - 1], c[next_i]), 0
+        )
+
+        # insert between positions k and k+1, or after the last node when k == n
+        k = i[:, None] + np.arange(-window, length + window)[None, :]
+        valid = (k >= 0) & (k <= n) & ((k < i[:, None] - 1) | (k > last_i[:, None]))
+        k = np.clip(k, 0, n)
+        after_k = np.minimum(k + 1, n)
+        is_end = k == n
+        edge = np.where(is_end, 0, model.time(c[k], c[after_k]))
+        forward = (
+            model.time(c[k], c[i][:, None])
+            + np.where(is_end, 0, model.time(c[last_i][:, None], c[after_k]))
+            - edge
+        )
+        backward = (
+            model.time(c[k], c[last_i][:, None])
+            + np.where(is_end, 0, model.time(c[i][:, None], c[after_k]))
+            - edge
+        )
+        insertion = np.where(valid, np.minimum(forward, backward), np.inf)
+        best = np.argmin(insertion, axis=1)
+        rows = np.arange(len(i))
+        gains = removal_gain - insertion[rows, best]
+        best_k = k[rows, best]
+        reverse = backward[rows, best] < forward[rows, best]
+        spans = np.column_stack(
+            [np.minimum(i - 1, best_k), np.maximum(next_i, after_k[rows, best])]
+        )
+        selected = _select_disjoint(gains, spans, n)
+        for m in selected:
+            start, stop, target = i[m], i[m] + length, best_k[m]
+            segment = path[start:stop].copy()
+            if reverse[m]:
+                segment = segment[::-1]
+            if target < start:  # move the segment back, to right after position target
+                path[target + 1 + length : stop] = path[target + 1 : start].copy()
+                path[target + 1 : target + 1 + length] = segment
+            else:  # move the segment forward, to right after position target
+                path[start : target + 1 - length] = path[stop : target + 1].copy()
+                path[target + 1 - length : target + 1] = segment
+        moves += len(selected)
+    return moves
+
+
+def optimize_route(
+    x,
+    y,
+    model: TravelTimeModel = None,
+    start=None,
+    window: int = 30,
+    max_passes: int = 5,
+    time_limit: float = 10.0,
+):
+    """Reorders scan positions to minimize the estimated travel time. Builds a nearest neighbour route, then refines it with windowed 2-opt and Or-opt passes. Windows limit each move to nearby positions along the route, which keeps passes fast for 10k+ points.
+
+    Args:
+        x (array-like): x positions, in um
+        y (array-like): y positions, in um
+        model (TravelTimeModel, optional): travel time estimates. Defaults to a TravelTimeModel with default velocities and settle times.
+        start (tuple, optional): (x, y) position before the first point, eg the current motor positions. Defaults to None (start wherever the route is shortest from the first given point).
+        window (int, optional): how far along the route 2-opt and Or-opt look for moves. Defaults to 30.
+        max_passes (int, optional): maximum number of 2-opt + Or-opt passes. Defaults to 5.
+        time_limit (float, optional): stop refining after this many seconds. Defaults to 10.0.
+
+    Returns:
+        tuple: (order, report). order is the permutation of the points to visit them in (x[order], y[order]). report holds the estimated "original_time" and "optimized_time" (s), the "saving" (s) and the "saving_fraction".
+    """
+    t0 = time.time()
+    model = model or TravelTimeModel()
+    points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    if start is None:
+        start = points[0]
+    start = np.asarray(start, dtype=float)
+    original_time = route_time(points, model, start=start)
+
+    all_points = np.vstack([start, points])  # node 0 is the fixed start
+    order = _nearest_neighbour(points, start, model)
+    path = np.concatenate([[0], order + 1])
+    for _ in range(max_passes):
+        moves = _two_opt_pass(path, all_points, model, window)
+        moves += _or_opt_pass(path, all_points, model, window)
+        if moves == 0 or time.time() - t0 > time_limit:
+            break
+
+    order = path[1:] - 1
+    optimized_time = route_time(points[order], model, start=start)
+    if optimized_time > original_time:  # never make a route worse
+        order = np.arange(len(points))
+        optimized_time = original_time
+    saving = original_time - optimized_time
+    report = {
+        "original_time": original_time,
+        "optimized_time": optimized_time,
+        "saving": saving,
+        "saving_fraction": saving / original_time if original_time > 0 else 0.0,
+    }
+    return order, report
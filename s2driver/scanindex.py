@@ -0,0 +1,67 @@
+import os
+import numpy as np
+from s2driver.logging import get_experiment_dir
+from s2driver.analysis.helpers import save_dict_to_hdf5, load_dict_from_hdf5
+
+### Scan index
+# Small h5 sidecar per scan, holding metadata the scan records and MAPS files do not store (eg whether a scan was stopped early).
+
+
+def get_scan_index_filepath(scan_number: int) -> str:
+    """Path to the scan index .h5 file of a scan"""
+    return os.path.join(
+        get_experiment_dir(),
+        "scanindex",
+        f"2idd_{scan_number:04d}_index.h5",
+    )
+
+
+def _to_h5_compatible(value):
+    if isinstance(value, dict):
+        return {k: _to_h5_compatible(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (str, bytes, np.ndarray, np.int64, np.float64)):
+        return value
+    if isinstance(value, (bool, np.bool_, int, np.integer)):
+        return np.int64(value)
+    if isinstance(value, (float, np.floating)):
+        return np.float64(value)
+    return np.asarray(value)
+
+
+def _from_h5(value):
+    if isinstance(value, dict):
+        return {k: _from_h5(v) for k, v in value.items()}
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_scan_metadata(scan_number: int, metadata: dict):
+    """Adds entries to the scan index of a scan. Existing entries with the same keys are overwritten.
+
+    Args:
+        scan_number (int): scan number
+        metadata (dict): entries to write. Values may be numbers, bools, strings, arrays, or nested dicts of these. None values are skipped.
+    """
+    fpath = get_scan_index_filepath(scan_number)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    contents = load_scan_metadata(scan_number)
+    contents.update(metadata)
+    save_dict_to_hdf5(_to_h5_compatible(contents), fpath)
+
+
+def load_scan_metadata(scan_number: int) -> dict:
+    """Loads the scan index of a scan
+
+    Args:
+        scan_number (int): scan number
+
+    Returns:
+        dict: scan index entries. Empty if nothing was recorded for this scan.
+    """
+    fpath = get_scan_index_filepath(scan_number)
+    if not os.path.exists(fpath):
+        return {}
+    return _from_h5(load_dict_from_hdf5(fpath))
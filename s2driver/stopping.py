@@ -0,0 +1,187 @@
+import numpy as np
+from abc import ABC, abstractmethod
+
+### Online stopping rules
+# Fed with the values of newly completed points while a scan runs. Once a rule has converged, the scan is aborted and the partial data is flagged as stopped early.
+
+
+class StoppingRule(ABC):
+    """Base class for online stopping rules. Subclasses implement `_update` and `converged`."""
+
+    def __init__(self, min_points: int = 5):
+        """
+        Args:
+            min_points (int, optional): never stop before this many points were measured. Defaults to 5.
+        """
+        self.min_points = min_points
+        self.n = 0
+
+    def update(self, values) -> bool:
+        """Feeds newly completed points to the rule
+
+        Args:
+            values (array-like): values of the points completed since the previous update, in acquisition order
+
+        Returns:
+            bool: True if the scan can be stopped
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if values.size > 0:
+            self._update(values)
+        return self.n >= self.min_points and self.converged()
+
+    @abstractmethod
+    def _update(self, values: np.ndarray):
+        """Accumulates the finite values of newly completed points"""
+        pass
+
+    @abstractmethod
+    def converged(self) -> bool:
+        """Whether the points seen so far are enough to stop the scan"""
+        pass
+
+
+class PrecisionRule(StoppingRule):
+    """Stops once the mean of the measured values is known to a target precision. Uses Welford's running mean/variance, so each update is O(new points)."""
+
+    def __init__(
+        self, rel_precision: float = None, abs_precision: float = None, min_points: int = 5
+    ):
+        """
+        Args:
+            rel_precision (float, optional): target standard error of the mean, relative to the mean (eg 0.01 = 1%). Defaults to None.
+            abs_precision (float, optional): target standard error of the mean, in the units of the measured values. Defaults to None.
+            min_points (int, optional): never stop before this many points were measured. Defaults to 5.
+
+        Raises:
+            ValueError: neither rel_precision nor abs_precision was given
+        """
+        if rel_precision is None and abs_precision is None:
+            raise ValueError("Must specify a rel_precision and/or an abs_precision!")
+        super().__init__(min_points=min_points)
+        self.rel_precision = rel_precision
+        self.abs_precision = abs_precision
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of squared deviations from the mean
+
+    def _update(self, values: np.ndarray):
+        # Chan et al. merge of the running statistics with those of the new block
+        n_b = values.size
+        mean_b = values.mean()
+        m2_b = ((values - mean_b) ** 2).sum()
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self._m2 += m2_b + delta**2 * self.n * n_b / n
+        self.n = n
+
+    @property
+    def sem(self) -> float:
+        """Standard error of the mean"""
+        if self.n < 2:
+            return np.inf
+        return np.sqrt(self._m2 / (self.n - 1) / self.n)
+
+    def converged(self) -> bool:
+        sem = self.sem
+        if self.abs_precision is not None and sem > self.abs_precision:
+            return False
+        if self.rel_precision is not None and (
+            self.mean == 0 or sem / abs(self.mean) > self.rel_precision
+        ):
+            return False
+        return True
+
+
+class DecayRule(StoppingRule):
+    """Stops once the lifetime of an exponential decay is determined to a target precision, or once the signal has decayed away. Fits log(intensity) against point index with running sums, so each update is O(new points). Values should be background subtracted - non-positive values are skipped."""
+
+    def __init__(
+        self,
+        rel_precision: float = 0.05,
+        decayed_fraction: float = None,
+        min_points: int = 10,
+    ):
+        """
+        Args:
+            rel_precision (float, optional): target standard error of the decay lifetime, relative to the lifetime. Defaults to 0.05.
+            decayed_fraction (float, optional): also stop once the fitted intensity has fallen below this fraction of its initial value (eg 0.05). Defaults to None.
+            min_points (int, optional): never stop before this many points were measured. Defaults to 10.
+        """
+        super().__init__(min_points=min_points)
+        self.rel_precision = rel_precision
+        self.decayed_fraction = decayed_fraction
+        self._index = 0  # index of the next point
+        self._sums = np.zeros(6)  # n, sum t, sum y, sum t^2, sum t*y, sum y^2
+
+    def _update(self, values: np.ndarray):
+        t = np.arange(self._index, self._index + values.size, dtype=float)
+        self._index += values.size
+        keep = values > 0
+        t = t[keep]
+        y = np.log(values[keep])
+        self._sums += [t.size, t.sum(), y.sum(), (t * t).sum(), (t * y).sum(), (y * y).sum()]
+        self.n = int(self._sums[0])
+
+    def fit(self):
+        """Current fit of log(intensity) = intercept + slope * point index
+
+        Returns:
+            tuple: (intercept, slope, standard error of slope). NaN if fewer than 3 points were fitted.
+        """
+        n, st, sy, stt, sty, syy = self._sums
+        if n < 3:
+            return np.nan, np.nan, np.nan
+        sxx = stt - st**2 / n
+        sxy = sty - st * sy / n
+        syy_c = syy - sy**2 / n
+        if sxx <= 0:
+            return np.nan, np.nan, np.nan
+        slope = sxy / sxx
+        intercept = (sy - slope * st) / n
+        residual_var = max(syy_c - slope * sxy, 0) / (n - 2)
+        return intercept, slope, np.sqrt(residual_var / sxx)
+
+    @property
+    def lifetime(self) -> float:
+        """Fitted decay lifetime, in points (multiply by the dwelltime for seconds)"""
+        _, slope, _ = self.fit()
+        if not slope < 0:
+            return np.inf
+        return -1 / slope
+
+    def converged(self) -> bool:
+        intercept, slope, slope_err = self.fit()
+        if not slope < 0:
+            return False  # not decaying (yet)
+        if abs(slope_err / slope) <= self.rel_precision:
+            return True
+        if self.decayed_fraction is not None:
+            return np.exp(slope * (self._index - 1)) <= self.decayed_fraction
+        return False
+
+
+STOPPING_RULES = {
+    "precision": PrecisionRule,
+    "decay": DecayRule,
+}
+
+
+def make_stopping_rule(spec: dict) -> StoppingRule:
+    """Builds a stopping rule from a json-friendly spec, eg {"rule": "precision", "rel_precision": 0.01}
+
+    Args:
+        spec (dict): "rule" is one of STOPPING_RULES, the remaining entries are passed to its constructor
+
+    Raises:
+        ValueError: unknown rule
+
+    Returns:
+        StoppingRule: new stopping rule
+    """
+    spec = dict(spec)
+    rule = spec.pop("rule")
+    if rule not in STOPPING_RULES:
+        raise ValueError(f"Stopping rule must be one of {list(STOPPING_RULES)}, not '{rule}'")
+    return STOPPING_RULES[rule](**spec)
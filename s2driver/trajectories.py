@@ -0,0 +1,145 @@
+import numpy as np
+
+### Scan trajectories
+# Generators return (x, y) offsets in um, relative to the trajectory center, for s2driver.driving.trajectory_scan.
+
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))  # radians
+
+
+def spiral(step: float, npts: int):
+    """Archimedean-like spiral used by the legacy spiralscan: point i sits at radius step*sqrt(i) and angle 4*sqrt(i)
+
+    Args:
+        step (float): radial scale, in um
+        npts (int): number of points
+
+    Returns:
+        tuple: (x, y) arrays of offsets, in um
+    """
+    i = np.arange(npts)
+    r = np.sqrt(i) * step
+    theta = 4 * np.sqrt(i)
+    return r * np.cos(theta), r * np.sin(theta)
+
+
+def fermat_spiral(step: float, npts: int):
+    """Fermat spiral with golden angle increments. Covers a disk with near-uniform point density and no grid periodicity, which avoids raster artifacts in ptychography.
+
+    Args:
+        step (float): radial scale, in um. The mean spacing between neighbouring points is roughly 1.8*step.
+        npts (int): number of points
+
+    Returns:
+        tuple: (x, y) arrays of offsets, in um
+    """
+    i = np.arange(npts)
+    r = np.sqrt(i) * step
+    theta = i * GOLDEN_ANGLE
+    return r * np.cos(theta), r * np.sin(theta)
+
+
+def grid(step: float, numx: int, numy: int = None):
+    """Centered raster grid, row by row
+
+    Args:
+        step (float): spacing between points, in um
+        numx (int): number of points along x
+        numy (int, optional): number of points along y. Defaults to numx.
+
+    Returns:
+        tuple: (x, y) arrays of offsets, in um
+    """
+    numy = numy or numx
+    x = (np.arange(numx) - (numx - 1) / 2) * step
+    y = (np.arange(numy) - (numy - 1) / 2) * step
+    xx, yy = np.meshgrid(x, y)
+    return xx.ravel(), yy.ravel()
+
+
+def jittered_grid(
+    step: float, numx: int, numy: int = None, jitter_std: float = 0.1, seed: int = None
+):
+    """Centered raster grid with gaussian noise on every position, as in the legacy jitterscan
+
+    Args:
+        step (float): spacing between points, in um
+        numx (int): number of points along x
+        numy (int, optional): number of points along y. Defaults to numx.
+        jitter_std (float, optional): standard deviation of the noise, as a fraction of step. Defaults to 0.1.
+        seed (int, optional): random seed, for reproducible trajectories. Defaults to None.
+
+    Returns:
+        tuple: (x, y) arrays of offsets, in um
+    """
+    rng = np.random.default_rng(seed)
+    x, y = grid(step, numx, numy)
+    noise = rng.normal(0, jitter_std * step, size=(2, x.size))
+    return x + noise[0], y + noise[1]
+
+
+def jittered_spiral(
+    step: float,
+    npts: int,
+    jitter_std: float = 0.1,
+    long_range: bool = False,
+    seed: int = None,
+):
+    """spiral() with every step between consecutive points scaled by a gaussian factor (mean 1), as in the legacy jitterspiralscan
+
+    Args:
+        step (float): radial scale, in um
+        npts (int): number of points
+        jitter_std (float, optional): standard deviation of the step scaling. Defaults to 0.1.
+        long_range (bool, optional): if True, each point is jittered around its ideal position (errors do not accumulate). If False, jittered steps are chained, so the trajectory only keeps short range order. Defaults to False.
+        seed (int, optional): random seed, for reproducible trajectories. Defaults to None.
+
+    Returns:
+        tuple: (x, y) arrays of offsets, in um
+    """
+    rng = np.random.default_rng(seed)
+    x, y = spiral(step, npts)
+    scale = rng.normal(1, jitter_std, size=(2, npts - 1))
+    dx = np.diff(x) * scale[0]
+    dy = np.diff(y) * scale[1]
+    if long_range:
+        return np.concatenate([x[:1], x[:-1] + dx]), np.concatenate([y[:1], y[:-1] + dy])
+    return np.concatenate([x[:1], x[0] + np.cumsum(dx)]), np.concatenate(
+        [y[:1], y[0] + np.cumsum(dy)]
+    )
+
+
+def split_trajectory(x, y, max_points: int) -> list:
+    """Splits a trajectory into consecutive chunks that fit in a scan record
+
+    Args:
+        x (array-like): x positions
+        y (array-like): y positions
+        max_points (int): maximum number of points per chunk
+
+    Returns:
+        list: (x, y) array pairs, in trajectory order
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.shape != y.shape or x.ndim != 1:
+        raise ValueError("x and y must be 1d arrays of the same length!")
+    n_chunks = max(int(np.ceil(x.size / max_points)), 1)
+    return list(zip(np.array_split(x, n_chunks), np.array_split(y, n_chunks)))
+
+
+def masked_serpentine(mask) -> tuple:
+    """Grid pixels inside a mask, in serpentine order: rows in order, alternating direction along x, so the sample never flies back across the empty part of a row
+
+    Args:
+        mask (array-like): boolean mask, shape (numy, numx). True pixels are visited.
+
+    Returns:
+        tuple: (iy, ix) integer arrays of the visited pixels, in scan order
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim != 2:
+        raise ValueError("mask must be a 2d array!")
+    order = np.arange(mask.size).reshape(mask.shape)
+    order[1::2] = order[1::2, ::-1]  # reverse every other row
+    visited = order.ravel()[mask.ravel()[order.ravel()]]
+    return np.unravel_index(visited, mask.shape)
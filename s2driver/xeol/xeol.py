@@ -3,6 +3,7 @@ from s2driver.xeol.spectrometer import Stellarnet
 import numpy as np
 import time
 import epics
+from functools import partial
 from threading import Thread
 from tqdm import tqdm
 from s2driver.analysis.helpers import save_dict_to_hdf5
@@ -15,7 +16,7 @@ XRF_DETECTOR_TRIGGER = (
     4  # index of scan trigger that is used to trigger the XRF detector
 )
 
-XEOL_IMPLEMENTATED_SCANTYPES = ["scan1d", "scan2d", "timeseries"]
+XEOL_IMPLEMENTATED_SCANTYPES = ["scan1d", "scan2d", "scan2d_serpentine", "timeseries"]
 class XEOLController:
     def __init__(self):
         try:
@@ -23,12 +24,14 @@ class XEOLController:
             self.IS_PRESENT = True
         except:
             self.IS_PRESENT = False
+        self.live_data = None  # spectra buffer of the scan being captured, filled in as points complete
         self.DWELLTIME_RATIO = 0.98  # fraction of XRF collection dwelltime to use to acquire spectra. Should be <1 to avoid missing the transition from point to point while XRF scan is ongoing
 
         self.XEOL_IMPLEMENTED_SCANTYPES = {
             "scan1d": self._capture_alongside_scan1d,
             "timeseries": self._capture_alongside_scan1d,
             "scan2d": self._capture_alongside_scan2d,
+            "scan2d_serpentine": partial(self._capture_alongside_scan2d, serpentine=True),
         }
     ### scanning
     def __xrf_detector_is_acquiring(self) -> bool:
@@ -40,11 +43,32 @@ class XEOLController:
         det_trig = epics.caget(f"2idd:scan1.T{XRF_DETECTOR_TRIGGER}CD")
         return det_trig == 0
 
+    def _wait_for_point(self, scanner) -> bool:
+        """Busy-waits until the step scan waits on the spectrometer for the next point
+
+        Args:
+            scanner (epics.devices.Scan): outermost scanner of the running scan, used to notice that the scan has ended
+
+        Returns:
+            bool: True when the next point is ready, False if the scan stopped first (eg was aborted)
+        """
+        while sc1.WCNT == 0: #while we havent gotten to the next point
+            if scanner.BUSY == 0:
+                return False
+        return True
+
+    def _release_point(self, scanner):
+        """Lets the step scan move on to the next point"""
+        sc1.WAIT = 0 #decrement the wait count. setting = 1 increments instead
+        while sc1.WCNT == 1 and scanner.BUSY == 1: #while wait count has not registered the change yet
+            pass
+
     def prime_for_scan(self, scantype:str, output_filepath: str) -> Thread:
         if scantype not in self.XEOL_IMPLEMENTED_SCANTYPES:
             raise ValueError(f"Invalid scan type - XEOL is only implemented for {XEOL_IMPLEMENTATED_SCANTYPES.keys()}")
         capture_function = self.XEOL_IMPLEMENTED_SCANTYPES[scantype] #get the capture thread appropriate to this scan type
         sc1.AWCT = 1 #set to wait for one trigger per pixel        
+        self.live_data = None  # capture thread will point this at the new scan's buffer
 
         stepscan_dwelltime = epics.caget(
             "2iddXMAP:PresetReal"
@@ -64,10 +88,11 @@ class XEOLController:
         capture_thread.start()
         return capture_thread
 
-    def _capture_alongside_scan2d(self, output_filepath: str, background_counts: np.ndarray):
+    def _capture_alongside_scan2d(self, output_filepath: str, background_counts: np.ndarray, serpentine: bool = False):
         """
         captures a spectrum from the usb spectrometer alongside the step scan
         saves raw wavelength + counts read from spectrometer to h5 file
+        serpentine: the scan reverses direction on odd lines. those points are stored flipped back, so every line is oriented like the first one
         """
         numx = sc1.NPTS
         numy = sc2.NPTS
@@ -82,20 +107,29 @@ class XEOLController:
         time_data = np.zeros([numy, numx])
         x_coords = np.zeros([numy, numx])
         y_coords = np.zeros([numy, numx])
+        self.live_data = {"spectra": data, "background": background_counts}
 
+        wl = None
+        npts_completed = 0
         for y_point in range(numy):
-            for x_point in range(numx):
-                while sc1.WCNT == 0: #while we havent gotten to the next point
-                    pass
+            for x_index in range(numx):
+                x_point = numx - 1 - x_index if serpentine and y_point % 2 else x_index
+                if not self._wait_for_point(sc2):
+                    break  # scan was aborted
                 wl, cts, tot_time = self.spectrometer.capture_raw()
                 time_data[y_point, x_point] = tot_time
                 data[y_point, x_point] = cts
                 x_coords[y_point, x_point] = epics.caget(sc1.P1PV)
                 y_coords[y_point, x_point] = epics.caget(sc2.P1PV)
-                sc1.WAIT = 0 #decrement the wait count. setting = 1 increments instead
-                while sc1.WCNT == 1: #while wait count has not registered the change yet
-                    pass
-                
+                self._release_point(sc2)
+                npts_completed += 1
+            else:
+                continue
+            break
+        if wl is None:
+            tqdm.write("XEOL scan ended before the first point, nothing saved")
+            return
+
         data_dict = {
             "wavelength": wl,
             "dwelltime": time_data,
@@ -103,6 +137,9 @@ class XEOLController:
             "background": background_counts,
             "x": x_coords,
             "y": y_coords,
+            "npts_completed": np.int64(npts_completed),  # unfinished points are left as zeros, with zero dwelltime. load_xeol makes them NaN
+            "stopped_early": np.int64(npts_completed < numx * numy),
+            "serpentine": np.int64(serpentine),  # odd lines were acquired in reverse, already flipped back here
         }
 
         save_dict_to_hdf5(data_dict, output_filepath)
@@ -125,26 +162,33 @@ class XEOLController:
         data = np.zeros([numpts, numwl])
         time_data = np.zeros(numpts)
         coords = np.zeros(numpts)
+        self.live_data = {"spectra": data, "background": background_counts}
 
+        wl = None
+        npts_completed = 0
         for point in range(numpts):
-            while sc1.WCNT == 0: #while we havent gotten to the next point
-                pass
+            if not self._wait_for_point(sc1):
+                break  # scan was aborted, eg by a stopping rule
 			
             tqdm.write("XEOL Scan triggered")
             wl, cts, tot_time = self.spectrometer.capture_raw()
             time_data[point] = tot_time
             data[point] = cts
             coords[point] = epics.caget(sc1.P1PV)
-            sc1.WAIT = 0 #decrement the wait count. setting = 1 increments instead
-            while sc1.WCNT == 1: #while wait count has not registered the change yet
-                pass
+            self._release_point(sc1)
+            npts_completed += 1
+        if wl is None:
+            tqdm.write("XEOL scan ended before the first point, nothing saved")
+            return
 
         data_dict = {
             "wavelength": wl,
-            "dwelltime": time_data,
-            "spectra": data,
+            "dwelltime": time_data[:npts_completed],  # only keep the completed points
+            "spectra": data[:npts_completed],
             "background": background_counts,
-            "x": coords,
+            "x": coords[:npts_completed],
+            "npts_completed": np.int64(npts_completed),
+            "stopped_early": np.int64(npts_completed < numpts),
         }
 
         save_dict_to_hdf5(data_dict, output_filepath)